@@ -21,12 +21,17 @@ import argparse
 import base64
 import string
 import logging
+import collections
+import contextlib
+import functools
+import multiprocessing
 
 from sentence_splitter import SentenceSplitter, SentenceSplitterException
 from loomchild.segmenter import LoomchildSegmenter
 
 from bitextor.utils.common import open_xz_or_gzip_or_plain
 from bitextor.utils.common import ExternalTextProcessor
+from bitextor.bitextor_tokenize import add_tokenizer_arguments, get_tokenizer, tokenize_document
 
 
 # True -> keep sentence
@@ -64,94 +69,294 @@ def split_segments(text, splitter_unary_func, prune_type="words", prune_threshol
     return segmented_text
 
 
-oparser = argparse.ArgumentParser(description="Tool that does sentence splitting on plain text")
-oparser.add_argument("--text", default="-",
-                     help="Plain text file")
-oparser.add_argument("--sentence-splitter", dest="splitter",
-                     help="Sentence splitter command line. If not provided, loomchild loomchild-segment Python port "
-                          "will be used")
-oparser.add_argument("--langcode", default="en",
-                     help="Language code for default sentence splitter and tokenizer")
-oparser.add_argument("--customnbp",
-                     help="Path for custom non breaking prefixes used by Moses Sentence Splitter Python port")
-oparser.add_argument("--sentences-output", dest="sent_output", default="-",
-                     help="Path of the output file that will contain sentence splitted text")
-oparser.add_argument("--prune", dest="prune_threshold", type=int, default=0,
-                     help="Prune sentences longer than n (words/characters)")
-oparser.add_argument("--prune-type", choices={"words", "chars"}, default="words",
-                     help="Prune sentences either by words or characters")
-oparser.add_argument("--dont-filter", action="store_true",
-                     help="By default, sentences which are detected to be very noisy or have very bad quality are discarded")
-oparser.add_argument("--process-paragraphs", action="store_true",
-                     help="Once the sentence had been base64-decoded, the second column contains the paragraph "
-                          "identification which will be processed")
-
-options = oparser.parse_args()
-
-splitter = options.splitter
-splitter_func = lambda s: s.split('\n')
-
-# Get splitter
-if not splitter or splitter == "loomchild":
-    # Loomchild is the default sentence splitter
-    splitter_func = LoomchildSegmenter(options.langcode).get_document_segmentation
-elif splitter == "moses":
+def cache_splitter(splitter_func, cache_size, by_line=False):
+    """
+    Put a LRU cache of the segmentation of the texts (e.g. repeated boilerplate paragraphs) in front of the
+    splitter. If by_line, the splitter segments every line on its own, so the lines are cached instead of the whole
+    text. Returns the cached splitter and the function which returns the cache statistics
+    """
+    cached_func = functools.lru_cache(maxsize=cache_size)(splitter_func)
+
+    if not by_line:
+        return cached_func, cached_func.cache_info
+
+    def split_lines(text):
+        segments = []
+
+        for line in text.split('\n'):
+            if line != "":
+                segments.extend(cached_func(line))
+
+        return segments
+
+    return split_lines, cached_func.cache_info
+
+
+def get_splitter(options):
+    """
+    Return the sentence splitter function, its cache statistics function (or None) and, if it is an external
+    command, its ExternalTextProcessor
+    """
+    splitter = options.splitter
+    splitter_func = lambda s: s.split('\n')
+    splitter_processor = None
+    cache_info = None
+
+    # Get splitter
+    if not splitter or splitter == "loomchild":
+        # Loomchild is the default sentence splitter
+        splitter_func = LoomchildSegmenter(options.langcode).get_document_segmentation
+    elif splitter == "moses":
+        try:
+            if options.customnbp:
+                splitter_func = SentenceSplitter(language=options.langcode, non_breaking_prefix_file=options.customnbp)
+            else:
+                splitter_func = SentenceSplitter(language=options.langcode)
+        except SentenceSplitterException as e:
+            sys.stderr.write(str(e) + "\n")
+            splitter_func = SentenceSplitter(language='en')
+
+        splitter_func = splitter_func.split
+    elif splitter == "none":
+        pass
+
+    # use custom sentence splitter via ExternalTextProcessor (a process per document, unless a framing is provided):
+    else:
+        splitter_processor = ExternalTextProcessor(os.path.expanduser(splitter), framing=options.splitter_framing,
+                                                   idle_timeout=options.external_idle_timeout)
+        splitter_func = lambda s: splitter_processor.process(s).split('\n')
+
+    if options.segmentation_cache_size > 0 and splitter != "none":
+        # Loomchild segments every line on its own
+        by_line = not splitter or splitter == "loomchild"
+        splitter_func, cache_info = cache_splitter(splitter_func, options.segmentation_cache_size, by_line)
+
+    return splitter_func, cache_info, splitter_processor
+
+
+def init_worker(opts):
+    # Every worker process builds its own splitter (the models and the external processes cannot be shared)
+    global options, splitter_func, cache_info, splitter_processor, tokenize, tokenizer_processors
+
+    options = opts
+    splitter_func, cache_info, splitter_processor = get_splitter(options)
+    tokenize, tokenizer_processors = None, []
+
+    if options.tokenised_output:
+        tokenize, tokenizer_processors = get_tokenizer(options)
+
+
+def cache_counts():
+    if cache_info is None:
+        return 0, 0
+
+    info = cache_info()
+
+    return info.hits, info.misses
+
+
+def split_document(doc_idx, doc):
+    sentences = ""
+    content = ""
+
     try:
-        if options.customnbp:
-            splitter_func = SentenceSplitter(language=options.langcode, non_breaking_prefix_file=options.customnbp)
-        else:
-            splitter_func = SentenceSplitter(language=options.langcode)
-    except SentenceSplitterException as e:
-        sys.stderr.write(str(e) + "\n")
-        splitter_func = SentenceSplitter(language='en')
-
-    splitter_func = splitter_func.split
-elif splitter == "none":
-    pass
-
-# TODO check TODO in bitextor_tokenize.py about ExternalTextProcessor and ToolWrapper
-# use custom sentence splitter via ExternalTextProcessor (inefficient):
-else:
-    splitter_func = ExternalTextProcessor(os.path.expanduser(splitter)).process
-
-with open_xz_or_gzip_or_plain(options.text) if options.text != "-" else sys.stdin as reader, \
-     open(options.sent_output, 'w') if options.sent_output != "-" else sys.stdout as writer:
+        content = base64.b64decode(doc.strip()).decode("utf-8")
+    except UnicodeDecodeError:
+        logging.warning("unicode decoding error while processing doc #%d", doc_idx)
+
+    if options.process_paragraphs:
+        content = content.rstrip().split("\n")
+
+        # Split each sentence of the paragraph and identify each of them with the corresponding paragraph
+        for sent_idx, sentence in enumerate(content, 1):
+            paragraph = sentence.split("\t")
+
+            if len(paragraph) == 1:
+                sentences += f"{paragraph[0]}\tp-1s-1\n"
+                logging.warning("could not get the paragraph identification data for the doc #%d, sentence #%d: using 'p-1s-1'",
+                                doc_idx, sent_idx)
+                continue
+
+            paragraph_text = paragraph[0]
+            paragraph_id = int(paragraph[1]) + 1 # Start at 1
+            sentences_wo_paragraphs = split_segments(paragraph_text, splitter_func, options.prune_type,
+                                                     options.prune_threshold, not options.dont_filter, return_list=True)
+
+            # Add the paragraph data to the splitted sentences
+            for idx in range(len(sentences_wo_paragraphs)):
+                sentences += f"{sentences_wo_paragraphs[idx]}\t" \
+                             f"p{paragraph_id}/{len(content)}s{idx + 1}/{len(sentences_wo_paragraphs)}\n"
+    else:
+        content = content.strip().replace("\t", " ")
+        content = '\n'.join([c.strip() for c in content.split('\n')])
+        sentences = split_segments(content, splitter_func, options.prune_type, options.prune_threshold, not options.dont_filter)
+
+    return sentences
+
+
+def remove_paragraph_identification(sentences):
+    # Same as running 'cut -f 1' on the document with utils/apply_command_b64_doc.py
+    lines = sentences.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+
+    sentences = "".join(line.split("\t")[0] + "\n" for line in lines)
+
+    # Empty documents are written as a newline
+    return sentences if sentences else "\n"
+
+
+def process_document(doc_idx, doc):
+    """
+    Split a document and, if --tokenised-output is provided, tokenise its sentences. Returns the base64-encoded
+    sentences and tokenised sentences (or None)
+    """
+    sentences = split_document(doc_idx, doc)
+    tokenised = None
+
+    if tokenize is not None:
+        tokenised = tokenize_document(tokenize, remove_paragraph_identification(sentences)
+                                      if options.process_paragraphs else sentences)
+
+    return base64.b64encode(sentences.encode("utf-8")).decode("utf-8"), tokenised
+
+
+def split_chunk(chunk):
+    hits, misses = cache_counts()
+    results = [process_document(doc_idx, doc) for doc_idx, doc in chunk]
+    new_hits, new_misses = cache_counts()
+
+    # The statistics of the cache of every worker are added by the main process
+    return results, new_hits - hits, new_misses - misses
+
+
+def read_chunks(reader, chunk_size):
+    chunk = []
+
     for doc_idx, doc in enumerate(reader, 1):
-        sentences = ""
-        content = ""
+        chunk.append((doc_idx, doc))
 
-        try:
-            content = base64.b64decode(doc.strip()).decode("utf-8")
-        except UnicodeDecodeError:
-            logging.warning("unicode decoding error while processing doc #%d", doc_idx)
-
-        if options.process_paragraphs:
-            content = content.rstrip().split("\n")
-
-            # Split each sentence of the paragraph and identify each of them with the corresponding paragraph
-            for sent_idx, sentence in enumerate(content, 1):
-                paragraph = sentence.split("\t")
-
-                if len(paragraph) == 1:
-                    sentences += f"{paragraph[0]}\tp-1s-1\n"
-                    logging.warning("could not get the paragraph identification data for the doc #%d, sentence #%d: using 'p-1s-1'",
-                                    doc_idx, sent_idx)
-                    continue
-
-                paragraph_text = paragraph[0]
-                paragraph_id = int(paragraph[1]) + 1 # Start at 1
-                sentences_wo_paragraphs = split_segments(paragraph_text, splitter_func, options.prune_type,
-                                                         options.prune_threshold, not options.dont_filter, return_list=True)
-
-                # Add the paragraph data to the splitted sentences
-                for idx in range(len(sentences_wo_paragraphs)):
-                    sentences += f"{sentences_wo_paragraphs[idx]}\t" \
-                                 f"p{paragraph_id}/{len(content)}s{idx + 1}/{len(sentences_wo_paragraphs)}\n"
-        else:
-            content = content.strip().replace("\t", " ")
-            content = '\n'.join([c.strip() for c in content.split('\n')])
-            sentences = split_segments(content, splitter_func, options.prune_type, options.prune_threshold, not options.dont_filter)
-
-        sentences = base64.b64encode(sentences.encode("utf-8")).decode("utf-8")
-
-        writer.write(f"{sentences}\n")
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def split_documents(reader, workers, chunk_size, cache_stats):
+    # Chunks of documents are split in parallel (if workers > 1), but returned in the input order, so the output
+    # has a line per input line
+    if workers <= 1:
+        for doc_idx, doc in enumerate(reader, 1):
+            yield process_document(doc_idx, doc)
+
+        cache_stats.update(zip(("hits", "misses"), cache_counts()))
+        return
+
+    max_pending = workers * 4
+    pending = collections.deque()
+
+    def next_results():
+        results, hits, misses = pending.popleft().get()
+        cache_stats["hits"] += hits
+        cache_stats["misses"] += misses
+
+        return results
+
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(options,)) as pool:
+        for chunk in read_chunks(reader, chunk_size):
+            pending.append(pool.apply_async(split_chunk, (chunk,)))
+
+            if len(pending) >= max_pending:
+                yield from next_results()
+
+        while pending:
+            yield from next_results()
+
+
+def main():
+    global options
+
+    oparser = argparse.ArgumentParser(description="Tool that does sentence splitting on plain text")
+    oparser.add_argument("--text", default="-",
+                         help="Plain text file")
+    oparser.add_argument("--sentence-splitter", dest="splitter",
+                         help="Sentence splitter command line. If not provided, loomchild loomchild-segment Python port "
+                              "will be used")
+    oparser.add_argument("--sentence-splitter-framing", dest="splitter_framing",
+                         help="Run the sentence splitter command as a single long-lived process instead of once per "
+                              "document. The value is how the documents are delimited: 'lines' if it writes exactly one "
+                              "line per input line, or a sentinel line which it copies to its output on a line of its own "
+                              "(e.g. '<P>' for Moses split-sentences.perl)")
+    oparser.add_argument("--external-idle-timeout", type=int, default=60,
+                         help="Seconds to wait for the output of a document from a long-lived sentence splitter before "
+                              "running it once per document instead (e.g. because it buffers its output)")
+    oparser.add_argument("--langcode", default="en",
+                         help="Language code for default sentence splitter and tokenizer")
+    oparser.add_argument("--customnbp",
+                         help="Path for custom non breaking prefixes used by Moses Sentence Splitter Python port")
+    oparser.add_argument("--sentences-output", dest="sent_output", default="-",
+                         help="Path of the output file that will contain sentence splitted text")
+    oparser.add_argument("--prune", dest="prune_threshold", type=int, default=0,
+                         help="Prune sentences longer than n (words/characters)")
+    oparser.add_argument("--prune-type", choices={"words", "chars"}, default="words",
+                         help="Prune sentences either by words or characters")
+    oparser.add_argument("--dont-filter", action="store_true",
+                         help="By default, sentences which are detected to be very noisy or have very bad quality are discarded")
+    oparser.add_argument("--process-paragraphs", action="store_true",
+                         help="Once the sentence had been base64-decoded, the second column contains the paragraph "
+                              "identification which will be processed")
+    oparser.add_argument("--segmentation-cache-size", type=int, default=100000,
+                         help="Number of segmented paragraphs kept in a LRU cache (per worker), so repeated paragraphs "
+                              "(e.g. menus and footers) are not segmented again. If the value is 0, the cache is "
+                              "disabled")
+    oparser.add_argument("--verbose", action="store_true",
+                         help="Produce additional information (e.g. the hit rate of the segmentation cache) through "
+                              "stderr")
+    oparser.add_argument("--tokenised-output", dest="tokenised_output",
+                         help="Path of a second output file where the split sentences are also tokenised (as "
+                              "bitextor_tokenize.py does), so the documents are not decoded and split again. The "
+                              "paragraph identification is not included in this file")
+    add_tokenizer_arguments(oparser)
+    oparser.add_argument("--workers", type=int, default=1,
+                         help="Number of processes which split the documents. The output keeps the input order")
+    oparser.add_argument("--chunk-size", type=int, default=64,
+                         help="Number of documents sent to a worker at once (with --workers)")
+
+    opts = oparser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
+                        level=logging.INFO if opts.verbose else logging.WARNING)
+
+    if opts.workers > 1:
+        # The workers build their own splitter
+        options = opts
+    else:
+        init_worker(opts)
+
+    with open_xz_or_gzip_or_plain(opts.text) if opts.text != "-" else sys.stdin as reader, \
+         open(opts.sent_output, 'w') if opts.sent_output != "-" else sys.stdout as writer, \
+         open_xz_or_gzip_or_plain(opts.tokenised_output, 'wt') if opts.tokenised_output \
+            else contextlib.nullcontext() as tokenised_writer:
+        cache_stats = collections.Counter()
+
+        for sentences, tokenised in split_documents(reader, opts.workers, opts.chunk_size, cache_stats):
+            writer.write(f"{sentences}\n")
+
+            if tokenised_writer:
+                tokenised_writer.write(f"{tokenised}\n")
+
+    lookups = cache_stats["hits"] + cache_stats["misses"]
+    if lookups:
+        logging.info("Segmentation cache: %d hits, %d misses (hit rate: %.1f%%)", cache_stats["hits"],
+                     cache_stats["misses"], 100.0 * cache_stats["hits"] / lookups)
+
+    if opts.workers <= 1:
+        for processor in [splitter_processor] + tokenizer_processors:
+            if processor:
+                processor.close()
+
+
+if __name__ == "__main__":
+    main()
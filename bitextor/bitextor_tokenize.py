@@ -19,6 +19,8 @@ import sys
 import os
 import argparse
 import base64
+import threading
+import collections
 
 from mosestokenizer import MosesTokenizer
 
@@ -26,26 +28,87 @@ from bitextor.utils.common import open_xz_or_gzip_or_plain
 from bitextor.utils.common import ExternalTextProcessor
 
 
-# TODO ExternalTextProcessor has to open and close the external software every time
-#  it is executed. Another option, whose performance is better, is ToolWrapper. The
-#  problem with ToolWrapper is that the executed software cannot be doing buffering
-#  since it is expected to obtain the ouput per each provided input, what might not happen
-#  in the case of softwares which do buffering. One possible solution might be to
-#  use ExternalTextProcessor as the default option and let the user configure if the
-#  provided tool does not do buffering, and use ToolWrapper. It might be nice if the
-#  taken decision would apply to every other scripts/steps (e.g. Bicleaner), since
-#  this might avoid to hang up the pipeline due to mishandeling buffering for external
-#  softwares
+# ExternalTextProcessor opens and closes the external software for every document, unless
+#  a framing is provided (--word-tokenizer-framing, --morph-analyser-framing): then the
+#  software is kept running, which requires it not to buffer its output (e.g. tokenizer.perl -b).
+#  If the output of a document does not arrive in time, ExternalTextProcessor falls back to
+#  running the software for every document
 
 
-def tokenize_moses(text, word_tokeniser, morph_analyser):
-    sentences = text.split('\n')
-    tokenized_text = []
-    for sentence in sentences:
-        tokenized_text.append(" ".join(word_tokeniser(sentence)).strip())
+class MosesBatchTokenizer(object):
+    """
+    Moses tokenizer.perl (through the mosestokenizer wrapper) which tokenises all the sentences of a document in a
+    single round trip, instead of one per sentence, with a LRU cache of the tokenised sentences of its language
+    (e.g. repeated menus and legal notices)
+    """
+
+    # Batches whose sentences are shorter (in total) are written without a thread: their tokenised output cannot
+    #  fill the pipe, so tokenizer.perl cannot block while they are being written
+    MAX_INLINE_CHARS = 2048
+
+    def __init__(self, lang, cache_size=0):
+        self.lang = lang
+        self.tokenizer = MosesTokenizer(lang)
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+
+    def tokenize_batch(self, batch):
+        text = "".join(sentence + "\n" for sentence in batch)
+
+        def write():
+            self.tokenizer.stdin.write(text)
+            self.tokenizer.stdin.flush()
+
+        if len(text) <= self.MAX_INLINE_CHARS:
+            write()
+            return [" ".join(self.tokenizer.readline().split()) for _ in batch]
+
+        # tokenizer.perl writes the output of a line as soon as it is read, so the output is read while the batch is
+        #  being written
+        writer = threading.Thread(target=write, daemon=True)
+        writer.start()
+        tokenized = [" ".join(self.tokenizer.readline().split()) for _ in batch]
+        writer.join()
+
+        return tokenized
+
+    def __call__(self, sentences):
+        """
+        Tokenise a list of sentences, and return a list with the tokens of each sentence joined by spaces
+        """
+        tokenized = [""] * len(sentences)
+        pending = collections.defaultdict(list)
 
+        for idx, sentence in enumerate(sentences):
+            if sentence == "":
+                continue
+            if sentence in self.cache:
+                self.cache.move_to_end(sentence)
+                tokenized[idx] = self.cache[sentence]
+            else:
+                pending[sentence].append(idx)
+
+        if pending:
+            batch = list(pending)
+
+            for sentence, tokens in zip(batch, self.tokenize_batch(batch)):
+                for idx in pending[sentence]:
+                    tokenized[idx] = tokens
+
+                if self.cache_size > 0:
+                    self.cache[sentence] = tokens
+                    if len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+
+        return tokenized
+
+    def close(self):
+        self.tokenizer.close()
+
+
+def tokenize_moses(text, word_tokeniser, morph_analyser):
     # don't do + "\n" because tokenized text ends with '' item
-    tokenized_text = "\n".join(tokenized_text)
+    tokenized_text = "\n".join(word_tokeniser(text.split('\n')))
 
     if morph_analyser:
         tokenized_text = morph_analyser.process(tokenized_text)
@@ -68,37 +131,87 @@ def tokenize_external(text, word_tokeniser, morph_analyser):
     return tokenized_text
 
 
-oparser = argparse.ArgumentParser(description="Tool that tokenizes plain text in Base64")
-oparser.add_argument('--text', default="-",
-                     help="Plain text file Base64 encoded")
-oparser.add_argument('--word-tokenizer', dest='tokenizer',
-                     help="Word tokenisation command line. If not provided, Moses tokenizer.perl will be used")
-oparser.add_argument('--morph-analyser', dest='lemmatizer',
-                     help="Morphological analyser command line")
-oparser.add_argument('--langcode', dest='langcode', default='en',
-                     help="Language code for default sentence splitter and tokenizer")
-
-options = oparser.parse_args()
-
-tokenizer = options.tokenizer
-lemmatizer = options.lemmatizer
-tokenizer_func = None
-
-# no custom tokenizer is provided, use moses (internally uses tool wrapper)
-if not tokenizer:
-    tokenizer = MosesTokenizer(options.langcode)
-    tokenizer_func = tokenize_moses
-# use custom tokenizer via ExternalTextProcessor (inefficient)
-else:
-    tokenizer = ExternalTextProcessor(os.path.expanduser(tokenizer))
-    tokenizer_func = tokenize_external
-
-if lemmatizer:
-    lemmatizer = ExternalTextProcessor(os.path.expanduser(lemmatizer))
-
-with open_xz_or_gzip_or_plain(options.text) if options.text != "-" else sys.stdin as reader:
-    for doc in reader:
-        content = base64.b64decode(doc.strip()).decode("utf-8").replace("\t", " ")
-        tokenized = tokenizer_func(content, tokenizer, lemmatizer).lower()
-
-        print(base64.b64encode(tokenized.encode("utf-8")).decode("utf-8"))
+def add_tokenizer_arguments(oparser):
+    """
+    Options of the tokenisation, which are shared with bitextor_split.py --tokenised-output
+    """
+    oparser.add_argument('--word-tokenizer', dest='tokenizer',
+                         help="Word tokenisation command line. If not provided, Moses tokenizer.perl will be used")
+    oparser.add_argument('--morph-analyser', dest='lemmatizer',
+                         help="Morphological analyser command line")
+    oparser.add_argument('--word-tokenizer-framing', dest='tokenizer_framing',
+                         help="Run the word tokenisation command as a single long-lived process instead of once per "
+                              "document. The value is how the documents are delimited: 'lines' if it writes exactly one "
+                              "line per input line, or a sentinel line which it copies to its output on a line of its own")
+    oparser.add_argument('--morph-analyser-framing', dest='lemmatizer_framing',
+                         help="Same as --word-tokenizer-framing, for the morphological analyser command")
+    oparser.add_argument('--tokenization-cache-size', type=int, default=100000,
+                         help="Number of tokenised sentences kept in a LRU cache when the Moses tokenizer is used, so "
+                              "repeated sentences (e.g. menus and legal notices) are not tokenised again. If the value "
+                              "is 0, the cache is disabled")
+
+
+def get_tokenizer(options):
+    """
+    Return a function which tokenises a document (base64-decoded), and the processors to close at the end
+    """
+    tokenizer = options.tokenizer
+    lemmatizer = options.lemmatizer
+    tokenizer_func = None
+
+    # no custom tokenizer is provided, use moses (internally uses tool wrapper), with the sentences of a document
+    #  tokenised in a single round trip
+    if not tokenizer:
+        tokenizer = MosesBatchTokenizer(options.langcode, options.tokenization_cache_size)
+        tokenizer_func = tokenize_moses
+    # use custom tokenizer via ExternalTextProcessor (a process per document, unless a framing is provided)
+    else:
+        tokenizer = ExternalTextProcessor(os.path.expanduser(tokenizer), framing=options.tokenizer_framing,
+                                          idle_timeout=options.external_idle_timeout)
+        tokenizer_func = tokenize_external
+
+    if lemmatizer:
+        lemmatizer = ExternalTextProcessor(os.path.expanduser(lemmatizer), framing=options.lemmatizer_framing,
+                                           idle_timeout=options.external_idle_timeout)
+
+    processors = [p for p in (tokenizer, lemmatizer) if p]
+
+    return lambda content: tokenizer_func(content, tokenizer, lemmatizer), processors
+
+
+def tokenize_document(tokenize, content):
+    """
+    Tokenise a document and return it lowercased and base64-encoded
+    """
+    tokenized = tokenize(content.replace("\t", " ")).lower()
+
+    return base64.b64encode(tokenized.encode("utf-8")).decode("utf-8")
+
+
+def main():
+    oparser = argparse.ArgumentParser(description="Tool that tokenizes plain text in Base64")
+    oparser.add_argument('--text', default="-",
+                         help="Plain text file Base64 encoded")
+    add_tokenizer_arguments(oparser)
+    oparser.add_argument('--external-idle-timeout', type=int, default=60,
+                         help="Seconds to wait for the output of a document from a long-lived command before running it "
+                              "once per document instead (e.g. because it buffers its output)")
+    oparser.add_argument('--langcode', dest='langcode', default='en',
+                         help="Language code for default sentence splitter and tokenizer")
+
+    options = oparser.parse_args()
+
+    tokenize, processors = get_tokenizer(options)
+
+    with open_xz_or_gzip_or_plain(options.text) if options.text != "-" else sys.stdin as reader:
+        for doc in reader:
+            content = base64.b64decode(doc.strip()).decode("utf-8")
+
+            print(tokenize_document(tokenize, content))
+
+    for processor in processors:
+        processor.close()
+
+
+if __name__ == "__main__":
+    main()
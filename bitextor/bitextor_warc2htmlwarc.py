@@ -15,7 +15,6 @@
 #  You should have received a copy of the GNU General Public License
 #  along with Bitextor.  If not, see <https://www.gnu.org/licenses/>.
 
-from warcio.archiveiterator import ArchiveIterator
 from warcio.warcwriter import WARCWriter
 from warcio.statusandheaders import StatusAndHeaders
 import sys
@@ -24,10 +23,24 @@ import cchardet
 import re
 import logging
 import lzma
+import os
+import signal
 import subprocess
+import threading
+import collections
+import concurrent.futures
 import zipfile
 import io
 from io import BytesIO
+import ftfy
+
+from bitextor.utils.stats import PipelineStats, timed
+from bitextor.utils.checkpoint import Checkpoint, iterate_archive, truncate_outputs
+from bitextor.utils.triage import triage_record
+from bitextor.utils.encoding import looks_like_mojibake
+
+# Records over this size (WARC Content-Length) are skipped
+MAX_RECORD_SIZE = 5242880
 
 
 def convert_encoding(data):
@@ -43,10 +56,47 @@ def convert_encoding(data):
     return None, ''
 
 
-def pdf2html(data):
-    pconverter = subprocess.Popen(["pdftohtml", "-i", "-stdout", "-", "-"],
-                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE)
-    converter_stdout, error = pconverter.communicate(input=data)
+class ConversionError(Exception):
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+# Converter processes which are running, so they can be killed when the processing finishes
+converter_processes = set()
+converter_processes_lock = threading.Lock()
+
+
+def kill_converter(pconverter):
+    # Kill the process group, in case the converter started other processes
+    try:
+        os.killpg(pconverter.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def pdf2html(data, timeout=None, max_memory=None):
+    command = ["pdftohtml", "-i", "-stdout", "-", "-"]
+    if max_memory:
+        # The memory limit (RLIMIT_AS) is set by a shell which then runs the converter, since preexec_fn is not safe
+        #  in the converter threads
+        command = ["sh", "-c", f'ulimit -v {max_memory // 1024} && exec "$@"', "sh"] + command
+
+    pconverter = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE,
+                                  start_new_session=True)
+    with converter_processes_lock:
+        converter_processes.add(pconverter)
+
+    try:
+        converter_stdout, error = pconverter.communicate(input=data, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_converter(pconverter)
+        pconverter.communicate()
+        raise ConversionError("conversion_timeout", f"pdftohtml did not finish in {timeout} seconds")
+    finally:
+        with converter_processes_lock:
+            converter_processes.discard(pconverter)
+
     return [converter_stdout.replace(b"&#160;", b" ")]
 
 
@@ -58,241 +108,323 @@ def pdfextract(data, pdfextractor):
         return [b""]
 
 
-def openoffice2html(data):
+def read_zip_members(zip_file, names, max_memory=None):
+    # The uncompressed size of the members is checked before reading them, so a small archive cannot take
+    # all the memory
+    size = sum(zip_file.getinfo(name).file_size for name in names)
+    if max_memory and size > max_memory:
+        raise ConversionError("conversion_memory", f"{size} bytes of uncompressed content exceed the memory limit")
+
+    xmls = []
+    for name in names:
+        try:
+            xmls.append(zip_file.read(name))
+        except Exception as ex:
+            continue
+    return xmls
+
+
+def openoffice2html(data, max_memory=None):
     datastream = io.BytesIO(data)
     try:
         openoffice_file = zipfile.ZipFile(datastream)
-        return [openoffice_file.read('content.xml')]
+        if 'content.xml' not in openoffice_file.namelist():
+            return []
+        return read_zip_members(openoffice_file, ['content.xml'], max_memory)
     except zipfile.BadZipFile:
         return []
 
 
-def office2html(data):
+def office2html(data, max_memory=None):
     datastream = io.BytesIO(data)
     try:
         office_file = zipfile.ZipFile(datastream)
         # word/document.xml, ppt/slides/slide*.xml, xl/sharedStrings.xml
-        xmls = []
-        for xml in office_file.namelist():
-            if "word/document.xml" == xml or "ppt/slides/slide" == xml[0:16] or "xl/sharedStrings.xml" == xml:
-                try:
-                    xmls.append(office_file.read(xml))
-                except Exception as ex:
-                    continue
-        return xmls
+        names = [xml for xml in office_file.namelist()
+                 if "word/document.xml" == xml or "ppt/slides/slide" == xml[0:16] or "xl/sharedStrings.xml" == xml]
+        return read_zip_members(office_file, names, max_memory)
     except zipfile.BadZipFile:
         return []
 
 
-def epub2html(data):
+def epub2html(data, max_memory=None):
     datastream = io.BytesIO(data)
     try:
         epub_file = zipfile.ZipFile(datastream)
         # EPUB/*html
-        xmls = []
-        for xml in epub_file.namelist():
-            if "ml" == xml[-2:]:
-                try:
-                    xmls.append(epub_file.read(xml))
-                except Exception as ex:
-                    continue
-        return xmls
+        names = [xml for xml in epub_file.namelist() if "ml" == xml[-2:]]
+        return read_zip_members(epub_file, names, max_memory)
     except zipfile.BadZipFile:
         return []
 
 
-oparser = argparse.ArgumentParser(
-    description="Script that takes every record in a WARC file and runs basic preprocessing, which includes: HTML"
-                "normalization, deduplication. The result is a WARC file.")
-oparser.add_argument('-v', "--verbose", action="store_true", default=False,
-                     help="Produce additional information about preprocessing through stderr.")
-oparser.add_argument('-o', '--output', dest='output', help='Output WARC file', default=sys.stdout)
-oparser.add_argument('-i', '--input', dest='input', help='Input WARC file', default=sys.stdin)
-oparser.add_argument('--only-broader', dest='onlybroader', action="store_true",
-                     help="Only outputs broader document format records", default=False)
-oparser.add_argument('--pdfextract', action="store_true", help='Use pdf-extract engine or pdftohtml for PDFs',
-                     default=False)
-oparser.add_argument('--pe_configfile', dest='configFile', default="",
-                     help='PDFExtract configuration file for language model paths')
-
-oparser.add_argument('--sentence_join_path', dest='sentenceJoinPath', help='sentence-join.py path', default="")
-oparser.add_argument('--kenlm_path', dest='kenlmPath', help='kenlm binary folder path', default="")
-oparser.add_argument('--pdfpass', dest='pdfpass', help='Pass PDFs verbatim to file', default=None)
-oparser.add_argument('--ftfy', action='store_true', help='User fix-text-for-you to fix possible encoding problems',
-                     default=False)
-oparser.add_argument('--cleanhtml', action='store_true', help='Clean HTML to remove javascript, css and head tags',
-                     default=False)
-oparser.add_argument('--disable-output-gzip', dest='disable_output_gzip', action='store_true',
-                     help='Disable compression of output WARC')
-oparser.add_argument('--disable-pdfs-gzip', dest='disable_pdfs_gzip', action='store_true',
-                     help='Disable compression of PDFs WARC (if --pdfpass is enabled)')
-options = oparser.parse_args()
-
-logging.basicConfig(
-    format='%(asctime)s %(levelname)-8s %(message)s',
-    level=logging.INFO if options.verbose else logging.ERROR,
-    datefmt='%Y-%m-%d %H:%M:%S')
-
-f = None
-fo = None
-po = None
-extractor = None
-
-if options.input == sys.stdin or options.input == '-':
-    f = ArchiveIterator(sys.stdin.buffer)
-elif options.input[-3:] == ".xz":
-    f = ArchiveIterator(lzma.open(options.input, 'r'))
-elif options.input[-3:] == ".gz":
-    f = ArchiveIterator(open(options.input, 'rb'))
-else:
-    f = ArchiveIterator(open(options.input, 'rb'))
-
-if options.output == sys.stdout or options.output == '-':
-    fo = WARCWriter(sys.stdout.buffer, gzip=True)
-else:
-    fo = WARCWriter(open(options.output, 'wb'), gzip=not options.disable_output_gzip)
-
-if options.pdfpass is not None:
-    po = WARCWriter(open(options.pdfpass, 'wb'), gzip=not options.disable_pdfs_gzip)
-
-if not options.pdfpass and options.pdfextract:
-    from pdfextract.extract import Extractor as ExtrP
-    extractor = ExtrP(
-        configFile=options.configFile,
-        sentenceJoinPath=options.sentenceJoinPath,
-        kenlmPath=options.kenlmPath)
-
-cleaner = None
-if options.cleanhtml:
-    from lxml.html.clean import Cleaner
-    cleaner = Cleaner(style=True, links=True, add_nofollow=True, page_structure=False, safe_attrs_only=False)
-
-if options.output == sys.stdout or options.output == '-':
-    filename = ""
-else:
-    filename = options.output
-
-fo.write_record(
-    fo.create_warcinfo_record(
-        filename=filename,
-        info={
-            'software': 'bitextor/bitextor-warc2htmlwarc.py',
-            'format': 'WARC File Format 1.0'}))
-
-for record in f:
-    # Initial checks
-    if record.rec_type != 'response' and record.rec_type != 'resource':
-        continue
-    if not record.rec_headers.get_header('WARC-Target-URI'):
-        url = None
-    elif record.rec_headers.get_header('WARC-Target-URI')[0] == '<' and record.rec_headers.get_header('WARC-Target-URI')[-1] == '>':
-        url = record.rec_headers.get_header('WARC-Target-URI')[1:-1]
-    else:
-        url = record.rec_headers.get_header('WARC-Target-URI')
-    if url == "unknown" or not url:
-        logging.info("Skipping page with unknown URL")
-        continue
-    if record.rec_headers.get_header('Content-Type') is None:
-        continue
-    if "text/dns" in record.rec_headers.get_header('Content-Type'):
-        continue
-    pageSize = int(record.rec_headers.get_header('Content-Length'))
-    if pageSize > 5242880:
-        logging.info("Skipping page, over limit. " + str(pageSize) + " " + url)
-        continue
-    if record.http_headers is not None and record.http_headers.get_header('Content-Type') is not None:
-        if "image/" in record.http_headers.get_header('Content-Type') \
-                or "audio/" in record.http_headers.get_header('Content-Type') \
-                or "video/" in record.http_headers.get_header('Content-Type') \
-                or "text/x-component" in record.http_headers.get_header('Content-Type') \
-                or "text/x-js" in record.http_headers.get_header('Content-Type') \
-                or "text/javascript" in record.http_headers.get_header('Content-Type') \
-                or "application/x-javascript" in record.http_headers.get_header('Content-Type') \
-                or "text/css" in record.http_headers.get_header('Content-Type') \
-                or "application/javascript" in record.http_headers.get_header('Content-Type') \
-                or "application/x-shockwave-flash" in record.http_headers.get_header('Content-Type') \
-                or "application/octet-stream" in record.http_headers.get_header('Content-Type') \
-                or "application/x-font-ttf" in record.http_headers.get_header('Content-Type'):
+def document_format(url, content_type):
+    """
+    Broader document format of a record ('pdf', 'openoffice', 'office' or 'epub'), or None if it is not converted
+    """
+    if url[-4:] == ".pdf" or (content_type is not None and "application/pdf" in content_type):
+        return "pdf"
+    elif url[-4:] == ".odt" or url[-4:] == ".ods" or url[-4:] == ".odp":
+        return "openoffice"
+    elif url[-5:] == ".docx" or url[-5:] == ".pptx" or url[-5:] == ".xlsx":
+        return "office"
+    elif url[-5:] == ".epub":
+        return "epub"
+    return None
+
+
+def convert_document(doc_format, data):
+    """
+    Extract the payloads (HTML or XML) of a document in a broader document format. Returns the payloads and the
+    time spent in the conversion; it can be run in the converters pool
+    """
+    timings = {}
+    max_memory = options.converter_max_memory * 1024 * 1024 if options.converter_max_memory > 0 else None
+    timeout = options.converter_timeout if options.converter_timeout > 0 else None
+
+    with timed(timings, doc_format):
+        if doc_format == "pdf":
+            if options.pdfextract:
+                payloads = pdfextract(data, extractor)
+            else:
+                payloads = pdf2html(data, timeout, max_memory)
+        elif doc_format == "openoffice":
+            payloads = openoffice2html(data, max_memory)
+        elif doc_format == "office":
+            payloads = office2html(data, max_memory)
+        else:
+            payloads = epub2html(data, max_memory)
+
+    return payloads, timings
+
+
+def add_processing_arguments(oparser):
+    """
+    Options of the cleaning and conversion of the records, which are shared with bitextor_warc2preprocess.py --htmlwarc
+    """
+    oparser.add_argument('--only-broader', dest='onlybroader', action="store_true",
+                         help="Only outputs broader document format records", default=False)
+    oparser.add_argument('--pdfextract', action="store_true", help='Use pdf-extract engine or pdftohtml for PDFs',
+                         default=False)
+    oparser.add_argument('--pe_configfile', dest='configFile', default="",
+                         help='PDFExtract configuration file for language model paths')
+
+    oparser.add_argument('--sentence_join_path', dest='sentenceJoinPath', help='sentence-join.py path', default="")
+    oparser.add_argument('--kenlm_path', dest='kenlmPath', help='kenlm binary folder path', default="")
+    oparser.add_argument('--pdfpass', dest='pdfpass', help='Pass PDFs verbatim to file', default=None)
+    oparser.add_argument('--ftfy', action='store_true', help='User fix-text-for-you to fix possible encoding problems',
+                         default=False)
+    oparser.add_argument('--ftfy-strict', dest='ftfy_strict', action='store_true',
+                         help='With --ftfy, run ftfy on every document, instead of only on the documents where '
+                              'mojibake is detected')
+    oparser.add_argument('--cleanhtml', action='store_true', help='Clean HTML to remove javascript, css and head tags',
+                         default=False)
+    oparser.add_argument('--disable-pdfs-gzip', dest='disable_pdfs_gzip', action='store_true',
+                         help='Disable compression of PDFs WARC (if --pdfpass is enabled)')
+    oparser.add_argument('--converter-workers', type=int, default=4,
+                         help='Number of threads which convert the broader document formats (e.g. PDFs with '
+                              'pdftohtml) while the records are read. The output keeps the input order. If the value '
+                              'is 0, documents are converted one after the other')
+    oparser.add_argument('--converter-timeout', type=int, default=120,
+                         help='Seconds after which the conversion of a document is abandoned and the document '
+                              'discarded. If the value is 0, conversions are not limited')
+    oparser.add_argument('--converter-max-memory', type=int, default=2048,
+                         help='Memory limit (MB) of the pdftohtml processes, and maximum uncompressed size of the '
+                              'content read from office and EPUB archives. If the value is 0, memory is not limited')
+
+
+def init_processing(opts):
+    global options, extractor, cleaner, converters, converter_timeout
+
+    options = opts
+    extractor = None
+    cleaner = None
+    converters = None
+
+    if not options.pdfpass and options.pdfextract:
+        from pdfextract.extract import Extractor as ExtrP
+        extractor = ExtrP(
+            configFile=options.configFile,
+            sentenceJoinPath=options.sentenceJoinPath,
+            kenlmPath=options.kenlmPath)
+
+    if options.cleanhtml:
+        from lxml.html.clean import Cleaner
+        cleaner = Cleaner(style=True, links=True, add_nofollow=True, page_structure=False, safe_attrs_only=False)
+
+    if options.converter_workers > 0:
+        converters = concurrent.futures.ThreadPoolExecutor(max_workers=options.converter_workers)
+    converter_timeout = options.converter_timeout if options.converter_timeout > 0 else None
+
+
+def finish_processing():
+    if converters is not None:
+        # The conversions which are still running (i.e. which timed out) are abandoned. Their converter processes are
+        #  killed, so the converter threads finish and the interpreter does not wait for them at exit
+        with converter_processes_lock:
+            for pconverter in converter_processes:
+                kill_converter(pconverter)
+        converters.shutdown(wait=False)
+
+
+def conversion_done(doc):
+    return doc["conversion"] is None or doc["conversion"].done()
+
+
+def pop_ready(pending, max_pending):
+    while pending and (len(pending) >= max_pending or conversion_done(pending[0])):
+        yield pending.popleft()
+
+
+def read_records(archive_records, stats, lookup=None):
+    """
+    Filter the records of a WARC and start the conversion of the broader document formats. Yields a dict for every
+    record which is kept, in input order, as soon as its conversion has finished (or when too many records are
+    waiting for it).
+
+    If `lookup` is provided, it is called with every record which is kept before reading its payload: if it returns
+    something other than None (e.g. the results of the record in a cache), the record is neither read nor converted
+    and the value is yielded in doc["cached"].
+    """
+    # Records which have been read, but not yielded yet
+    pending = collections.deque()
+    max_pending = max(options.converter_workers, 1) * 4
+
+    for index, offset, record in archive_records:
+        stats.count("records")
+        stats.maybe_flush()
+
+        # Skip the records which are not needed without reading their payload
+        reason, url = triage_record(record, max_size=MAX_RECORD_SIZE)
+        if reason is not None:
+            logging.info("Skipping record " + str(url) + ": " + reason)
+            stats.drop(reason)
             continue
 
-    url = url.replace('\t', ' ')
-    if url[-4:] == ".gif" or url[-4:] == ".jpg" or url[-5:] == ".jpeg" or url[-4:] == ".png" \
-            or url[-4:] == ".css" or url[-3:] == ".js" or url[-4:] == ".mp3" or url[-4:] == ".mp4" \
-            or url[-4:] == ".ogg" or url[-5:] == ".midi" or url[-4:] == ".swf":
-        continue
-
-    # Ignore robots.txt when processing records
-    if url[-11:] == "/robots.txt":
-        continue
+        cached = lookup(record) if lookup is not None else None
+        if cached is not None:
+            pending.append({
+                "index": index,
+                "offset": offset,
+                "url": url,
+                "date": record.rec_headers.get_header('WARC-Date'),
+                "recordId": record.rec_headers.get_header('WARC-Record-ID'),
+                "pdfpass": None,
+                "conversion": None,
+                "cached": cached,
+            })
+            yield from pop_ready(pending, max_pending)
+            continue
 
-    payload = record.content_stream().read()
-    payloads = []
+        with stats.time("read"):
+            payload = record.content_stream().read()
+        stats.count("payload_bytes", len(payload))
 
-    if not record.http_headers or record.http_headers.to_str()[:7] != "HTTP/1.":
-        if record.http_headers:
-            payload = record.http_headers.to_bytes() + payload
-        record_type = 'resource'
-        http_headers = None
-    else:
-        record_type = 'response'
-        http_headers = record.http_headers
-        # Transfer-Encoding: chunked header causes error with giawarc
-        http_headers.remove_header("Transfer-Encoding")
-        try:
-            http_headers.to_ascii_bytes()
-        except UnicodeEncodeError:
-            # if header is non ascii, create a new header, with status code only
-            # content length and content type will be filled before writing
-            http_headers = StatusAndHeaders(record.http_headers.get_statuscode(), [])
-
-    bdf = True
-    # Extract payloads (XML) from non-HTML document formats
-    if url[-4:] == ".pdf" \
-            or ((record.http_headers is not None and record.http_headers.get_header('Content-Type') is not None)
-                and "application/pdf" in record.http_headers.get_header('Content-Type')
-                ):
-        if options.pdfpass:
-            new_record = po.create_warc_record(
-                uri=url,
-                record_type=record_type,
-                warc_content_type=record.content_type,
-                payload=BytesIO(payload),
-                http_headers=http_headers)
-            po.write_record(new_record)
-            continue  # do not process further!
-        if options.pdfextract:
-            payloads = pdfextract(payload, extractor)
+        if not record.http_headers or record.http_headers.to_str()[:7] != "HTTP/1.":
+            if record.http_headers:
+                payload = record.http_headers.to_bytes() + payload
+            record_type = 'resource'
+            http_headers = None
         else:
-            payloads = pdf2html(payload)
-    elif url[-4:] == ".odt" or url[-4:] == ".ods" or url[-4:] == ".odp":
-        payloads = openoffice2html(payload)
-    elif url[-5:] == ".docx" or url[-5:] == ".pptx" or url[-5:] == ".xlsx":
-        payloads = office2html(payload)
-    elif url[-5:] == ".epub":
-        payloads = epub2html(payload)
+            record_type = 'response'
+            http_headers = record.http_headers
+            # Transfer-Encoding: chunked header causes error with giawarc
+            http_headers.remove_header("Transfer-Encoding")
+            try:
+                http_headers.to_ascii_bytes()
+            except UnicodeEncodeError:
+                # if header is non ascii, create a new header, with status code only
+                # content length and content type will be filled before writing
+                http_headers = StatusAndHeaders(record.http_headers.get_statuscode(), [])
+
+        http_content_type = record.http_headers.get_header('Content-Type') if record.http_headers is not None else None
+        doc = {
+            "index": index,
+            "offset": offset,
+            "url": url,
+            "record_type": record_type,
+            "http_headers": http_headers,
+            "warc_content_type": record.content_type,
+            "date": record.rec_headers.get_header('WARC-Date'),
+            "recordId": record.rec_headers.get_header('WARC-Record-ID'),
+            "digest": record.rec_headers.get_header('WARC-Payload-Digest'),
+            "http_content_type": http_content_type,
+            "format": document_format(url, http_content_type),
+            "pdfpass": None,
+            "conversion": None,
+            "cached": None,
+            "payloads": [],
+        }
+
+        # Extract payloads (XML) from non-HTML document formats
+        if doc["format"] == "pdf" and options.pdfpass:
+            doc["pdfpass"] = payload  # do not process further!
+        elif doc["format"] is not None and converters is not None \
+                and not (doc["format"] == "pdf" and options.pdfextract):
+            doc["conversion"] = converters.submit(convert_document, doc["format"], payload)
+        elif doc["format"] is not None:
+            # PDFExtract is not used from several threads
+            try:
+                doc["payloads"], timings = convert_document(doc["format"], payload)
+                stats.add_timings(timings)
+            except ConversionError as ex:
+                logging.info("Skipping " + url + ": " + str(ex))
+                stats.drop(ex.reason)
+                continue
+        elif not options.onlybroader:
+            doc["payloads"] = [payload]
+
+        pending.append(doc)
+        yield from pop_ready(pending, max_pending)
+
+    while pending:
+        yield pending.popleft()
+
+
+def process_payloads(doc, stats):
+    """
+    Decode and clean the payloads of a record (waiting for its conversion, if any). Yields the original encoding
+    and the cleaned HTML of every payload which is kept
+    """
+    url = doc["url"]
+
+    if doc["conversion"] is not None:
+        try:
+            payloads, timings = doc["conversion"].result(timeout=converter_timeout)
+        except concurrent.futures.TimeoutError:
+            # The thread cannot be stopped, but the output does not wait for it
+            logging.info("Skipping " + url + ": conversion did not finish in " + str(converter_timeout) + " seconds")
+            stats.drop("conversion_timeout")
+            return
+        except ConversionError as ex:
+            logging.info("Skipping " + url + ": " + str(ex))
+            stats.drop(ex.reason)
+            return
+        stats.add_timings(timings)
     else:
-        bdf = False
-        if options.onlybroader:
-            payloads = []
-        else:
-            payloads = [payload]
+        payloads = doc["payloads"]
+
+    if doc["format"] is not None and not payloads:
+        stats.drop("conversion")
 
-    date = record.rec_headers.get_header('WARC-Date')
-    recordId = record.rec_headers.get_header('WARC-Record-ID')
     for payload in payloads:
         if not payload:
+            stats.drop("empty_payload")
             continue
 
         logging.info("Processing document: " + url)
         # We convert into UTF8 first of all
-        orig_encoding, text = convert_encoding(payload)
+        with stats.time("encoding"):
+            orig_encoding, text = convert_encoding(payload)
 
         if orig_encoding is None:
             logging.info("Encoding of document " + url + " could not be identified")
+            stats.drop("unknown_encoding")
             continue
 
         text = re.sub('encoding *= *"[^"]+"', '', text, flags=re.IGNORECASE)
         if len(text.strip()) == 0:
+            stats.drop("empty_html")
             continue
 
         clean_html = ""
@@ -301,39 +433,198 @@ for record in f:
             if options.cleanhtml:
                 # HTML is then normalized
                 logging.info(url + ": cleaning HTML")
-                clean_html = cleaner.clean_html(text)
+                with stats.time("cleanhtml"):
+                    clean_html = cleaner.clean_html(text)
             else:
                 clean_html = text
 
-            if options.ftfy:
-                import ftfy
-                tree = ftfy.fix_text(clean_html, unescape_html=False, fix_character_width=False)
+            if options.ftfy and (options.ftfy_strict or looks_like_mojibake(clean_html)):
+                if not options.ftfy_strict:
+                    stats.count("mojibake_detected")
+                with stats.time("ftfy"):
+                    tree = ftfy.fix_text(clean_html, unescape_html=False, fix_character_width=False)
+                if tree != clean_html:
+                    stats.count("ftfy_repaired")
             else:
                 tree = clean_html
 
         except Exception as ex:
             logging.info("Skipping " + url + ": " + str(ex))
+            stats.drop("cleaning_error")
             continue
         clean_tree = tree.replace("&#160;", " ")
         clean_tree = clean_tree.replace("\t", " ")
-        clean_tree = clean_tree.encode('utf-8')
-        if http_headers:
-            http_headers.replace_header('Content-Length', str(len(clean_tree)))
-            http_headers.replace_header('Content-Type', 'text/html')
-        elif not http_headers and bdf:
-            # for broader document formats without HTTP header create a fake one
-            # to make it easier to distinguish between binary and processed documents downstream (warc2text)
-            record_type = 'response'
-            http_headers = StatusAndHeaders(
-                statusline="200 OK",
-                protocol="HTTP/1.1",
-                headers=[('Content-Type', 'text/html'), ('Content-Length', str(len(clean_tree)))]
-            )
 
+        yield orig_encoding, clean_tree
+
+
+def write_html(fo, doc, clean_tree, stats):
+    clean_tree = clean_tree.encode('utf-8')
+    record_type = doc["record_type"]
+    http_headers = doc["http_headers"]
+
+    if http_headers:
+        http_headers.replace_header('Content-Length', str(len(clean_tree)))
+        http_headers.replace_header('Content-Type', 'text/html')
+    elif doc["format"] is not None:
+        # for broader document formats without HTTP header create a fake one
+        # to make it easier to distinguish between binary and processed documents downstream (warc2text)
+        record_type = 'response'
+        http_headers = StatusAndHeaders(
+            statusline="200 OK",
+            protocol="HTTP/1.1",
+            headers=[('Content-Type', 'text/html'), ('Content-Length', str(len(clean_tree)))]
+        )
+
+    with stats.time("write"):
         new_record = fo.create_warc_record(
-            uri=url,
+            uri=doc["url"],
             record_type=record_type,
-            warc_content_type=record.content_type,
+            warc_content_type=doc["warc_content_type"],
             payload=BytesIO(clean_tree),
             http_headers=http_headers)
         fo.write_record(new_record)
+
+    stats.count("documents")
+    stats.count("html_bytes", len(clean_tree))
+
+
+def write_pdfpass(po, doc, stats):
+    new_record = po.create_warc_record(
+        uri=doc["url"],
+        record_type=doc["record_type"],
+        warc_content_type=doc["warc_content_type"],
+        payload=BytesIO(doc["pdfpass"]),
+        http_headers=doc["http_headers"])
+    po.write_record(new_record)
+    stats.count("pdfpass")
+
+
+def open_input(path, resume_state=None):
+    if path == sys.stdin or path == '-':
+        return iterate_archive(sys.stdin.buffer, resume_state)
+    elif path[-3:] == ".xz":
+        return iterate_archive(lzma.open(path, 'r'), resume_state)
+    else:
+        return iterate_archive(open(path, 'rb'), resume_state)
+
+
+def main():
+    oparser = argparse.ArgumentParser(
+        description="Script that takes every record in a WARC file and runs basic preprocessing, which includes: HTML"
+                    "normalization, deduplication. The result is a WARC file.")
+    oparser.add_argument('-v', "--verbose", action="store_true", default=False,
+                         help="Produce additional information about preprocessing through stderr.")
+    oparser.add_argument('-o', '--output', dest='output', help='Output WARC file', default=sys.stdout)
+    oparser.add_argument('-i', '--input', dest='input', help='Input WARC file', default=sys.stdin)
+    add_processing_arguments(oparser)
+    oparser.add_argument('--disable-output-gzip', dest='disable_output_gzip', action='store_true',
+                         help='Disable compression of output WARC')
+    oparser.add_argument('--stats-json', dest='stats_json',
+                         help='Path of a JSON file where the time spent in every stage, the number of processed '
+                              'records and the reasons why records were discarded are periodically written')
+    oparser.add_argument('--checkpoint',
+                         help='Path of a checkpoint which is periodically written with the last processed record and '
+                              'the size of the output files, so an interrupted run can be resumed with --resume. '
+                              'Requires --output')
+    oparser.add_argument('--checkpoint-interval', type=int, default=300, help='Seconds between checkpoints')
+    oparser.add_argument('--resume', action='store_true',
+                         help='Resume from the checkpoint, if it exists: the records which were processed are skipped '
+                              'and the output files are truncated to their size in the checkpoint')
+    opts = oparser.parse_args()
+
+    if opts.checkpoint and (opts.output == sys.stdout or opts.output == '-'):
+        oparser.error("--checkpoint requires --output")
+    if opts.resume and not opts.checkpoint:
+        oparser.error("--resume requires --checkpoint")
+
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=logging.INFO if opts.verbose else logging.ERROR,
+        datefmt='%Y-%m-%d %H:%M:%S')
+
+    po = None
+    stats = PipelineStats(opts.stats_json)
+    checkpoint = None
+    resume_state = None
+
+    if opts.checkpoint:
+        checkpoint = Checkpoint(opts.checkpoint, opts.checkpoint_interval)
+
+        if opts.resume:
+            resume_state, _ = checkpoint.load()
+
+    if resume_state:
+        # Every record is written as a separate gzip member, so the output can be truncated after any of them
+        truncate_outputs(resume_state["outputs"])
+        stats.counters.update(resume_state["counters"])
+        stats.drops.update(resume_state["drops"])
+
+    output_mode = 'ab' if resume_state else 'wb'
+
+    f = open_input(opts.input, resume_state)
+
+    if opts.output == sys.stdout or opts.output == '-':
+        fo = WARCWriter(sys.stdout.buffer, gzip=True)
+    else:
+        fo = WARCWriter(open(opts.output, output_mode), gzip=not opts.disable_output_gzip)
+
+    if opts.pdfpass is not None:
+        po = WARCWriter(open(opts.pdfpass, output_mode), gzip=not opts.disable_pdfs_gzip)
+
+    init_processing(opts)
+
+    if opts.output == sys.stdout or opts.output == '-':
+        filename = ""
+    else:
+        filename = opts.output
+
+    if not resume_state:
+        fo.write_record(
+            fo.create_warcinfo_record(
+                filename=filename,
+                info={
+                    'software': 'bitextor/bitextor-warc2htmlwarc.py',
+                    'format': 'WARC File Format 1.0'}))
+
+    def save_checkpoint(index, offset):
+        outputs = {}
+        for path, writer in ((opts.output, fo), (opts.pdfpass, po)):
+            if writer is not None:
+                writer.out.flush()
+                outputs[path] = writer.out.tell()
+
+        checkpoint.save({
+            "input_record": index,
+            "input_offset": offset,
+            "outputs": outputs,
+            "counters": dict(stats.counters),
+            "drops": dict(stats.drops),
+        })
+
+    last_record = None
+
+    for doc in read_records(f, stats):
+        # Every record before this one has been completely processed
+        if checkpoint is not None and last_record is not None and checkpoint.due():
+            with stats.time("checkpoint"):
+                save_checkpoint(*last_record)
+
+        if doc["pdfpass"] is not None:
+            write_pdfpass(po, doc, stats)
+        else:
+            for orig_encoding, clean_tree in process_payloads(doc, stats):
+                write_html(fo, doc, clean_tree, stats)
+
+        last_record = (doc["index"], doc["offset"])
+
+    finish_processing()
+
+    if checkpoint is not None:
+        checkpoint.remove()
+
+    stats.flush()
+
+
+if __name__ == "__main__":
+    main()
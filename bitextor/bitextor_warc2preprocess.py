@@ -16,10 +16,11 @@
 #  along with Bitextor.  If not, see <https://www.gnu.org/licenses/>.
 
 import html
-from warcio.archiveiterator import ArchiveIterator
+import collections
+import multiprocessing
+import concurrent.futures
 import base64
 import argparse
-import cchardet
 import magic
 import re
 from bs4 import BeautifulSoup
@@ -36,6 +37,28 @@ import html5lib
 import lxml
 from lxml import etree
 from lxml import html as _lxml_html
+from warcio.warcwriter import WARCWriter
+
+from bitextor.utils.hashstore import HashStore, SeenHashes, is_hash_store, write_hashes
+from bitextor.utils.neardup import SimHashIndex, simhash
+from bitextor.utils.encoding import resolve_encoding, resolve_mime
+from bitextor.utils.stats import PipelineStats, timed
+from bitextor.utils.watchdog import CPUBudget, RecordBudgetExceeded
+from bitextor.utils.writers import BackgroundWriter, HandlePool, MemberWriter
+from bitextor.utils.checkpoint import Checkpoint, iterate_archive, truncate_outputs
+from bitextor.utils.triage import record_url, triage_record
+from bitextor.utils.digestcache import DigestCache, options_fingerprint
+from bitextor import bitextor_warc2htmlwarc as warc2htmlwarc
+
+# Options which change the results stored in the digest cache (--digest-cache)
+DIGEST_CACHE_OPTIONS = (
+    "boilerpipe", "parser", "html5lib", "l1", "l2", "langs", "langid", "paragraph_identification",
+    "near_duplicates_distance", "near_duplicates_shingle_size", "max_record_seconds", "max_record_size",
+    "htmlwarc", "onlybroader", "pdfextract", "configFile", "pdfpass", "ftfy", "ftfy_strict", "cleanhtml",
+    "converter_timeout", "converter_max_memory",
+)
+# Results which depend on the rest of the run, and are not stored in the digest cache
+TRANSIENT_DROPS = {"time_budget", "watchdog", "duplicate_html"}
 
 
 def remove_control_characters(html):
@@ -119,10 +142,23 @@ class SimpleParser(HTMLTokenizer):
     lastTok = ""
     parsed = ""
 
+    def __init__(self):
+        super().__init__()
+        self.links = []
+        self.images = []
+
+    def collect_refs(self, tag, attrs):
+        for name, value in attrs:
+            if name == "href" and value:
+                self.links.append(value)
+            elif name == "src" and value and tag == "img":
+                self.images.append(value)
+
     def handle_starttag(self, tag, attrs):
         if tag in self.startendNL or tag in self.selfNL:
             self.parsed = self.parsed + "\n"
         self.lastTok = tag
+        self.collect_refs(tag, attrs)
 
     def handle_endtag(self, tag):
         if tag in self.startendNL:
@@ -133,6 +169,7 @@ class SimpleParser(HTMLTokenizer):
     def handle_startendtag(self, tag, attrs):
         if tag in self.selfNL:
             self.parsed = self.parsed + "\n"
+        self.collect_refs(tag, attrs)
 
     def handle_data(self, data):
         if self.lastTok not in self.noText:
@@ -154,21 +191,6 @@ def guess_lang_from_data3(model, data):
     return language
 
 
-def convert_encoding(data):
-    encoding = cchardet.detect(data)['encoding']
-    if encoding is None:
-        encoding = "utf-8"
-    if len(data) > 0:
-        # We convert, even if the text is detected to be UTF8 so,
-        # if it is an error and conversion fails, the error is caught here
-        for enc in [encoding, 'utf-8', 'iso-8859-1', 'windows‑1252']:
-            try:
-                return enc, data.decode(enc)
-            except BaseException:
-                pass
-    return None, ''
-
-
 def open_xz_or_gzip(path, mode):
     if path[-3:] == '.gz':
         return gzip.open(path, mode)
@@ -178,25 +200,56 @@ def open_xz_or_gzip(path, mode):
         return open(path, mode)
 
 
+def background_writer(fh):
+    if compression_executor is not None:
+        # Compressed and written in the background
+        return BackgroundWriter(fh, compression_executor)
+
+    return fh
+
+
+def open_output(path):
+    if checkpoint is None:
+        return background_writer(open_xz_or_gzip(path, "w"))
+
+    # With checkpoints, files are written as a sequence of members which can be truncated. The files of a resumed
+    # run have already been truncated to their size in the checkpoint, so they are appended to
+    fh = background_writer(MemberWriter(path, "ab" if path in output_sizes else "wb"))
+    output_files[path] = fh
+
+    return fh
+
+
+def open_xzlang_output(lang):
+    return background_writer(lzma.open(f"{options.outDir}/{lang}", mode="a", format=lzma.FORMAT_XZ))
+
+
 def open_output_files(options, lang, files_dict):
     if not options.xzlang and lang not in files_dict:
         if not os.path.exists(f"{options.outDir}/{lang}"):
             os.makedirs(f"{options.outDir}/{lang}")
-        urlFile = open_xz_or_gzip(f"{options.outDir}/{lang}/url.{options.compression}", "w")
-        encodingFile = open_xz_or_gzip(f"{options.outDir}/{lang}/encoding.{options.compression}", "w")
-        mimeFile = open_xz_or_gzip(f"{options.outDir}/{lang}/mime.{options.compression}", "w")
-        normHtmlFile = open_xz_or_gzip(f"{options.outDir}/{lang}/normalized_html.{options.compression}", "w")
-        plainTextFile = open_xz_or_gzip(f"{options.outDir}/{lang}/plain_text.{options.compression}", "w")
-        if options.boilerpipe:
-            deboilFile = open_xz_or_gzip(f"{options.outDir}/{lang}/deboilerplate_html.{options.compression}", "w")
+        urlFile = open_output(f"{options.outDir}/{lang}/url.{options.compression}")
+        encodingFile = open_output(f"{options.outDir}/{lang}/encoding.{options.compression}")
+        mimeFile = open_output(f"{options.outDir}/{lang}/mime.{options.compression}")
+        normHtmlFile = open_output(f"{options.outDir}/{lang}/normalized_html.{options.compression}")
+        plainTextFile = open_output(f"{options.outDir}/{lang}/plain_text.{options.compression}")
+        if options.links_images:
             files_dict[lang] = {
+                "linksFile": open_output(f"{options.outDir}/{lang}/links.{options.compression}"),
+                "imagesFile": open_output(f"{options.outDir}/{lang}/images.{options.compression}")
+            }
+        else:
+            files_dict[lang] = {}
+        if options.boilerpipe:
+            deboilFile = open_output(f"{options.outDir}/{lang}/deboilerplate_html.{options.compression}")
+            files_dict[lang].update({
                 "urlFile": urlFile,
                 "encodingFile": encodingFile,
                 "mimeFile": mimeFile,
                 "normHtmlFile": normHtmlFile,
                 "plainTextFile": plainTextFile,
                 "deboilFile": deboilFile
-            }
+            })
         else:
             if not os.path.exists(f"{options.outDir}/{lang}/deboilerplate_html.{options.compression}") \
                     and not os.path.islink(f"{options.outDir}/{lang}/deboilerplate_html.{options.compression}"):
@@ -204,113 +257,165 @@ def open_output_files(options, lang, files_dict):
                     f"normalized_html.{options.compression}",
                     f"{options.outDir}/{lang}/deboilerplate_html.{options.compression}"
                 )
-            files_dict[lang] = {
+            files_dict[lang].update({
                 "urlFile": urlFile,
                 "encodingFile": encodingFile,
                 "mimeFile": mimeFile,
                 "normHtmlFile": normHtmlFile,
-                "plainTextFile": plainTextFile}
-
-
-oparser = argparse.ArgumentParser(
-    description="Script that takes every record in a WARC file and runs preprocessing, which includes: HTML"
-                "normalization, deduplication, MIME and language identification, and boilerplate removing. The result"
-                "of each pre-processing step is stored in a XZ compressed file in the output directory.")
-oparser.add_argument("--verbose", action="store_true", default=False,
-                     help="Produce additional information about preprocessing through stderr.")
-oparser.add_argument("--boilerpipe", action="store_true", default=False,
-                     help="Use boilerpipe bodytext to do the de-boiling")
-oparser.add_argument("--boilerpipe-max-heap-size", type=int, default=-1,
-                     help="Max. heap size for providing to jpype if the JVM is not up. If the value is negative, the "
-                          "default max. heap size will be used instead")
-oparser.add_argument("--parser", dest="parser", default="bs4", choices={'bs4', 'modest', 'lxml', 'simple'},
-                     help="Use 'HTML tokenizer', 'modest', 'bs4' or 'lxml' (using html5lib tree) parser to extract "
-                          "relevant text from HTML. By default 'bs4' is used")
-oparser.add_argument("--html5lib", action="store_true", default=False, help="Process HTML tree with html5lib")
-oparser.add_argument('--output-dir', dest='outDir', help='Output directory', required=True)
-oparser.add_argument('--output_hash', dest='outputHash', help='Output path for Murmur Hash of plain texts')
-oparser.add_argument('--input_hash', dest='inputHash',
-                     help='Input path for previous Bitextor Murmur Hash plain texts file')
-oparser.add_argument('--lang1', dest='l1', help='Language l1 in the crawl', default=None)
-oparser.add_argument('--lang2', dest='l2', help='Language l2 in the crawl', default=None)
-oparser.add_argument('--input', dest='input', help='Input WARC file', default=sys.stdin)
-oparser.add_argument('--xzlang', action="store_true", help='Separate output into different files by language',
-                     default=False)
-oparser.add_argument('--langs', dest="langs", default="",
-                     help='List of languages to include or ignore (%%): l1,l2,%%l3,%%l4')
-oparser.add_argument('--langid', dest="langid", default="cld2", help="Model used for language detection: cld2 or cld3")
-oparser.add_argument('--compression', dest='compression', default='gz', choices={'xz', 'gz'},
-                     help='Compression type for the output files')
-oparser.add_argument('--paragraph-identification', action='store_true',
-                     help='Add paragraph index in each b64encoded document sentence as tab separated column')
-options = oparser.parse_args()
-
-logging.basicConfig(
-    format='%(asctime)s %(levelname)-8s %(message)s',
-    level=logging.INFO if options.verbose else logging.ERROR,
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
+                "plainTextFile": plainTextFile})
 
-if options.input == sys.stdin or options.input == '-':
-    f = ArchiveIterator(sys.stdin.buffer)
-elif options.input[-3:] == ".xz":
-    f = ArchiveIterator(lzma.open(options.input, 'r'))
-elif options.input[-3:] == ".gz":
-    f = ArchiveIterator(open(options.input, 'rb'))
-else:
-    f = ArchiveIterator(open(options.input, 'r'))
-
-seen_html = set()
-seen_plain_text = set()
-
-magic.Magic(mime=True)
-
-languages = []
-banned = []
-if options.langid == "cld3":
-    import cld3
-    cld3model = cld3.LanguageIdentifier()
-else:
-    import pycld2 as cld2
-
-if options.langs:
-    for l in options.langs.split(','):
-        if l[0] == '+':
-            languages.append(l[1:])
-        elif l[0] == '%':
-            banned.append(l[1:])
-        else:
-            languages.append(l)
 
-# make sure that if languages are specified, lang1 and lang2 are among them
-if languages:
-    if options.l1 is not None:
-        languages.append(options.l1)
-    if options.l2 is not None:
-        languages.append(options.l2)
+class ExtractionError(Exception):
+
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+def normalize_text(plaintext):
+    return re.sub(r"\n+", "\n",
+                  re.sub(r" *\n *", "\n",
+                         re.sub(r"[ \t\v\f]+", " ",
+                                re.sub(r"\r", "",
+                                       plaintext.replace(u'\xa0', u' '))))).strip()
+
+
+# Links (href of any element) and images (src of img elements) of a document, in the order they appear, taken from the
+#  tree which is parsed to extract the text. Every function returns the text, the links and the images
+def strip_refs(refs):
+    return [r.strip() for r in refs if r and r.strip()]
+
+
+# get text with beautifulsoup
+def extract_text_bs4(url, html):
+    logging.info(url + ": Getting text with BeautifulSoup")
+    try:
+        soup = BeautifulSoup(html, "lxml")
+    except Exception as ex:
+        raise ExtractionError("parser_error", "Exception ocurred when processing " + url + " with BeautifulSoup")
+
+    links = strip_refs(tag.get("href") for tag in soup.find_all(href=True))
+    images = strip_refs(tag.get("src") for tag in soup.find_all("img", src=True))
+
+    for script in soup(["script", "style", "img"]):
+        script.extract()  # rip it out
+    return soup.get_text(), links, images
+
+
+# or get text with 'modest' library
+def extract_text_modest(url, html):
+    logging.info(url + ": Getting text with modest (selectolax)")
+    try:
+        tree = HTMLParser(html)
+    except RecordBudgetExceeded:
+        raise
+    except BaseException:
+        raise ExtractionError("parser_error", "Tree structure issues in HTML/XML. Ignoring this document")
+
+    links = strip_refs(tag.attributes.get("href") for tag in tree.css("[href]"))
+    images = strip_refs(tag.attributes.get("src") for tag in tree.css("img[src]"))
+
+    for tag in tree.css('script'):
+        tag.decompose()
+    for tag in tree.css('style'):
+        tag.decompose()
+    for tag in tree.css('img'):
+        tag.decompose()
+    if tree.body is None:
+        raise ExtractionError("empty_body", "Body is empty. Ignoring this document")
+    # TODO should separator='\n' be removed? It splits inline elements inside block elements...
+    return tree.body.text(separator='\n'), links, images
+
+
+# or get text by moving through the lxml tree
+def extract_text_lxml(url, html):
+    logging.info(url + ": Getting text with lxml")
+
+    document = lxml.html.document_fromstring(html)
 
-previous_crawl_hashes = set()
+    return document.text_content(), strip_refs(document.xpath("//@href")), strip_refs(document.xpath("//img/@src"))
 
-if not os.path.exists(options.outDir):
-    os.makedirs(options.outDir)
 
-if options.inputHash:
-    with open_xz_or_gzip(options.inputHash, 'r') as fh:
-        for line in fh:
-            previous_crawl_hashes.add(int(line.strip()))
+# or use an HTML tokenizer
+def extract_text_simple(url, html):
+    logging.info(url + ": Getting text with HTML tokenizer")
+    parser = SimpleParser()
+    try:
+        parser.feed(html)
+        return parser.get_text(), strip_refs(parser.links), strip_refs(parser.images)
+    except RecordBudgetExceeded:
+        raise
+    except BaseException:
+        raise ExtractionError("parser_error", "Tree structure issues in HTML/XML. Ignoring this document")
 
-plainTextHashFile = None
-if options.outputHash:
-    plainTextHashFile = open_xz_or_gzip(options.outputHash, "w")
 
-files_dict = dict()
+# Markup left in the text extracted by modest, which means that the HTML was not parsed as expected
+LEFTOVER_MARKUP_RE = re.compile(r"</?(html|head|body|p|div|span|table|tr|td|ul|li|a|br|script|style)\b[^>]*>",
+                                re.IGNORECASE)
 
-ExtrB = None
-if options.boilerpipe:
+
+def extract_text(url, text, deboiled):
+    """
+    Extract the normalized plain text of a document with the configured parser. Returns the parser which was used,
+    the text, and the links and images of the document. With the 'auto' parser, modest is used unless it fails,
+    returns an empty text or the text still contains HTML tags, in which case BeautifulSoup is used instead
+    """
+    if options.parser == "auto":
+        try:
+            plaintext, links, images = extract_text_modest(url, deboiled)
+            plaintext = normalize_text(plaintext)
+
+            if plaintext and not LEFTOVER_MARKUP_RE.search(plaintext):
+                return "modest", plaintext, links, images
+
+            logging.info(url + ": modest did not extract a valid text, falling back to BeautifulSoup")
+        except ExtractionError as ex:
+            logging.info(url + ": " + str(ex) + ", falling back to BeautifulSoup")
+
+        parser, extract = "bs4", extract_text_bs4
+    elif options.parser == "bs4":
+        parser, extract = "bs4", extract_text_bs4
+    elif options.parser == "modest":
+        parser, extract = "modest", extract_text_modest
+    elif options.parser == "lxml":
+        parser, extract = "lxml", extract_text_lxml
+    else:
+        # the HTML tokenizer processes the HTML before boilerplate removal
+        parser, extract, deboiled = "simple", extract_text_simple, text
+
+    plaintext, links, images = extract(url, deboiled)
+
+    return parser, normalize_text(plaintext), links, images
+
+
+def parse_langs(options):
+    languages = []
+    banned = []
+
+    if options.langs:
+        for l in options.langs.split(','):
+            if l[0] == '+':
+                languages.append(l[1:])
+            elif l[0] == '%':
+                banned.append(l[1:])
+            else:
+                languages.append(l)
+
+    # make sure that if languages are specified, lang1 and lang2 are among them
+    if languages:
+        if options.l1 is not None:
+            languages.append(options.l1)
+        if options.l2 is not None:
+            languages.append(options.l2)
+
+    return languages, banned
+
+
+def start_boilerpipe(max_heap_size_mb):
     import jpype
 
     if not jpype.isJVMStarted():
-        max_heap_size = f"-Xmx{str(options.boilerpipe_max_heap_size)}M" if options.boilerpipe_max_heap_size >= 0 else ''
+        max_heap_size = f"-Xmx{str(max_heap_size_mb)}M" if max_heap_size_mb >= 0 else ''
         jars = []
 
         for top, dirs, files in os.walk(
@@ -329,211 +434,712 @@ if options.boilerpipe:
 
         jpype.startJVM(*jargs, convertStrings=False)
 
-    from boilerpipe.extract import Extractor as ExtrB
+    from boilerpipe.extract import Extractor
 
-for record in f:
-    plaintext = ""
-    # Initial checks
-    if record.rec_type != 'response' and record.rec_type != 'resource':
-        continue
-    if record.rec_headers.get_header('WARC-Target-URI')[0] == '<' \
-            and record.rec_headers.get_header('WARC-Target-URI')[-1] == '>':
-        url = record.rec_headers.get_header('WARC-Target-URI')[1:-1]
+    return Extractor
+
+
+def init_worker(opts):
+    # Set up the state needed by process_document(): it runs once in the main process when working serially,
+    # and once per worker process otherwise (the JVM and the language models cannot be shared across processes)
+    global options, languages, banned, cld2, cld3model, ExtrB
+
+    options = opts
+    languages, banned = parse_langs(options)
+
+    magic.Magic(mime=True)
+
+    if options.langid == "cld3":
+        import cld3
+        cld3model = cld3.LanguageIdentifier()
     else:
-        url = record.rec_headers.get_header('WARC-Target-URI')
-    if url == "unknown":
-        logging.info("Skipping page with unknown URL")
-        continue
-    url = url.replace('\t', ' ')
-    if url[-4:] == ".gif" or url[-4:] == ".jpg" or url[-5:] == ".jpeg" or url[-4:] == ".png" or url[-4:] == ".css" \
-            or url[-3:] == ".js" or url[-4:] == ".mp3" or url[-4:] == ".mp4" or url[-4:] == ".ogg" \
-            or url[-5:] == ".midi" or url[-4:] == ".swf":
-        continue
-
-    # Ignore robots.txt when processing records
-    if url[-11:] == "/robots.txt":
-        continue
-
-    payload = record.content_stream().read()
+        import pycld2 as cld2
+
+    if options.boilerpipe:
+        ExtrB = start_boilerpipe(options.boilerpipe_max_heap_size)
+
+
+def record_cache_key(record):
+    content_type = record.http_headers.get_header('Content-Type') if record.http_headers else None
+    # The same payload is processed differently depending on the extension of the URL (e.g. '.pdf')
+    doc_format = warc2htmlwarc.document_format(record_url(record), content_type)
+
+    return digest_cache.key(record.rec_headers.get_header('WARC-Payload-Digest'), content_type, doc_format)
+
+
+def lookup_cache(record):
+    key = record_cache_key(record)
+
+    return digest_cache.get(key) if key else None
+
+
+def cached_records(record, results):
+    # A record for every document of the original record, with its result in the digest cache
+    for result in results:
+        yield dict(record, cached=result, cache_key=None)
+
+
+def cacheable_result(doc):
+    if doc.get("drop") in TRANSIENT_DROPS:
+        return None
+
+    return {k: v for k, v in doc.items() if k != "timings"}
+
+
+def read_records(archive_records, stats):
+    for index, offset, record in archive_records:
+        stats.count("records")
+
+        # Skip the records which are not needed (and oversized ones) without reading their payload
+        reason, url = triage_record(record, max_size=options.max_record_size)
+        if reason is not None:
+            logging.info("Skipping record " + str(url) + ": " + reason)
+            stats.drop(reason)
+            continue
+
+        doc = {
+            "url": url,
+            "content_type": record.http_headers.get_header('Content-Type') if record.http_headers else None,
+            "date": record.rec_headers.get_header('WARC-Date'),
+            "recordId": record.rec_headers.get_header('WARC-Record-ID'),
+            "index": index,
+            "offset": offset,
+            "cache_key": record_cache_key(record) if digest_cache is not None else None,
+        }
+
+        cached = digest_cache.get(doc["cache_key"]) if doc["cache_key"] else None
+        if cached is not None:
+            yield from cached_records(doc, cached)
+            continue
+
+        with stats.time("read"):
+            doc["payload"] = record.content_stream().read()
+
+        stats.count("payload_bytes", len(doc["payload"]))
+
+        yield doc
+
+
+def read_htmlwarc_records(archive_records, stats):
+    # Records cleaned and converted by bitextor_warc2htmlwarc.py in this process (--htmlwarc): the HTML is passed
+    # already decoded, with the encoding of the original record, instead of being written to a WARC and parsed again
+    lookup = lookup_cache if digest_cache is not None else None
+
+    for doc in warc2htmlwarc.read_records(archive_records, stats, lookup=lookup):
+        if doc["pdfpass"] is not None:
+            # Written by the main process, in order with the rest of the output
+            yield doc
+            continue
+
+        if doc["cached"] is not None:
+            record = {k: doc[k] for k in ("url", "date", "recordId", "index", "offset")}
+            yield from cached_records(dict(record, content_type="text/html"), doc["cached"])
+            continue
+
+        # Same Content-Type bitextor_warc2htmlwarc.py would have written in the HTTP headers
+        content_type = "text/html" if doc["http_headers"] or doc["format"] is not None else None
+        cache_key = digest_cache.key(doc["digest"], doc["http_content_type"], doc["format"]) \
+            if digest_cache is not None else None
+
+        for orig_encoding, clean_tree in warc2htmlwarc.process_payloads(doc, stats):
+            yield {
+                "url": doc["url"],
+                "content_type": content_type,
+                "payload": clean_tree,
+                "encoding": orig_encoding,
+                "date": doc["date"],
+                "recordId": doc["recordId"],
+                "index": doc["index"],
+                "offset": doc["offset"],
+                "cache_key": cache_key,
+            }
+
+
+def process_document(url, payload, content_type=None, seen_html=None, encoding=None):
+    """
+    Decode, identify the language of and extract the text from a single document, within the CPU time budget
+    of a record (if set).
+
+    Returns a dict with the processed document and the time spent in every stage. If the document has to be
+    discarded, the dict only contains the reason ('drop') and the timings. Deduplication against the documents
+    which have already been written is left to the caller, but if `seen_html` is provided, duplicated HTML is
+    discarded before extracting the text. If `encoding` is provided, the payload has already been decoded (str) from
+    that encoding.
+    """
+    if options.max_record_size > 0:
+        size = len(payload) if encoding is None else len(payload.encode())
+
+        if size > options.max_record_size:
+            logging.info("Skipping document " + url + ": payload of " + str(size) + " bytes over limit")
+            return {"drop": "size", "timings": {}}
+
+    doc = None
+
+    try:
+        with CPUBudget(options.max_record_seconds) as budget:
+            doc = process_document_content(url, payload, content_type, seen_html, encoding)
+    except RecordBudgetExceeded:
+        pass
+
+    # The budget might have been exceeded inside a parser which caught the exception
+    if budget.expired:
+        logging.warning("Skipping document " + url + ": over the CPU time budget of the record")
+        return {"drop": "time_budget", "timings": doc["timings"] if doc else {}}
+
+    return doc
+
+
+def process_document_content(url, payload, content_type=None, seen_html=None, encoding=None):
+    plaintext = ""
+    timings = {}
+
+    def dropped(reason):
+        return {"drop": reason, "timings": timings}
 
     # We convert into UTF8 first of all
-    orig_encoding, text = convert_encoding(payload)
+    if encoding is not None:
+        encoding_source, orig_encoding, text = "htmlwarc", encoding, payload
+    else:
+        with timed(timings, "encoding"):
+            encoding_source, orig_encoding, text = resolve_encoding(payload, content_type)
 
     # Fix HTML issues with html5lib if activated through parameters
     if options.html5lib or options.parser == "lxml":
-        document = html5lib.parse(remove_control_characters(bytes(text, 'utf8')),
-                                  treebuilder="lxml", namespaceHTMLElements=False)
-        text = etree.tostring(document, encoding="utf8").decode('utf8')
+        with timed(timings, "html5lib"):
+            document = html5lib.parse(remove_control_characters(bytes(text, 'utf8')),
+                                      treebuilder="lxml", namespaceHTMLElements=False)
+            text = etree.tostring(document, encoding="utf8").decode('utf8')
 
     logging.info("Processing document: " + url)
     if orig_encoding is None:
         logging.info("Encoding of document " + url + " could not be identified")
-        continue
-
-    date = record.rec_headers.get_header('WARC-Date')
-    recordId = record.rec_headers.get_header('WARC-Record-ID')
+        return dropped("unknown_encoding")
 
     if len(text.strip()) == 0:
-        continue
+        return dropped("empty_html")
 
     # lang id
     logging.info(url + ": detecting language")
     lang = ""
 
     if options.langid == "cld2":
-        lang = guess_lang_from_data2(text)
+        with timed(timings, "langid"):
+            lang = guess_lang_from_data2(text)
         if (len(languages) > 0 and lang not in languages) or (lang in banned):
             logging.info("Language of document " + url + ": " + lang + ". Not among searched languages.")
-            continue
+            return dropped("language")
         if lang == "un":
             logging.info("Language of document " + url + " could not be identified")
-            continue
-        open_output_files(options, lang, files_dict)
+            return dropped("unknown_language")
 
     # If enabled, remove boilerplate HTML
     if options.boilerpipe:
         logging.info(url + ": deboiling html")
-        extractor = ExtrB(extractor='ArticleExtractor', html=text)
-        deboiled = str(extractor.getHTML())
+        with timed(timings, "boilerpipe"):
+            extractor = ExtrB(extractor='ArticleExtractor', html=text)
+            deboiled = str(extractor.getHTML())
     else:
         deboiled = text
 
     # We compute a hash on the HTML (either normalized one or after boilerpipe if enabled):
     # if we get duplicate files we discard them
-    html_hash = mmh3.hash(deboiled, signed=False)
+    with timed(timings, "hash"):
+        html_hash = mmh3.hash(deboiled, signed=False)
     # checking for duplicate content (duplicates are discarded)
-    if html_hash in seen_html:
+    if seen_html is not None and html_hash in seen_html:
         logging.info("Repeated file:\t" + url)
-        continue
-
-    # get text with beautifulsoup
-    if options.parser == "bs4":
-        logging.info(url + ": Getting text with BeautifulSoup")
-        try:
-            soup = BeautifulSoup(deboiled, "lxml")
-        except Exception as ex:
-            logging.info("Exception ocurred when processing " + url + " with BeautifulSoup")
-            continue
-
-        for script in soup(["script", "style", "img"]):
-            script.extract()  # rip it out
-        plaintext = soup.get_text()
+        return dropped("duplicate_html")
 
-    # or get text with 'modest' library
-    elif options.parser == "modest":
-        logging.info(url + ": Getting text with modest (selectolax)")
+    with timed(timings, "extraction"):
         try:
-            tree = HTMLParser(deboiled)
-        except BaseException:
-            logging.info("Tree structure issues in HTML/XML. Ignoring this document")
-            continue
-        for tag in tree.css('script'):
-            tag.decompose()
-        for tag in tree.css('style'):
-            tag.decompose()
-        for tag in tree.css('img'):
-            tag.decompose()
-        if tree.body is None:
-            logging.info("Body is empty. Ignoring this document")
-            continue
-        # TODO should separator='\n' be removed? It splits inline elements inside block elements...
-        plaintext = tree.body.text(separator='\n')
-
-    # or get text by moving through the lxml tree
-    elif options.parser == "lxml":
-        logging.info(url + ": Getting text with lxml")
-
-        plaintext = lxml.html.document_fromstring(deboiled).text_content()
-    # or use an HTML tokenizer
-    else:
-        logging.info(url + ": Getting text with HTML tokenizer")
-        parser = SimpleParser()
-        try:
-            parser.feed(text)
-            plaintext = parser.get_text()
-        except BaseException:
-            logging.info("Tree structure issues in HTML/XML. Ignoring this document")
-            continue
-    plaintext = re.sub(r"\n+", "\n",
-                       re.sub(r" *\n *", "\n",
-                              re.sub(r"[ \t\v\f]+", " ",
-                                     re.sub(r"\r", "",
-                                            plaintext.replace(u'\xa0', u' '))))).strip()
+            parser_used, plaintext, links, images = extract_text(url, text, deboiled)
+        except ExtractionError as ex:
+            logging.info(str(ex))
+            return dropped(ex.reason)
     if options.langid == "cld3":
         if plaintext:
-            lang = guess_lang_from_data3(cld3model, plaintext)
+            with timed(timings, "langid"):
+                lang = guess_lang_from_data3(cld3model, plaintext)
             if (len(languages) > 0 and lang not in languages) or (lang in banned):
                 logging.info("Language of document " + url + ": " + lang + ". Not among searched languages.")
-                continue
+                return dropped("language")
             if lang == "un":
                 logging.info("Language of document " + url + " could not be identified")
-                continue
-            open_output_files(options, lang, files_dict)
+                return dropped("unknown_language")
         else:
-            continue
+            return dropped("empty_text")
+
+    if len(plaintext) == 0:
+        return dropped("empty_text")
+
+    with timed(timings, "hash"):
+        plaintext_hash = mmh3.hash(plaintext, signed=False)
+        plaintext_simhash = None
+
+        if options.near_duplicates_distance >= 0:
+            plaintext_simhash = simhash(plaintext, options.near_duplicates_shingle_size)
+
+    if options.paragraph_identification:
+        # Add paragraph index
+        plaintext = [f"{element}\t{idx}" for idx, element in enumerate(plaintext.strip().split("\n"))]
+        plaintext = '\n'.join(plaintext)
+
+    # Guessing MIME of the file (checked on original content)
+    logging.info(url + ": Getting mime")
+    with timed(timings, "mime"):
+        mime_source, mime = resolve_mime(text, content_type)
+
+    return {
+        "lang": lang,
+        "orig_encoding": orig_encoding,
+        "text": text,
+        "deboiled": deboiled,
+        "html_hash": html_hash,
+        "plaintext": plaintext,
+        "plaintext_hash": plaintext_hash,
+        "plaintext_simhash": plaintext_simhash,
+        "mime": mime,
+        "encoding_source": encoding_source,
+        "mime_source": mime_source,
+        "parser": parser_used,
+        "links": links,
+        "images": images,
+        "timings": timings,
+    }
+
+
+def precomputed_result(record):
+    # Results which do not need to be processed by a worker
+    if record.get("pdfpass") is not None:
+        return {"pdfpass": True, "timings": {}}
+    if record.get("cached") is not None:
+        return dict(record["cached"], timings={})
+
+    return None
+
+
+def process_document_worker(record, seen_html=None):
+    return process_document(record["url"], record["payload"], record["content_type"], seen_html,
+                            record.get("encoding"))
+
+
+def write_document(record, doc, files_dict, plainTextHashFile):
+    url = record["url"]
+    lang = doc["lang"]
+    plaintext = doc["plaintext"]
+    mime = doc["mime"]
+
+    open_output_files(options, lang, files_dict)
+
+    if not options.xzlang:
+        files_dict[lang]["mimeFile"].write(mime.encode() + b"\n")
+        files_dict[lang]["urlFile"].write(url.encode() + b"\n")
+        files_dict[lang]["encodingFile"].write(doc["orig_encoding"].encode() + b"\n")
+
+        b64norm = base64.b64encode(doc["text"].encode())
+        files_dict[lang]["normHtmlFile"].write(b64norm + b"\n")
 
-    plaintext_hash = mmh3.hash(plaintext, signed=False)
+        if options.boilerpipe:
+            b64deboil = base64.b64encode(doc["deboiled"].encode())
+            files_dict[lang]["deboilFile"].write(b64deboil + b"\n")
 
-    if plaintext_hash in seen_plain_text or plaintext_hash in previous_crawl_hashes:
-        logging.info("Repeated plain text file:\t" + url)
-        continue
+        b64text = base64.b64encode(html.unescape(plaintext).encode())
+        files_dict[lang]["plainTextFile"].write(b64text + b"\n")
 
-    if len(plaintext) > 0:
+        if options.links_images:
+            b64links = base64.b64encode("\n".join(doc["links"]).encode())
+            files_dict[lang]["linksFile"].write(b64links + b"\n")
+            b64images = base64.b64encode("\n".join(doc["images"]).encode())
+            files_dict[lang]["imagesFile"].write(b64images + b"\n")
 
-        seen_html.add(html_hash)
-        seen_plain_text.add(plaintext_hash)
-        # Guessing MIME of the file (checked on original content)
-        logging.info(url + ": Getting mime")
+    # append to language specific file
+    else:
+        langfile = xzlang_files.get(lang)
+        header = "Content-Location: " + url + "\n"
+        header += "Content-Type: " + mime + "\n"
+        header += "Content-Language: " + lang + "\n"
+        header += "Content-Length: " + str(len(plaintext)) + "\n"
+        header += "Date: " + record["date"] + "\n"
+        header += "X-WARC-Record-ID: " + record["recordId"] + "\n"
+        header += "X-WARC-Filename: " + options.input + "\n"
+        langfile.write(header.encode())
+        langfile.write(b"\n")
+        langfile.write(plaintext.encode())
+        langfile.write(b"\n")
+
+    if options.outputHash and is_hash_store(options.outputHash):
+        plainTextHashFile.add(doc["plaintext_hash"])
+    elif options.outputHash:
+        plainTextHashFile.write(str(doc["plaintext_hash"]).encode() + b"\n")
+
+
+def process_records(records, workers):
+    # Documents are processed in parallel (if workers > 1), but written in the input order by this process, which
+    # is the only one which keeps the deduplication state, so the output does not depend on the number of workers
+    if workers <= 1:
+        for record in records:
+            result = precomputed_result(record)
+            yield record, result if result is not None else process_document_worker(record, seen_html=seen_html)
+        return
+
+    max_pending = workers * 4
+    pending = collections.deque()
+    # The CPU time budget cannot interrupt a worker stuck in a C extension, so if the result of a document takes
+    # much longer than its budget, the workers are replaced and the pending documents resubmitted
+    watchdog_timeout = options.max_record_seconds * 10 + 60 if options.max_record_seconds > 0 else None
+    pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(options,))
+
+    def next_result():
+        nonlocal pool, pending
+
+        record, result = pending.popleft()
+
+        if isinstance(result, dict):
+            return record, result
 
-        if options.paragraph_identification:
-            # Add paragraph index
-            plaintext = [f"{element}\t{idx}" for idx, element in enumerate(plaintext.strip().split("\n"))]
-            plaintext = '\n'.join(plaintext)
+        try:
+            return record, result.get(timeout=watchdog_timeout)
+        except multiprocessing.TimeoutError:
+            logging.warning("Skipping document " + record["url"] + ": worker did not answer in "
+                            + str(watchdog_timeout) + " seconds, restarting the workers")
+
+            pool.terminate()
+            pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(options,))
+            pending = collections.deque(
+                (r, res if isinstance(res, dict) or res.ready() else pool.apply_async(process_document_worker, (r,)))
+                for r, res in pending)
+
+            return record, {"drop": "watchdog", "timings": {}}
+
+    try:
+        for record in records:
+            result = precomputed_result(record)
+            if result is None:
+                result = pool.apply_async(process_document_worker, (record,))
+            pending.append((record, result))
+
+            if len(pending) >= max_pending:
+                yield next_result()
+
+        while pending:
+            yield next_result()
+    finally:
+        pool.terminate()
+
+
+def main():
+    global options, seen_html, seen_plain_text, compression_executor, xzlang_files, checkpoint, output_sizes, \
+        output_files, digest_cache
+
+    oparser = argparse.ArgumentParser(
+        description="Script that takes every record in a WARC file and runs preprocessing, which includes: HTML"
+                    "normalization, deduplication, MIME and language identification, and boilerplate removing. The "
+                    "result of each pre-processing step is stored in a XZ compressed file in the output directory.")
+    oparser.add_argument("--verbose", action="store_true", default=False,
+                         help="Produce additional information about preprocessing through stderr.")
+    oparser.add_argument("--boilerpipe", action="store_true", default=False,
+                         help="Use boilerpipe bodytext to do the de-boiling")
+    oparser.add_argument("--boilerpipe-max-heap-size", type=int, default=-1,
+                         help="Max. heap size for providing to jpype if the JVM is not up. If the value is negative, "
+                              "the default max. heap size will be used instead")
+    oparser.add_argument("--parser", dest="parser", default="bs4",
+                         choices={'bs4', 'modest', 'lxml', 'simple', 'auto'},
+                         help="Use 'HTML tokenizer', 'modest', 'bs4' or 'lxml' (using html5lib tree) parser to extract "
+                              "relevant text from HTML. 'auto' uses 'modest' and falls back to 'bs4' for the "
+                              "documents which 'modest' cannot process. By default 'bs4' is used")
+    oparser.add_argument("--html5lib", action="store_true", default=False, help="Process HTML tree with html5lib")
+    oparser.add_argument('--output-dir', dest='outDir', help='Output directory', required=True)
+    oparser.add_argument('--output_hash', dest='outputHash',
+                         help='Output path for Murmur Hash of plain texts. If the path ends with \'.npy\', a sorted '
+                              'hash store which can be memory-mapped is written instead of a hash per line')
+    oparser.add_argument('--input_hash', dest='inputHash',
+                         help='Input path for previous Bitextor Murmur Hash plain texts file (or hash store, see '
+                              'bitextor/utils/hashstore.py in order to merge several of them)')
+    oparser.add_argument('--input_hash_bloom', dest='inputHashBloom', action='store_true',
+                         help='Check a Bloom filter before looking up the previous Bitextor Murmur Hashes')
+    oparser.add_argument('--near-duplicates-distance', type=int, default=-1,
+                         help='Discard documents whose plain text SimHash differs in this number of bits or less from '
+                              'the SimHash of a previous document. If the value is negative, near-duplicates are '
+                              'not detected. The SimHashes are indexed in distance + 1 bands, which take up to 16 '
+                              'bytes in memory per document and band (40 bytes per document with a distance of 3)')
+    oparser.add_argument('--near-duplicates-shingle-size', type=int, default=4,
+                         help='Number of words of the shingles used to compute the SimHash of the plain texts')
+    oparser.add_argument('--output_simhash', dest='outputSimhash',
+                         help='Output path for SimHash of plain texts (same format as --output_hash)')
+    oparser.add_argument('--input_simhash', dest='inputSimhash',
+                         help='Input path for previous Bitextor SimHash plain texts file')
+    oparser.add_argument('--lang1', dest='l1', help='Language l1 in the crawl', default=None)
+    oparser.add_argument('--lang2', dest='l2', help='Language l2 in the crawl', default=None)
+    oparser.add_argument('--input', dest='input', help='Input WARC file', default=sys.stdin)
+    oparser.add_argument('--xzlang', action="store_true", help='Separate output into different files by language',
+                         default=False)
+    oparser.add_argument('--langs', dest="langs", default="",
+                         help='List of languages to include or ignore (%%): l1,l2,%%l3,%%l4')
+    oparser.add_argument('--langid', dest="langid", default="cld2",
+                         help="Model used for language detection: cld2 or cld3")
+    oparser.add_argument('--compression', dest='compression', default='gz', choices={'xz', 'gz'},
+                         help='Compression type for the output files')
+    oparser.add_argument('--compression-threads', type=int, default=2,
+                         help='Number of threads which compress the output files in the background. If the value '
+                              'is 0, the output files are compressed while the records are processed')
+    oparser.add_argument('--max-open-files', type=int, default=64,
+                         help='Maximum number of language files which are kept open with --xzlang')
+    oparser.add_argument('--paragraph-identification', action='store_true',
+                         help='Add paragraph index in each b64encoded document sentence as tab separated column')
+    oparser.add_argument('--links-images', action='store_true',
+                         help='Write the links (href) and images (img src) of every document, taken from the parsed '
+                              'HTML, to links and images files (b64encoded, one per line), so the document alignment '
+                              'features do not need to parse the HTML again')
+    oparser.add_argument('--stats-json', dest='stats_json',
+                         help='Path of a JSON file where the time spent in every stage, the number of processed records '
+                              'and the reasons why documents were discarded are periodically written')
+    oparser.add_argument('--max-record-seconds', type=float, default=0,
+                         help='CPU time budget for the processing of a single record: records which exceed it are '
+                              'skipped. If the value is 0, records are not limited')
+    oparser.add_argument('--max-record-size', type=int, default=0,
+                         help='Records with a payload larger than this number of bytes are skipped. If the value is 0, '
+                              'records are not limited')
+    oparser.add_argument('--checkpoint',
+                         help='Path of a checkpoint which is periodically written with the last processed record, the '
+                              'size of the output files and the deduplication state, so an interrupted run can be '
+                              'resumed with --resume. Not supported with --xzlang')
+    oparser.add_argument('--checkpoint-interval', type=int, default=300, help='Seconds between checkpoints')
+    oparser.add_argument('--resume', action='store_true',
+                         help='Resume from the checkpoint, if it exists: the records which were processed are skipped '
+                              'and the output files are truncated to their size in the checkpoint')
+    oparser.add_argument('--workers', type=int, default=1,
+                         help='Number of processes which decode, identify the language and extract the text of the '
+                              'documents. The output is the same regardless of the number of workers')
+    oparser.add_argument('--digest-cache',
+                         help='SQLite database where the results of the records are stored by WARC-Payload-Digest '
+                              '(and processing options), so the records of later crawls with the same payload are '
+                              'not processed again. It can be shared by several runs')
+    oparser.add_argument('--htmlwarc', action='store_true',
+                         help='Read the original WARC and run bitextor_warc2htmlwarc.py in this process (with the '
+                              'options below), instead of reading its output. The HTML is passed already decoded, so '
+                              'it is not written to a WARC, parsed and decoded again')
+    warc2htmlwarc.add_processing_arguments(
+        oparser.add_argument_group("bitextor_warc2htmlwarc.py options (with --htmlwarc)"))
+    opts = oparser.parse_args()
+
+    if opts.checkpoint and opts.xzlang:
+        oparser.error("--checkpoint is not supported with --xzlang")
+    if opts.resume and not opts.checkpoint:
+        oparser.error("--resume requires --checkpoint")
+
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=logging.INFO if opts.verbose else logging.ERROR,
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+    checkpoint = None
+    resume_state, resume_arrays = None, {}
+    if opts.checkpoint:
+        checkpoint = Checkpoint(opts.checkpoint, opts.checkpoint_interval)
+
+        if opts.resume:
+            resume_state, resume_arrays = checkpoint.load()
+
+    # Remove the output written after the checkpoint
+    output_sizes = resume_state["outputs"] if resume_state else {}
+    output_files = dict()
+    truncate_outputs(output_sizes)
+
+    if opts.input == sys.stdin or opts.input == '-':
+        f = iterate_archive(sys.stdin.buffer, resume_state)
+    elif opts.input[-3:] == ".xz":
+        f = iterate_archive(lzma.open(opts.input, 'r'), resume_state)
+    else:
+        f = iterate_archive(open(opts.input, 'rb'), resume_state)
 
-        mime = magic.from_buffer(text, mime=True)
+    digest_cache = None
+    if opts.digest_cache:
+        digest_cache = DigestCache(opts.digest_cache, options_fingerprint(opts, DIGEST_CACHE_OPTIONS))
 
-        if not options.xzlang:
-            files_dict[lang]["mimeFile"].write(mime.encode() + b"\n")
-            files_dict[lang]["urlFile"].write(url.encode() + b"\n")
-            files_dict[lang]["encodingFile"].write(orig_encoding.encode() + b"\n")
+    pdfpass_writer = None
+    if opts.htmlwarc:
+        warc2htmlwarc.init_processing(opts)
 
-            b64norm = base64.b64encode(text.encode())
-            files_dict[lang]["normHtmlFile"].write(b64norm + b"\n")
+        if opts.pdfpass is not None:
+            pdfpass_writer = WARCWriter(open(opts.pdfpass, 'ab' if resume_state else 'wb'),
+                                        gzip=not opts.disable_pdfs_gzip)
 
-            if options.boilerpipe:
-                b64deboil = base64.b64encode(deboiled.encode())
-                files_dict[lang]["deboilFile"].write(b64deboil + b"\n")
+    seen_html = SeenHashes()
+    seen_plain_text = SeenHashes()
+    if "seen_html" in resume_arrays:
+        seen_html.load(resume_arrays["seen_html"])
+        seen_plain_text.load(resume_arrays["seen_plain_text"])
 
-            b64text = base64.b64encode(html.unescape(plaintext).encode())
-            files_dict[lang]["plainTextFile"].write(b64text + b"\n")
+    if opts.workers > 1:
+        # The workers load their own models (and JVM, if boilerpipe is enabled)
+        options = opts
+    else:
+        init_worker(opts)
+
+    if not os.path.exists(options.outDir):
+        os.makedirs(options.outDir)
+
+    compression_executor = None
+    if options.compression_threads > 0:
+        compression_executor = concurrent.futures.ThreadPoolExecutor(max_workers=options.compression_threads)
+
+    # Language files are kept open instead of being opened for every document
+    xzlang_files = HandlePool(open_xzlang_output, options.max_open_files)
+
+    # Previous hashes are looked up in a sorted array instead of being loaded into a Python set
+    previous_crawl_hashes = HashStore(options.inputHash, bloom=options.inputHashBloom)
+
+    near_duplicates = None
+    if options.near_duplicates_distance >= 0:
+        near_duplicates = SimHashIndex(options.near_duplicates_distance)
+
+        if "simhashes" in resume_arrays:
+            # Already contains the signatures of --input_simhash
+            near_duplicates.update(resume_arrays["simhashes"])
+        elif options.inputSimhash:
+            near_duplicates.load(options.inputSimhash)
+
+    plainTextHashFile = None
+    if options.outputHash and is_hash_store(options.outputHash):
+        plainTextHashFile = SeenHashes()
+
+        if "output_hashes" in resume_arrays:
+            plainTextHashFile.load(resume_arrays["output_hashes"])
+    elif options.outputHash:
+        plainTextHashFile = open_output(options.outputHash)
+
+    files_dict = dict()
+    stats = PipelineStats(options.stats_json)
+
+    if resume_state:
+        stats.counters.update(resume_state["counters"])
+        stats.drops.update(resume_state["drops"])
+
+    def save_checkpoint(record):
+        arrays = {"seen_html": seen_html.to_array(), "seen_plain_text": seen_plain_text.to_array()}
+        if near_duplicates is not None:
+            arrays["simhashes"] = near_duplicates.to_array()
+        if isinstance(plainTextHashFile, SeenHashes):
+            arrays["output_hashes"] = plainTextHashFile.to_array()
+
+        # Files of a resumed run which have not been opened again keep the size of the previous checkpoint
+        outputs = dict(output_sizes)
+        outputs.update((path, fh.checkpoint()) for path, fh in output_files.items())
+        if pdfpass_writer is not None:
+            # Every record is written as a separate gzip member
+            pdfpass_writer.out.flush()
+            outputs[options.pdfpass] = pdfpass_writer.out.tell()
+
+        checkpoint.save({
+            "input_record": record["index"],
+            "input_offset": record["offset"],
+            "outputs": outputs,
+            "counters": dict(stats.counters),
+            "drops": dict(stats.drops),
+        }, arrays)
+
+    last_record = None
+    records = read_htmlwarc_records(f, stats) if options.htmlwarc else read_records(f, stats)
+
+    for record, doc in process_records(records, options.workers):
+        # Every record before this one has been completely processed (a converted document might have several
+        # payloads, which share the index of the record)
+        if checkpoint is not None and last_record is not None and last_record["index"] != record["index"] \
+                and checkpoint.due():
+            with stats.time("checkpoint"):
+                save_checkpoint(last_record)
+        last_record = record
+
+        stats.add_timings(doc["timings"])
+        stats.maybe_flush()
+
+        if record.get("cached") is not None:
+            stats.count("digest_cache_hits")
+        elif digest_cache is not None and "pdfpass" not in doc:
+            digest_cache.add(record["cache_key"], record["index"], cacheable_result(doc))
+
+        if "pdfpass" in doc:
+            warc2htmlwarc.write_pdfpass(pdfpass_writer, record, stats)
+            continue
 
-        # append to language specific file
-        else:
-            langfile = lzma.open(options.outDir + "/" + lang, mode="a", format=lzma.FORMAT_XZ)
-            header = "Content-Location: " + url + "\n"
-            header += "Content-Type: " + mime + "\n"
-            header += "Content-Language: " + lang + "\n"
-            header += "Content-Length: " + str(len(plaintext)) + "\n"
-            header += "Date: " + date + "\n"
-            header += "X-WARC-Record-ID: " + recordId + "\n"
-            header += "X-WARC-Filename: " + options.input + "\n"
-            langfile.write(header.encode())
-            langfile.write(b"\n")
-            langfile.write(plaintext.encode())
-            langfile.write(b"\n")
-            langfile.close()
-
-        if options.outputHash:
-            plainTextHashFile.write(str(plaintext_hash).encode() + b"\n")
-
-if not options.xzlang:
-    for lang in files_dict:
-        files_dict[lang]["urlFile"].close()
-        files_dict[lang]["encodingFile"].close()
-        files_dict[lang]["mimeFile"].close()
-        files_dict[lang]["normHtmlFile"].close()
-        files_dict[lang]["plainTextFile"].close()
-        if options.boilerpipe:
-            files_dict[lang]["deboilFile"].close()
-if options.outputHash:
-    plainTextHashFile.close()
+        if "drop" in doc:
+            stats.drop(doc["drop"])
+            continue
+
+        url = record["url"]
+
+        if doc["html_hash"] in seen_html:
+            logging.info("Repeated file:\t" + url)
+            stats.drop("duplicate_html")
+            continue
+
+        if doc["plaintext_hash"] in seen_plain_text:
+            logging.info("Repeated plain text file:\t" + url)
+            stats.drop("duplicate_text")
+            continue
+
+        if doc["plaintext_hash"] in previous_crawl_hashes:
+            logging.info("Repeated plain text file:\t" + url)
+            stats.drop("previous_crawl_text")
+            continue
+
+        if near_duplicates is not None:
+            if doc["plaintext_simhash"] in near_duplicates:
+                logging.info("Near-duplicate plain text file:\t" + url)
+                stats.drop("near_duplicate_text")
+                continue
+
+            near_duplicates.add(doc["plaintext_simhash"])
+
+        seen_html.add(doc["html_hash"])
+        seen_plain_text.add(doc["plaintext_hash"])
+
+        with stats.time("write"):
+            write_document(record, doc, files_dict, plainTextHashFile)
+
+        # Counted for the written documents only, so they do not depend on the documents skipped before processing
+        #  them (e.g. duplicates in the serial mode)
+        stats.count("documents")
+        stats.count("plain_text_bytes", len(doc["plaintext"].encode()))
+        stats.count("encoding_source_" + doc["encoding_source"])
+        stats.count("parser_" + doc["parser"])
+        stats.count("mime_source_" + doc["mime_source"])
+
+    if not options.xzlang:
+        for lang in files_dict:
+            files_dict[lang]["urlFile"].close()
+            files_dict[lang]["encodingFile"].close()
+            files_dict[lang]["mimeFile"].close()
+            files_dict[lang]["normHtmlFile"].close()
+            files_dict[lang]["plainTextFile"].close()
+            if options.boilerpipe:
+                files_dict[lang]["deboilFile"].close()
+            if options.links_images:
+                files_dict[lang]["linksFile"].close()
+                files_dict[lang]["imagesFile"].close()
+    else:
+        xzlang_files.close()
+    if options.htmlwarc:
+        warc2htmlwarc.finish_processing()
+    if pdfpass_writer is not None:
+        pdfpass_writer.out.close()
+    if digest_cache is not None:
+        digest_cache.close()
+    if near_duplicates is not None and options.outputSimhash:
+        near_duplicates.save(options.outputSimhash)
+    if options.outputHash and is_hash_store(options.outputHash):
+        write_hashes(options.outputHash, plainTextHashFile.to_array())
+    elif options.outputHash:
+        plainTextHashFile.close()
+    if compression_executor is not None:
+        compression_executor.shutdown()
+    if checkpoint is not None:
+        checkpoint.remove()
+
+    stats.flush()
+    logging.info("Preprocessing stats: %s", stats.to_dict())
+
+
+if __name__ == "__main__":
+    main()
@@ -17,81 +17,253 @@
 #  along with Bitextor.  If not, see <https://www.gnu.org/licenses/>.
 
 #
-# 1. Read every line from .lett file
-# 2. For each of them, clean the text and split it in words
-# 3. Lowercase and create a bag of words
+# 1. Read every line from the tokenised documents
+# 2. For each of them, split it in words and trim the punctuation
+# 3. Create a bag of words, assigning an integer ID to every new word
 # 4. Creating a list with the words corresponding to every language and a list of the documents in which these
 # words appear
 #
-# Output format:
+# Output format: binary inverted index (see bitextor/utils/invertedindex.py), or with --tsv:
 # language      word    num_doc[:inc(num_doc)]*
 #
 # Generates .idx -> index
 #
 
+import sys
 import base64
 import argparse
+import collections
+import multiprocessing
+from array import array
+
+import numpy as np
 
 from bitextor.utils.unicodepunct import get_unicode_punct
 from bitextor.utils.common import open_xz_or_gzip_or_plain
+from bitextor.utils.invertedindex import LanguageIndex, write_index, write_tsv
 
-
-oparser = argparse.ArgumentParser(
-    description="Script that reads the tokenised documents and produces an index with all the words "
-                "in these files and the list of documents in which each of them appear")
-oparser.add_argument('--text1', dest='text1',
-                     help='File produced by bitextor-tokenize containing the tokenized text of all the records'
-                     'in the WARC file encoded as base 64 (each line corresponds to a single record) for SL Language', required=True)
-oparser.add_argument('--text2', dest='text2',
-                     help='File produced by bitextor-tokenize containing the tokenized text of all the records'
-                     'in the WARC file encoded as base 64 (each line corresponds to a single record) for TL Language', required=True)
-oparser.add_argument("-m", "--max-occ",
-                     help="Maximum number of occurrences of a word in one language to be kept in the index", type=int,
-                     dest="maxo", default=-1)
-oparser.add_argument("--lang1", help="Two-characters-code for language 1 in the pair of languages", dest="lang1",
-                     required=True)
-oparser.add_argument("--lang2", help="Two-characters-code for language 2 in the pair of languages", dest="lang2",
-                     required=True)
-
-options = oparser.parse_args()
-
-word_map = {}
 punctuation = get_unicode_punct()
 
-for file_path, lang in [(options.text1, options.lang1), (options.text2, options.lang2)]:
-    if lang not in word_map:
-        word_map[lang] = {}
+
+def document_words(line):
+    # Decode the text (current document)
+    tokenized_text = base64.b64decode(line.strip()).decode("utf-8")
+
+    # Get unique words from the current document
+    sorted_uniq_wordlist = sorted(set(tokenized_text.split()))
+
+    # Trimming non-aplphanumerics
+    return [_f for _f in [w.strip(punctuation) for w in sorted_uniq_wordlist] if _f]
+
+
+def read_documents(file_path, vocabulary, word_ids, doc_ids):
+    """
+    Add the (word ID, document index) pairs of the words of every document to word_ids and doc_ids, and return the
+    number of documents
+    """
+    num_docs = 0
 
     with open_xz_or_gzip_or_plain(file_path) as text_reader:
         # Process documents
         for doc_idx, line in enumerate(text_reader, 1):
-            # Decode the text (current document)
-            tokenized_text = base64.b64decode(line.strip()).decode("utf-8")
+            # Process every unique word from the current document
+            for word in document_words(line):
+                word_ids.append(vocabulary.setdefault(word, len(vocabulary)))
+                doc_ids.append(doc_idx)
 
-            # Get unique words from the current document
-            sorted_uniq_wordlist = sorted(set(tokenized_text.split()))
+            num_docs = doc_idx
 
-            # Trimming non-aplphanumerics
-            sorted_uniq_wordlist = [_f for _f in [w.strip(punctuation) for w in sorted_uniq_wordlist] if _f]
+    return num_docs
 
-            # Process every unique word from the current document
-            for word in sorted_uniq_wordlist:
-                if word not in word_map[lang]:
-                    word_map[lang][word] = []
 
-                word_map[lang][word].append(doc_idx)
+def build_index(inputs, max_occ=-1):
+    """
+    Build the LanguageIndex of every language from a list of (tokenised documents file, language)
+    """
+    word_map = {}
+    num_docs = {}
+
+    for file_path, lang in inputs:
+        if lang not in word_map:
+            word_map[lang] = ({}, array('I'), array('I'))
+
+        vocabulary, word_ids, doc_ids = word_map[lang]
+        num_docs[lang] = max(num_docs.get(lang, 0), read_documents(file_path, vocabulary, word_ids, doc_ids))
+
+    # If there are many occurrences, the word might be a stop word
+    return [LanguageIndex.from_pairs(lang, list(vocabulary), word_ids, doc_ids, num_docs[lang], max_occ)
+            for lang, (vocabulary, word_ids, doc_ids) in word_map.items()]
+
+
+def index_chunk(chunk):
+    """
+    Partial index of a chunk of documents: its words (in the order in which they were first seen in the chunk) and
+    the (word position, document index) pairs of the words of every document
+    """
+    vocabulary = {}
+    word_ids = array('I')
+    doc_ids = array('I')
+
+    for doc_idx, line in chunk:
+        for word in document_words(line):
+            word_ids.append(vocabulary.setdefault(word, len(vocabulary)))
+            doc_ids.append(doc_idx)
+
+    return list(vocabulary), np.frombuffer(word_ids, dtype=np.uint32), np.frombuffer(doc_ids, dtype=np.uint32)
+
+
+class IndexMerger(object):
+    """
+    Merge the partial indices of the chunks of documents of a language as they arrive (in input order), so the
+    words get the IDs they would get in build_index(). Once a word appears in more than max_occ documents, its
+    postings are discarded, so only the postings of the words which might be kept are held in memory
+    """
+
+    # Minimum number of postings before the postings of the discarded words are removed
+    MIN_COMPACT_SIZE = 1000000
+
+    def __init__(self, lang, max_occ=-1):
+        self.lang = lang
+        self.max_occ = max_occ
+        self.vocabulary = {}
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.word_ids = array('I')
+        self.doc_ids = array('I')
+        self.num_docs = 0
+        self.compacted_size = 0
+
+    def add(self, partial, num_docs):
+        words, word_ids, doc_ids = partial
+        chunk_word_ids = np.array([self.vocabulary.setdefault(word, len(self.vocabulary)) for word in words],
+                                  dtype=np.uint32)
+        word_ids = chunk_word_ids[word_ids]
+
+        counts = np.bincount(word_ids, minlength=len(self.vocabulary))
+        counts[:len(self.counts)] += self.counts
+        self.counts = counts
+        self.num_docs = max(self.num_docs, num_docs)
+
+        if self.max_occ != -1:
+            # If there are many occurrences, the word might be a stop word
+            kept = self.counts[word_ids] <= self.max_occ
+            word_ids = word_ids[kept]
+            doc_ids = doc_ids[kept]
+
+        self.word_ids.frombytes(word_ids.tobytes())
+        self.doc_ids.frombytes(doc_ids.tobytes())
+
+        # The postings of the words which were kept in previous chunks are removed once in a while
+        if self.max_occ != -1 and len(self.word_ids) > max(2 * self.compacted_size, self.MIN_COMPACT_SIZE):
+            self.compact()
+
+    def compact(self):
+        word_ids = np.frombuffer(self.word_ids, dtype=np.uint32)
+        kept = self.counts[word_ids] <= self.max_occ
+        compacted_word_ids = array('I')
+        compacted_word_ids.frombytes(word_ids[kept].tobytes())
+        compacted_doc_ids = array('I')
+        compacted_doc_ids.frombytes(np.frombuffer(self.doc_ids, dtype=np.uint32)[kept].tobytes())
+
+        self.word_ids, self.doc_ids = compacted_word_ids, compacted_doc_ids
+        self.compacted_size = len(self.word_ids)
+
+    def index(self):
+        if self.max_occ != -1:
+            self.compact()
+
+        return LanguageIndex.from_pairs(self.lang, list(self.vocabulary), self.word_ids, self.doc_ids, self.num_docs,
+                                        self.max_occ)
+
+
+def read_chunks(reader, chunk_size):
+    chunk = []
+
+    for doc_idx, doc in enumerate(reader, 1):
+        chunk.append((doc_idx, doc))
+
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def build_index_parallel(inputs, workers, chunk_size, max_occ=-1):
+    """
+    Same as build_index(), but the chunks of documents are indexed by several processes, and their partial
+    indices are merged as they arrive
+    """
+    mergers = {}
+    max_pending = workers * 4
+    pending = collections.deque()
+
+    def next_partial():
+        lang, num_docs, partial = pending.popleft()
+        mergers[lang].add(partial.get(), num_docs)
+
+    with multiprocessing.Pool(workers) as pool:
+        for file_path, lang in inputs:
+            if lang not in mergers:
+                mergers[lang] = IndexMerger(lang, max_occ)
+
+            with open_xz_or_gzip_or_plain(file_path) as text_reader:
+                for chunk in read_chunks(text_reader, chunk_size):
+                    pending.append((lang, chunk[-1][0], pool.apply_async(index_chunk, (chunk,))))
+
+                    if len(pending) >= max_pending:
+                        next_partial()
+
+        while pending:
+            next_partial()
+
+    return [merger.index() for merger in mergers.values()]
+
+
+def main():
+    oparser = argparse.ArgumentParser(
+        description="Script that reads the tokenised documents and produces an index with all the words "
+                    "in these files and the list of documents in which each of them appear")
+    oparser.add_argument('--text1', dest='text1',
+                         help='File produced by bitextor-tokenize containing the tokenized text of all the records'
+                         'in the WARC file encoded as base 64 (each line corresponds to a single record) for SL Language', required=True)
+    oparser.add_argument('--text2', dest='text2',
+                         help='File produced by bitextor-tokenize containing the tokenized text of all the records'
+                         'in the WARC file encoded as base 64 (each line corresponds to a single record) for TL Language', required=True)
+    oparser.add_argument("-m", "--max-occ",
+                         help="Maximum number of occurrences of a word in one language to be kept in the index", type=int,
+                         dest="maxo", default=-1)
+    oparser.add_argument("--lang1", help="Two-characters-code for language 1 in the pair of languages", dest="lang1",
+                         required=True)
+    oparser.add_argument("--lang2", help="Two-characters-code for language 2 in the pair of languages", dest="lang2",
+                         required=True)
+    oparser.add_argument("-o", "--output", dest="output",
+                         help="Binary index file (memory-mappable by bitextor_idx2ridx.py). Required unless --tsv")
+    oparser.add_argument("--tsv", action="store_true",
+                         help="Write the index to the standard output in text format (lang, word and the document "
+                              "indices joined by ':') instead")
+    oparser.add_argument("--workers", type=int, default=1,
+                         help="Number of processes which index chunks of documents, whose partial indices are merged")
+    oparser.add_argument("--chunk-size", type=int, default=1000,
+                         help="Number of documents indexed by a worker at once (with --workers)")
+
+    options = oparser.parse_args()
+
+    if not options.tsv and not options.output:
+        oparser.error("either --output or --tsv is required")
 
-            doc_idx += 1
+    inputs = [(options.text1, options.lang1), (options.text2, options.lang2)]
 
-# Print output header
-print("lang\tword\tdoc_idxs")
+    if options.workers > 1:
+        indices = build_index_parallel(inputs, options.workers, options.chunk_size, options.maxo)
+    else:
+        indices = build_index(inputs, options.maxo)
 
-for map_lang, map_vocabulary in list(word_map.items()):
-    for map_word, map_doc in list(map_vocabulary.items()):
-        doc_idxs = word_map[map_lang][map_word]
+    if options.output:
+        write_index(options.output, indices)
+    if options.tsv:
+        write_tsv(indices, sys.stdout)
 
-        if options.maxo == -1 or len(doc_idxs) <= options.maxo: # If there are many occurrences, the word might be a stop word
-            sorted_docs = map(lambda d: str(d), sorted(doc_idxs))
 
-            print(map_lang + "\t" + map_word + "\t" + ":".join(sorted_docs))
-        # else: -> detected as stop word and we want to avoid them
+if __name__ == "__main__":
+    main()
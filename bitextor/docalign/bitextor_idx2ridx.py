@@ -16,8 +16,8 @@
 #  along with Bitextor.  If not, see <https://www.gnu.org/licenses/>.
 
 #
-# 1. Output from bitextor-lett2idx is read and an IDX file is obtained with an index of all the words in both
-# languages and the list of documents where they occur
+# 1. Output from bitextor-buildidx (binary index, or its text export) is read and an index of all the words in both
+# languages and the list of documents where they occur is obtained
 # 2. Words in both sides are translated by using the bilingual lexicon
 # 3. Similarity metric based on bag-of-word-overlapping is computed
 # 4. n-best documents are obtained for each document in the website
@@ -29,8 +29,11 @@
 import sys
 import argparse
 from collections import defaultdict
-from operator import itemgetter
-import re
+
+import numpy as np
+
+from bitextor.utils.hostindex import HostIndex
+from bitextor.utils.invertedindex import is_binary_index, read_index
 
 
 def read_lett(f, docs):
@@ -68,13 +71,27 @@ def fill_index(file, lang1, lang2, index1, index2):
 
                 for j in documents:
                     if lang == lang1:
-                        index1[j].add(word)
+                        index1[int(j)].add(word)
                     else:
-                        index2[j].add(word)
+                        index2[int(j)].add(word)
 
     file.close()
 
 
+#
+# Building word indexes from the binary index produced by bitextor-buildidx, which is memory-mapped
+#
+def fill_index_binary(path, lang1, lang2, index1, index2):
+    for lang, index in read_index(path).items():
+        if lang == lang1 or lang == lang2:
+            target_index = index1 if lang == lang1 else index2
+            vocabulary = index.vocabulary
+            word_ids, doc_ids = index.decode_postings()
+
+            for word_id, doc_idx in zip(word_ids.tolist(), doc_ids.tolist()):
+                target_index[doc_idx].add(vocabulary[word_id])
+
+
 #
 # Loading bilingual lexicon (.dic)
 #
@@ -118,23 +135,154 @@ def translate_words(index, dictionary, dictp, translatedindex):
 def feed_dict_with_identical_words(index1, index2, dictionary):
     words_lang1 = set()
     for words in index1.values():
-        words_lang1 = words_lang1.union(words)
+        words_lang1.update(words)
     words_lang2 = set()
     for words in index2.values():
-        words_lang2 = words_lang2.union(words)
+        words_lang2.update(words)
 
     for w in words_lang1.intersection(words_lang2):
         dictionary[w].append(w)
 
 
+#
+# Sparse representation of a list of sets of words: the IDs of the words of every set (row), concatenated, and the
+# offset of every row. Words which are not in the vocabulary are skipped
+#
+def build_rows(word_sets, vocabulary):
+    offsets = np.zeros(len(word_sets) + 1, dtype=np.int64)
+    values = []
+
+    for row, words in enumerate(word_sets):
+        values.extend(vocabulary[word] for word in words if word in vocabulary)
+        offsets[row + 1] = len(values)
+
+    return offsets, np.array(values, dtype=np.int64)
+
+
+#
+# Concatenation of the given rows of a sparse representation (or of the given posting lists)
+#
+def gather_rows(offsets, values, rows):
+    starts = offsets[rows]
+    lengths = offsets[rows + 1] - starts
+    positions = np.arange(lengths.sum(), dtype=np.int64) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+
+    return values[positions]
+
+
+#
+# Posting lists of the words of the given rows (in ascending order) of a sparse representation: the sorted IDs of
+# the words, the offset of the posting list of every word and the postings (the rows in which every word appears)
+#
+def build_postings(offsets, values, rows):
+    word_ids = gather_rows(offsets, values, rows)
+    posting_rows = np.repeat(rows, offsets[rows + 1] - offsets[rows])
+    words, local_word_ids = np.unique(word_ids, return_inverse=True)
+    word_offsets = np.zeros(len(words) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(local_word_ids, minlength=len(words)), out=word_offsets[1:])
+
+    return words, word_offsets, posting_rows[np.argsort(local_word_ids, kind="stable")]
+
+
+#
+# Positions of the k best scores (without sorting them), as a full sort would choose them: if several scores are
+# the same as the k-th best score, the first ones are chosen
+#
+def select_best(scores, k):
+    if k == 0:
+        return np.empty(0, dtype=np.int64)
+
+    kth_score = -np.partition(-scores, k - 1)[k - 1]
+    better = np.flatnonzero(scores > kth_score)
+    same = np.flatnonzero(scores == kth_score)[:k - len(better)]
+
+    return np.concatenate((better, same))
+
+
+#
+# Bag-of-words overlap score of every document in language 1 with the documents in language 2 which share at least
+# a translated word with it. Instead of intersecting the words of every pair of documents, the documents in
+# language 2 which contain each (translated) word of the document in language 1 are obtained from posting lists
+# and counted. If the LETT documents are provided, the documents are grouped by host, and the posting lists of
+# each host only contain its documents. Yields every document in language 1 with its best max_candidates candidates
+# (document in language 2 and score), sorted by score
+#
+def score_candidates(index1, index2, translated_index2, dict_words, max_candidates, lett_documents=None):
+    docs1 = list(index1)
+    docs2 = list(index2)
+
+    # Words in language 1 which are translations of the words of the documents in language 2
+    vocabulary = {}
+    for doc in docs2:
+        for word in translated_index2[doc]:
+            vocabulary.setdefault(word, len(vocabulary))
+
+    translated_offsets, translated_values = build_rows([translated_index2[doc] for doc in docs2], vocabulary)
+    offsets1, values1 = build_rows([index1[doc] for doc in docs1], vocabulary)
+
+    vocab_sizes2 = np.array([len(index2[doc]) for doc in docs2], dtype=np.float64)
+    trans_words2 = np.array([dict_words[doc] for doc in docs2], dtype=np.float64)
+
+    if lett_documents is None:
+        # A single bucket with every document
+        hosts1 = [None] * len(docs1)
+        buckets2 = {None: np.arange(len(docs2), dtype=np.int64)}
+    else:
+        host_index1 = HostIndex.from_urls((doc, lett_documents[doc]) for doc in docs1)
+        host_index2 = HostIndex.from_urls((doc, lett_documents[doc]) for doc in docs2)
+        rows2 = {doc: row2 for row2, doc in enumerate(docs2)}
+        hosts1 = [host_index1.host(doc) for doc in docs1]
+        buckets2 = {host: np.array([rows2[doc] for doc in host_index2.docs(host)], dtype=np.int64)
+                    for host in host_index2.hosts()}
+
+    # Posting lists of the translated words of the documents in language 2 of every host
+    postings = {host: build_postings(translated_offsets, translated_values, bucket)
+                for host, bucket in buckets2.items()}
+
+    for row1, doc1 in enumerate(docs1):
+        words, word_offsets, word_docs2 = postings.get(hosts1[row1], (np.empty(0, dtype=np.int64), None, None))
+
+        if len(words) == 0:
+            yield doc1, []
+            continue
+
+        # Words of the document which are translations of words of the documents in language 2 of the same host
+        doc_words = values1[offsets1[row1]:offsets1[row1 + 1]]
+        positions = np.minimum(np.searchsorted(words, doc_words), len(words) - 1)
+        positions = positions[words[positions] == doc_words]
+
+        candidates = gather_rows(word_offsets, word_docs2, positions)
+        rows2, num_intersect_words = np.unique(candidates, return_counts=True)
+
+        valid = trans_words2[rows2] > 0
+        rows2 = rows2[valid]
+        num_intersect_words = num_intersect_words[valid]
+
+        vocab_size1 = float(len(index1[doc1]))
+        max_vocab = np.maximum(vocab_size1, vocab_sizes2[rows2])
+        min_vocab = np.minimum(vocab_size1, vocab_sizes2[rows2])
+        scores = (min_vocab / max_vocab) * (num_intersect_words / trans_words2[rows2])
+
+        if 0 <= max_candidates < len(scores):
+            best = select_best(scores, max_candidates)
+            rows2 = rows2[best]
+            scores = scores[best]
+
+        # Sorted by score, and by the order of the documents in language 2 if the scores are the same
+        order = np.lexsort((rows2, -scores))
+
+        yield doc1, [(docs2[row2], score) for row2, score in zip(rows2[order].tolist(), scores[order].tolist())]
+
+
 oparser = argparse.ArgumentParser(
     description="Script that reads the output of bitextor-buildidx and builds an RIDX file (a list of documents and "
                 "their corresponding n-best canidates to be parallel). To do so, a bag-of-word-overlapping metric is "
                 "used to compare documents in both languages")
 oparser.add_argument('idx', metavar='FILE', nargs='?',
                      help='File produced by bitextor-buildidx containing an index of the different words for every '
-                          'language in the website and the list of documents in which they appear (if undefined, '
-                          'the script will read from the standard input)')
+                          'language in the website and the list of documents in which they appear, either binary '
+                          'or in text format (if undefined, the script will read the text format from the standard '
+                          'input)')
 oparser.add_argument('-d', dest="dictionary", required=True,
                      help='Dictionary containing translations of words for the languages of the website; it is used '
                           'to compute the overlapping scores which allow to relate documents in both languages)')
@@ -154,21 +302,20 @@ index_text1 = defaultdict(set)
 index_text2 = defaultdict(set)
 dic = defaultdict(list)
 lista_words = []
-found = {}
 dict_words = {}
 translated_index_text2 = {}
-lett_documents = {}
-ihost = None
+lett_documents = None
 
 # Loading bilingual lexicon
 load_dictionaries(options.dictionary, options.lang1, options.lang2, dic)
-if options.idx is None:
-    reader = sys.stdin
-else:
-    reader = open(options.idx, "r")
 
 # Loading IDX file
-fill_index(reader, options.lang1, options.lang2, index_text1, index_text2)
+if options.idx is not None and is_binary_index(options.idx):
+    fill_index_binary(options.idx, options.lang1, options.lang2, index_text1, index_text2)
+else:
+    reader = sys.stdin if options.idx is None else open(options.idx, "r")
+
+    fill_index(reader, options.lang1, options.lang2, index_text1, index_text2)
 
 # Extending the lexicon with words that are identical in both sides
 feed_dict_with_identical_words(index_text1, index_text2, dic)
@@ -177,45 +324,16 @@ feed_dict_with_identical_words(index_text1, index_text2, dic)
 translate_words(index_text2, dic, dict_words, translated_index_text2)
 
 if options.lett is not None:
+    lett_documents = {}
     read_lett(options.lett, lett_documents)
 
-for document_index1 in index_text1:
-    if options.lett is not None:
-        rx = re.match('(https?://)([^/]+)([^\?]*)(\?.*)?', lett_documents[document_index1])
-        ihost = rx.group(2)
-
-    similar = {}
-    for document_index2 in index_text2:
-        validpair = True
-        if options.lett is not None:
-            rx = re.match('(https?://)([^/]+)([^?]*)(\?.*)?', lett_documents[document_index2])
-            jhost = rx.group(2)
-            if jhost != ihost:
-                validpair = False
-        if validpair:
-            c3 = index_text1[document_index1].intersection(translated_index_text2[document_index2])
-            if len(c3) > 0 and int(dict_words[document_index2]) > 0:
-                max_vocab = max(len(index_text1[document_index1]), len(index_text2[document_index2]))
-                min_vocab = min(len(index_text1[document_index1]), len(index_text2[document_index2]))
-                num_intersect_words = len(c3)
-                num_trans_words_text2 = dict_words[document_index2]
-                similar[document_index2] = (float(min_vocab) / float(max_vocab)) * (
-                    float(num_intersect_words) / float(num_trans_words_text2))
-
-    if len(similar) > 0:
-        similar = sorted(list(similar.items()), key=itemgetter(1), reverse=True)
-    found[document_index1] = []
-    for document_index2 in similar:
-        found[document_index1].append((str(document_index2[0]), str(document_index2[1])))
+max_candidates = options.max_candidates
 
 # Print output header
 print("src_index\ttrg_index\tbow_overlap_score")
 
-max_candidates = options.max_candidates
-
-# For each document, we obtain the 10-best candidates with highest score.
-for src_doc_idx in found:
-    num_best_candidates = min(max_candidates, len(found[src_doc_idx]))
-
-    for trg_doc_idx, bow_score in found[src_doc_idx][:num_best_candidates]:
+# For each document, we obtain the 10-best candidates with highest score, which are written as soon as they are known
+for src_doc_idx, similar in score_candidates(index_text1, index_text2, translated_index_text2, dict_words,
+                                             max_candidates, lett_documents):
+    for trg_doc_idx, bow_score in similar[:max_candidates]:
         print(f"{str(src_doc_idx)}\t{trg_doc_idx}\t{bow_score}")
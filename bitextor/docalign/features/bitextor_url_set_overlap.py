@@ -20,7 +20,7 @@ import argparse
 import re
 import base64
 
-from bitextor.utils.common import open_xz_or_gzip_or_plain
+from bitextor.utils.common import open_xz_or_gzip_or_plain, read_b64_lists
 
 
 def extract_urls(f, docs, offset=1):
@@ -38,6 +38,14 @@ def extract_urls(f, docs, offset=1):
     return offset
 
 
+def read_links(f, docs, offset=1):
+    for links in read_b64_lists(f):
+        docs[offset] = set(links)
+        offset += 1
+
+    return offset
+
+
 def main():
     oparser = argparse.ArgumentParser(
         description="Script that rescores the aligned-document candidates provided by script bitextor-idx2ridx by using "
@@ -45,10 +53,16 @@ def main():
     oparser.add_argument('ridx', metavar='RIDX', nargs='?', default=None,
                          help='File with extension .ridx (reverse index) from bitextor-idx2ridx (if not provided, '
                          'the script will read from the standard input)')
-    oparser.add_argument("--html1", help="File produced during pre-processing containing all HTML files in a WARC file",
-                         dest="html1", required=True)
-    oparser.add_argument("--html2", help="File produced during pre-processing containing all HTML files in a WARC file",
-                         dest="html2", required=True)
+    input1 = oparser.add_mutually_exclusive_group(required=True)
+    input1.add_argument("--html1", help="File produced during pre-processing containing all HTML files in a WARC file",
+                        dest="html1")
+    input1.add_argument("--links1", help="File produced during pre-processing containing the links of all the "
+                                         "documents in a WARC file (used instead of --html1)", dest="links1")
+    input2 = oparser.add_mutually_exclusive_group(required=True)
+    input2.add_argument("--html2", help="File produced during pre-processing containing all HTML files in a WARC file",
+                        dest="html2")
+    input2.add_argument("--links2", help="File produced during pre-processing containing the links of all the "
+                                         "documents in a WARC file (used instead of --html2)", dest="links2")
     options = oparser.parse_args()
 
     if options.ridx is None:
@@ -57,8 +71,14 @@ def main():
         reader = open(options.ridx, "r")
 
     documents = {"l1": {}, "l2": {}}
-    extract_urls(options.html1, documents["l1"])
-    extract_urls(options.html2, documents["l2"])
+    if options.links1:
+        read_links(options.links1, documents["l1"])
+    else:
+        extract_urls(options.html1, documents["l1"])
+    if options.links2:
+        read_links(options.links2, documents["l2"])
+    else:
+        extract_urls(options.html2, documents["l2"])
 
     header = next(reader).strip().split("\t")
     src_doc_idx_idx = header.index("src_index")
@@ -21,25 +21,33 @@ import Levenshtein
 import re
 import base64
 
-from bitextor.utils.common import open_xz_or_gzip_or_plain
+from bitextor.utils.common import open_xz_or_gzip_or_plain, read_b64_lists
 
 
-def extract_urls(html_file, url_file, docs, offset=1):
+def html_links(html_file):
     with open_xz_or_gzip_or_plain(html_file) as hd:
-        with open_xz_or_gzip_or_plain(url_file) as ud:
-            for url in ud:
-                html_content = base64.b64decode(next(hd, None)).decode("utf-8", errors="ignore")
-                links = re.findall('''href\s*=\s*['"]\s*([^'"]+)['"]''', html_content, re.S)
-                rx = re.match('(https?://[^/:]+)', url)
+        for html_base64enc in hd:
+            html_content = base64.b64decode(html_base64enc).decode("utf-8", errors="ignore")
+            yield re.findall('''href\s*=\s*['"]\s*([^'"]+)['"]''', html_content, re.S)
 
-                if rx is not None:
-                    url_domain = rx.group(1)
-                    urls = "".join(links).replace(url_domain, "")
-                else:
-                    urls = "".join(links)
 
-                docs[offset] = urls
-                offset += 1
+def extract_urls(html_file, url_file, docs, offset=1, links_file=False):
+    # links_file: html_file contains the links of every document written during pre-processing instead of the HTML
+    documents_links = read_b64_lists(html_file) if links_file else html_links(html_file)
+
+    with open_xz_or_gzip_or_plain(url_file) as ud:
+        for url in ud:
+            links = next(documents_links, [])
+            rx = re.match('(https?://[^/:]+)', url)
+
+            if rx is not None:
+                url_domain = rx.group(1)
+                urls = "".join(links).replace(url_domain, "")
+            else:
+                urls = "".join(links)
+
+            docs[offset] = urls
+            offset += 1
 
     return offset
 
@@ -51,10 +59,16 @@ def main():
     oparser.add_argument('ridx', metavar='RIDX', nargs='?', default=None,
                          help='File with extension .ridx (reverse index) from bitextor-idx2ridx (if not provided, '
                          'the script will read from the standard input)')
-    oparser.add_argument("--html1", help="File produced during pre-processing containing all HTML files in a WARC file for SL",
-                         dest="html1", required=True)
-    oparser.add_argument("--html2", help="File produced during pre-processing containing all HTML files in a WARC file for TL",
-                         dest="html2", required=True)
+    input1 = oparser.add_mutually_exclusive_group(required=True)
+    input1.add_argument("--html1", help="File produced during pre-processing containing all HTML files in a WARC file for SL",
+                        dest="html1")
+    input1.add_argument("--links1", help="File produced during pre-processing containing the links of all the "
+                                         "documents in a WARC file for SL (used instead of --html1)", dest="links1")
+    input2 = oparser.add_mutually_exclusive_group(required=True)
+    input2.add_argument("--html2", help="File produced during pre-processing containing all HTML files in a WARC file for TL",
+                        dest="html2")
+    input2.add_argument("--links2", help="File produced during pre-processing containing the links of all the "
+                                         "documents in a WARC file for TL (used instead of --html2)", dest="links2")
     oparser.add_argument("--url1", help="File produced during pre-processing containing all the URLs in a WARC file for SL",
                          dest="url1", required=True)
     oparser.add_argument("--url2", help="File produced during pre-processing containing all the URLs in a WARC file for TL",
@@ -67,8 +81,14 @@ def main():
         reader = open(options.ridx, "r")
 
     documents = {"l1": {}, "l2": {}}
-    extract_urls(options.html1, options.url1, documents["l1"])
-    extract_urls(options.html2, options.url2, documents["l2"])
+    if options.links1:
+        extract_urls(options.links1, options.url1, documents["l1"], links_file=True)
+    else:
+        extract_urls(options.html1, options.url1, documents["l1"])
+    if options.links2:
+        extract_urls(options.links2, options.url2, documents["l2"], links_file=True)
+    else:
+        extract_urls(options.html2, options.url2, documents["l2"])
 
     header = next(reader).strip().split("\t")
     src_doc_idx_idx = header.index("src_index")
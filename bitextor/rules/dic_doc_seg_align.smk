@@ -9,18 +9,20 @@ rule build_idx:
     Produce an index of words used in text1 and text2
     :input.text1: gz-compressed file with a base64-encoded tokenised documents in SRC_LANG per line
     :input.text2: gz-compressed file with a base64-encoded tokenised documents in TRG_LANG per line
-    :output: gz-commpressed index file, format is <lang> \\t <word> \\t <doc_id_[src|trg]>
+    :output: binary inverted index file (see utils/invertedindex.py), equivalent to <lang> \\t <word> \\t <doc_id_[src|trg]>
     """
     input:
         text1=f"{DATADIR}/shards/{SRC_LANG}/{{shard}}/{{src_batch}}/tokenised.gz",
         text2=f"{DATADIR}/shards/{TRG_LANG}/{{shard}}/{{trg_batch}}/tokenised.gz",
     output:
-        f"{TRANSIENT}/{SRC_LANG}_{TRG_LANG}/{{shard}}/{SRC_LANG}{{src_batch}}_{TRG_LANG}{{trg_batch}}.idx.gz",
+        f"{TRANSIENT}/{SRC_LANG}_{TRG_LANG}/{{shard}}/{SRC_LANG}{{src_batch}}_{TRG_LANG}{{trg_batch}}.idx",
+    params:
+        threads=THREADS["docalign"],
+    threads: JOB_THREADS["docalign"]
     shell:
         """
         {PROFILING} python3 {WORKFLOW}/docalign/bitextor_build_idx.py --lang1 {SRC_LANG} --lang2 {TRG_LANG} \
-            -m 15 --text1 {input.text1} --text2 {input.text2} \
-            | gzip -c > {output}
+            -m 15 --text1 {input.text1} --text2 {input.text2} --output {output} --workers {params.threads}
         """
 
 
@@ -28,7 +30,7 @@ rule idx2ridx:
     """
     Read .idx file and produce an ridx file corresponding to preliminary alignment by computing bag-of-words overlap metric
         i.e. [SRC|TRG]_LANG docs and their corresponding n-best [TRG|SRC]_LANG candidates to be parallel
-    :input.idx: gz-compressed index file, output of build_idx rule
+    :input.idx: binary index file, output of build_idx rule
     :input.dic: SRC_LANG-TRG_LANG dictionary provided by user
     :output: gz-compressed ridx file, format is <doc_id_[src|trg]> \\t <doc_id_[trg|src]> \\t <score>
     """
@@ -43,8 +45,7 @@ rule idx2ridx:
                     echo "--lang1 {SRC_LANG} --lang2 {TRG_LANG}" || \
                     echo "--lang1 {TRG_LANG} --lang2 {SRC_LANG}")
 
-        zcat {input.idx} \
-            | {PROFILING} python3 {WORKFLOW}/docalign/bitextor_idx2ridx.py -d {input.dic} $params \
+        {PROFILING} python3 {WORKFLOW}/docalign/bitextor_idx2ridx.py {input.idx} -d {input.dic} $params \
             | gzip -c > {output}
         """
 
@@ -55,21 +56,24 @@ rule image_set_overlap:
     :input.ridx: gz-compressed {src2trg,trg2src}.ridx, output of idx2ridx step
     :input.html1: gz-compressed file with a base64-encoded html documents in SRC_LANG per line
     :input.html2: gz-compressed file with a base64-encoded html documents in TRG_LANG per line
+        (or with the base64-encoded images of the documents, if the preprocessor writes them)
     :output: gz-compressed ridx file, format is <doc_id_[src|trg]> \\t <doc_id_[trg|src]> \\t <f1> \\t <f2>,
         where f1 is the score computed in previous step, and f2 is newly computed images overlap score
         all the scores are in [0.0, 1.0] range
     """
     input:
         ridx=f"{TRANSIENT}/{SRC_LANG}_{TRG_LANG}/{{shard}}/{SRC_LANG}{{src_batch}}_{TRG_LANG}{{trg_batch}}.{{direction}}.ridx.gz",
-        html1=f"{DATADIR}/shards/{SRC_LANG}/{{shard}}/{{src_batch}}/{HTML_FILE}",
-        html2=f"{DATADIR}/shards/{TRG_LANG}/{{shard}}/{{trg_batch}}/{HTML_FILE}",
+        html1=f"{DATADIR}/shards/{SRC_LANG}/{{shard}}/{{src_batch}}/{IMAGES_FILE or HTML_FILE}",
+        html2=f"{DATADIR}/shards/{TRG_LANG}/{{shard}}/{{trg_batch}}/{IMAGES_FILE or HTML_FILE}",
     output:
         temp(f"{TRANSIENT}/{SRC_LANG}_{TRG_LANG}/{{shard}}/{SRC_LANG}{{src_batch}}_{TRG_LANG}{{trg_batch}}.{{direction}}.imgoverlap.gz"),
+    params:
+        input="--images" if IMAGES_FILE else "--html",
     shell:
         """
         params=$([[ {wildcards.direction} == src2trg* ]] && \
-                    echo "--html1 {input.html1} --html2 {input.html2}" || \
-                    echo "--html1 {input.html2} --html2 {input.html1}")
+                    echo "{params.input}1 {input.html1} {params.input}2 {input.html2}" || \
+                    echo "{params.input}1 {input.html2} {params.input}2 {input.html1}")
 
         zcat {input.ridx} \
             | {PROFILING} python3 {WORKFLOW}/docalign/features/bitextor_image_set_overlap.py $params \
@@ -111,6 +115,7 @@ rule url_distance:
     :input.ridx: gz-compressed {src2trg,trg2src}.ridx, output of structure_distance step
     :input.html1: gz-compressed file with a base64-encoded html documents in SRC_LANG per line
     :input.html2: gz-compressed file with a base64-encoded html documents in TRG_LANG per line
+        (or with the base64-encoded links of the documents, if the preprocessor writes them)
     :input.url1: gz-compressed file with a SRC document URL per line
     :input.url2: gz-compressed file with a TRG document URL per line
     :output: gz-compressed ridx file, format is <doc_id_[src|trg]> \\t <doc_id_[trg|src]> \\t <f1> \\t <f2> \\t ... \\t <f4>,
@@ -119,18 +124,20 @@ rule url_distance:
     """
     input:
         structuredistance=f"{TRANSIENT}/{SRC_LANG}_{TRG_LANG}/{{shard}}/{SRC_LANG}{{src_batch}}_{TRG_LANG}{{trg_batch}}.{{direction}}.structuredistance.gz",
-        html1=f"{DATADIR}/shards/{SRC_LANG}/{{shard}}/{{src_batch}}/{HTML_FILE}",
-        html2=f"{DATADIR}/shards/{TRG_LANG}/{{shard}}/{{trg_batch}}/{HTML_FILE}",
+        html1=f"{DATADIR}/shards/{SRC_LANG}/{{shard}}/{{src_batch}}/{LINKS_FILE or HTML_FILE}",
+        html2=f"{DATADIR}/shards/{TRG_LANG}/{{shard}}/{{trg_batch}}/{LINKS_FILE or HTML_FILE}",
         url1=f"{DATADIR}/shards/{SRC_LANG}/{{shard}}/{{src_batch}}/url.gz",
         url2=f"{DATADIR}/shards/{TRG_LANG}/{{shard}}/{{trg_batch}}/url.gz",
     output:
         temp(f"{TRANSIENT}/{SRC_LANG}_{TRG_LANG}/{{shard}}/{SRC_LANG}{{src_batch}}_{TRG_LANG}{{trg_batch}}.{{direction}}.urldistance.gz"),
     priority: 8
+    params:
+        input="--links" if LINKS_FILE else "--html",
     shell:
         """
         params=$([[ {wildcards.direction} == src2trg* ]] && \
-                    echo "--html1 {input.html1} --html2 {input.html2} --url1 {input.url1} --url2 {input.url2}" || \
-                    echo "--html1 {input.html2} --html2 {input.html1} --url1 {input.url2} --url2 {input.url1}")
+                    echo "{params.input}1 {input.html1} {params.input}2 {input.html2} --url1 {input.url1} --url2 {input.url2}" || \
+                    echo "{params.input}1 {input.html2} {params.input}2 {input.html1} --url1 {input.url2} --url2 {input.url1}")
 
         zcat {input.structuredistance} \
             | {PROFILING} python3 {WORKFLOW}/docalign/features/bitextor_urls_distance.py $params \
@@ -144,6 +151,7 @@ rule mutually_linked:
     :input.ridx: gz-compressed {src2trg,trg2src}.ridx, output of url_distance step
     :input.html1: gz-compressed file with a base64-encoded html documents in SRC_LANG per line
     :input.html2: gz-compressed file with a base64-encoded html documents in TRG_LANG per line
+        (or with the base64-encoded links of the documents, if the preprocessor writes them)
     :input.url1: gz-compressed file with a SRC document URL per line
     :input.url2: gz-compressed file with a TRG document URL per line
     :output: gz-compressed ridx file, format is <doc_id_[src|trg]> \\t <doc_id_[trg|src]> \\t <f1> \\t <f2> \\t ... \\t <f5>,
@@ -152,17 +160,19 @@ rule mutually_linked:
     """
     input:
         urldistance=f"{TRANSIENT}/{SRC_LANG}_{TRG_LANG}/{{shard}}/{SRC_LANG}{{src_batch}}_{TRG_LANG}{{trg_batch}}.{{direction}}.urldistance.gz",
-        html1=f"{DATADIR}/shards/{SRC_LANG}/{{shard}}/{{src_batch}}/{HTML_FILE}",
-        html2=f"{DATADIR}/shards/{TRG_LANG}/{{shard}}/{{trg_batch}}/{HTML_FILE}",
+        html1=f"{DATADIR}/shards/{SRC_LANG}/{{shard}}/{{src_batch}}/{LINKS_FILE or HTML_FILE}",
+        html2=f"{DATADIR}/shards/{TRG_LANG}/{{shard}}/{{trg_batch}}/{LINKS_FILE or HTML_FILE}",
         url1=f"{DATADIR}/shards/{SRC_LANG}/{{shard}}/{{src_batch}}/url.gz",
         url2=f"{DATADIR}/shards/{TRG_LANG}/{{shard}}/{{trg_batch}}/url.gz",
     output:
         temp(f"{TRANSIENT}/{SRC_LANG}_{TRG_LANG}/{{shard}}/{SRC_LANG}{{src_batch}}_{TRG_LANG}{{trg_batch}}.{{direction}}.mutuallylinked.gz"),
+    params:
+        input="--links" if LINKS_FILE else "--html",
     shell:
         """
         params=$([[ {wildcards.direction} == src2trg* ]] && \
-                    echo "--html1 {input.html1} --html2 {input.html2} --url1 {input.url1} --url2 {input.url2}" || \
-                    echo "--html1 {input.html2} --html2 {input.html1} --url1 {input.url2} --url2 {input.url1}")
+                    echo "{params.input}1 {input.html1} {params.input}2 {input.html2} --url1 {input.url1} --url2 {input.url2}" || \
+                    echo "{params.input}1 {input.html2} {params.input}2 {input.html1} --url1 {input.url2} --url2 {input.url1}")
 
         zcat {input.urldistance} \
             | {PROFILING} python3 {WORKFLOW}/docalign/features/bitextor_mutually_linked.py $params \
@@ -204,22 +214,25 @@ rule urls_overlap:
     :input.ridx: gz-compressed {src2trg,trg2src}.ridx, output of urls_comparison step
     :input.html1: gz-compressed file with a base64-encoded html documents in SRC_LANG per line
     :input.html2: gz-compressed file with a base64-encoded html documents in TRG_LANG per line
+        (or with the base64-encoded links of the documents, if the preprocessor writes them)
     :output: gz-compressed ridx file, format is <doc_id_[src|trg]> \\t <doc_id_[trg|src]> \\t <f1> \\t <f2> \\t ... \\t <f7>,
         where f1-f6 are the scores computed in previous steps, and f7 is newly urls overlapping score
         all the scores are in [0.0, 1.0] range
     """
     input:
         urlscomparison=f"{TRANSIENT}/{SRC_LANG}_{TRG_LANG}/{{shard}}/{SRC_LANG}{{src_batch}}_{TRG_LANG}{{trg_batch}}.{{direction}}.urlscomparison.gz",
-        html1=f"{DATADIR}/shards/{SRC_LANG}/{{shard}}/{{src_batch}}/{HTML_FILE}",
-        html2=f"{DATADIR}/shards/{TRG_LANG}/{{shard}}/{{trg_batch}}/{HTML_FILE}",
+        html1=f"{DATADIR}/shards/{SRC_LANG}/{{shard}}/{{src_batch}}/{LINKS_FILE or HTML_FILE}",
+        html2=f"{DATADIR}/shards/{TRG_LANG}/{{shard}}/{{trg_batch}}/{LINKS_FILE or HTML_FILE}",
     output:
         # not marking this as temp because this is the file that contains all the features
         f"{TRANSIENT}/{SRC_LANG}_{TRG_LANG}/{{shard}}/{SRC_LANG}{{src_batch}}_{TRG_LANG}{{trg_batch}}.{{direction}}.urlsoverlap.gz",
+    params:
+        input="--links" if LINKS_FILE else "--html",
     shell:
         """
         params=$([[ {wildcards.direction} == src2trg* ]] && \
-                    echo "--html1 {input.html1} --html2 {input.html2}" || \
-                    echo "--html1 {input.html2} --html2 {input.html1}")
+                    echo "{params.input}1 {input.html1} {params.input}2 {input.html2}" || \
+                    echo "{params.input}1 {input.html2} {params.input}2 {input.html1}")
 
         zcat {input.urlscomparison} \
             | {PROFILING} python3 {WORKFLOW}/docalign/features/bitextor_url_set_overlap.py $params \
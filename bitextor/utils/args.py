@@ -154,6 +154,7 @@ def validate_args(config):
         ## specific to warc2preprocess:
         'cleanHTML': {'type': 'boolean', 'dependencies': {'preprocessor': 'warc2preprocess'}},
         'ftfy': {'type': 'boolean', 'dependencies': {'preprocessor': 'warc2preprocess'}},
+        'ftfyStrict': {'type': 'boolean', 'dependencies': {'ftfy': True}},
         'langID': {
             'type': 'string',
             'allowed': ['cld2', 'cld3'],
@@ -161,10 +162,11 @@ def validate_args(config):
         },
         'parser': {
             'type': 'string',
-            'allowed': ['bs4', 'modest', 'simple', 'lxml'],
+            'allowed': ['bs4', 'modest', 'simple', 'lxml', 'auto'],
             'dependencies': {'preprocessor': 'warc2preprocess'}
         },
         'html5lib': {'type': 'boolean', 'dependencies': {'preprocessor': 'warc2preprocess'}},
+        'digestCache': {'type': 'string', 'dependencies': {'preprocessor': 'warc2preprocess'}},
         ## pdfEXTRACT
         'PDFextract': {'type': 'boolean', 'dependencies': {'preprocessor': 'warc2preprocess'}},
         'PDFextract_configfile': {'type': 'string', 'dependencies': 'PDFextract'},
@@ -0,0 +1,142 @@
+#  This file is part of Bitextor.
+#
+#  Bitextor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bitextor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Bitextor.  If not, see <https://www.gnu.org/licenses/>.
+
+# Checkpoints of the record processing scripts (e.g. bitextor_warc2preprocess.py), so an interrupted run can be
+#  resumed instead of starting again. A checkpoint is a JSON file with the last input record which was completely
+#  processed, the size of the output files at that point and the deduplication state (stored as arrays in a .npz
+#  file next to it). The output files are written as a sequence of compressed members (see MemberWriter), so they
+#  can be truncated at the recorded sizes
+
+import os
+import json
+import time
+import logging
+
+import numpy as np
+from warcio.archiveiterator import ArchiveIterator
+
+
+class Checkpoint(object):
+
+    def __init__(self, path, interval=300):
+        self.path = path
+        self.interval = interval
+        self.last_save = time.time()
+        self.sequence = 0
+
+    def due(self):
+        return time.time() - self.last_save >= self.interval
+
+    def load(self):
+        """
+        Return the state and the arrays of the last checkpoint, or (None, {}) if there is no checkpoint
+        """
+        if not os.path.exists(self.path):
+            return None, {}
+
+        with open(self.path) as fh:
+            state = json.load(fh)
+
+        self.sequence = state["sequence"]
+        arrays = {}
+
+        if state.get("arrays"):
+            with np.load(os.path.join(os.path.dirname(self.path), state["arrays"])) as npz:
+                arrays = {name: npz[name] for name in npz.files}
+
+        logging.info("Resuming from checkpoint %s (record %d)", self.path, state["input_record"])
+
+        return state, arrays
+
+    def save(self, state, arrays=None):
+        # Every checkpoint writes its arrays to a new file, and the JSON file is replaced once they are complete,
+        # so the JSON file always refers to complete arrays
+        self.sequence += 1
+        state = dict(state, sequence=self.sequence, arrays=None)
+        previous_arrays = None
+
+        if arrays:
+            state["arrays"] = f"{os.path.basename(self.path)}.{self.sequence}.npz"
+
+            with open(os.path.join(os.path.dirname(self.path), state["arrays"]), "wb") as fh:
+                np.savez(fh, **arrays)
+
+        if os.path.exists(self.path):
+            with open(self.path) as fh:
+                previous_arrays = json.load(fh).get("arrays")
+
+        tmp_path = f"{self.path}.tmp"
+
+        with open(tmp_path, "w") as fh:
+            json.dump(state, fh, indent=2, sort_keys=True)
+            fh.write("\n")
+
+        os.replace(tmp_path, self.path)
+
+        if previous_arrays and previous_arrays != state["arrays"]:
+            os.remove(os.path.join(os.path.dirname(self.path), previous_arrays))
+
+        self.last_save = time.time()
+
+    def remove(self):
+        """
+        Remove the checkpoint once the run is complete
+        """
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path) as fh:
+            arrays = json.load(fh).get("arrays")
+
+        os.remove(self.path)
+
+        if arrays:
+            os.remove(os.path.join(os.path.dirname(self.path), arrays))
+
+
+def iterate_archive(fh, state=None):
+    """
+    Yield the index, the offset and every record of a WARC file, starting after the last record processed in the
+    checkpoint state (if provided). Seekable inputs are moved to the offset of that record, and the records of other
+    inputs (e.g. stdin) are read and skipped
+    """
+    last_record = -1
+    start = 0
+
+    if state is not None:
+        last_record = state["input_record"]
+
+        if fh.seekable():
+            fh.seek(state["input_offset"])
+            start = last_record
+
+    archive_iterator = ArchiveIterator(fh)
+
+    for index, record in enumerate(archive_iterator, start=start):
+        if index <= last_record:
+            continue
+
+        # Offset where the current record starts (get_record_offset() would read the record to the end)
+        yield index, archive_iterator.offset, record
+
+
+def truncate_outputs(sizes):
+    """
+    Truncate the output files to the sizes recorded in a checkpoint
+    """
+    for path, size in sizes.items():
+        if os.path.exists(path) and os.path.getsize(path) > size:
+            with open(path, "r+b") as fh:
+                fh.truncate(size)
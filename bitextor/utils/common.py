@@ -19,19 +19,48 @@ except ImportError:
     from backports import lzma
 
 import gzip
+import base64
 from contextlib import contextmanager
 
 import subprocess
 import sys
 import os
-import requests
+import queue
 import shlex
+import logging
+import threading
+import requests
 
 class ExternalTextProcessor(object):
-
-    def __init__(self, cmd, raise_exception=True, return_debug_data=False):
+    """
+    Run an external tool on texts. By default, the tool is started for every text. If `framing` is provided, the
+    tool is started once and kept running, and every text is written to its standard input followed by a frame
+    delimiter:
+
+    - 'lines': the tool writes exactly one line per input line (e.g. word tokenizers), so no delimiter is needed
+    - any other value: a sentinel line which is written after every text, and which the tool copies to its output
+      on a line of its own (e.g. '<P>' for Moses split-sentences.perl). Texts with a line which is the sentinel or
+      is blank (Moses split-sentences.perl writes '<P>' for blank lines) would end the output early, so the tool is
+      started for them
+
+    If the tool writes more output than expected (so the output of the next texts would not be aligned with them),
+    an exception is raised.
+
+    If the tool exits while processing a text, it is restarted and the text is processed again; if the output of
+    a text does not arrive in `idle_timeout` seconds, the tool is assumed to buffer its output (i.e. it cannot
+    stream), so it is stopped and the tool is started for every text from then on.
+    """
+
+    def __init__(self, cmd, raise_exception=True, return_debug_data=False, framing=None, idle_timeout=60):
         self.raise_exception = raise_exception
         self.return_debug_data = return_debug_data
+        self.framing = framing
+        self.idle_timeout = idle_timeout if idle_timeout and idle_timeout > 0 else None
+        self.proc = None
+        self.output_lines = None
+
+        if framing and return_debug_data:
+            raise ValueError("The debug data of the external tool is not available when it is kept running")
 
         if isinstance(cmd, str):
             # Split the command as bash does
@@ -43,6 +72,15 @@ class ExternalTextProcessor(object):
             self.cmd = cmd
 
     def process(self, input_text):
+        if self.framing:
+            return self.process_persistent(input_text)
+
+        return self.process_once(input_text)
+
+    def process_once(self, input_text):
+        """
+        Start the tool for the text
+        """
         proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         outs, errs = proc.communicate(input=bytes(input_text, encoding='utf-8'))
         output = outs.decode('utf-8')
@@ -57,6 +95,135 @@ class ExternalTextProcessor(object):
 
         return output
 
+    def start(self):
+        # The errors of the tool go to our standard error, so it never blocks writing them
+        self.proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+        self.output_lines = queue.Queue()
+
+        # The output is read from another thread, so the tool does not block writing a long output while it is
+        # still being written a long input
+        def read_output(stdout, output_lines):
+            for line in stdout:
+                output_lines.put(line)
+            output_lines.put(None)
+
+        threading.Thread(target=read_output, args=(self.proc.stdout, self.output_lines), daemon=True).start()
+
+    def stop(self):
+        if self.proc is None:
+            return None
+
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+
+        try:
+            self.proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+        returncode = self.proc.returncode
+        self.proc = None
+        self.output_lines = None
+
+        return returncode
+
+    def close(self):
+        self.stop()
+
+    def process_persistent(self, input_text):
+        lines = input_text.split("\n")
+        if lines[-1] == "":
+            lines.pop()
+
+        if self.framing == "lines" and not lines:
+            return ""
+        if self.framing != "lines" and any(line.strip() in ("", self.framing) for line in lines):
+            # The sentinel would be found in the output before the end of the text
+            return self.process_once(input_text)
+
+        for attempt in range(2):
+            if self.proc is None:
+                self.start()
+
+            try:
+                output = self.communicate(lines)
+            except BrokenPipeError:
+                output = None
+            except queue.Empty:
+                logging.warning("External tool '%s' did not answer in %d seconds: running it for every text from now",
+                                " ".join(self.cmd), self.idle_timeout)
+                self.proc.kill()
+                self.stop()
+                self.framing = None
+
+                return self.process(input_text)
+
+            if output is not None:
+                break
+
+            returncode = self.stop()
+
+            if attempt == 0:
+                logging.warning("External tool '%s' exited with code %s: restarting it", " ".join(self.cmd), returncode)
+            else:
+                # The text itself makes the tool exit, so the error is handled as if the tool was run for it
+                logging.warning("External tool '%s' exited again with code %s: running it only for this text",
+                                " ".join(self.cmd), returncode)
+
+                return self.process_once(input_text)
+
+        output = "".join(output)
+
+        # Same output as running the tool for the text
+        if not input_text.endswith("\n") and output.endswith("\n"):
+            output = output[:-1]
+
+        return output
+
+    def communicate(self, lines):
+        """
+        Write a text (list of lines) and return the lines of its output, or None if the tool exits before
+        """
+        try:
+            leftover = self.output_lines.get_nowait()
+        except queue.Empty:
+            pass
+        else:
+            if leftover is None:
+                # The tool exited after the previous text
+                return None
+
+            raise Exception(f"External tool '{' '.join(self.cmd)}' wrote more output than expected for the previous "
+                            f"text, so its output is not aligned with the input")
+
+        data = "".join(line + "\n" for line in lines)
+        if self.framing != "lines":
+            data += self.framing + "\n"
+
+        self.proc.stdin.write(data.encode("utf-8"))
+        self.proc.stdin.flush()
+
+        output = []
+        expected = len(lines) if self.framing == "lines" else None
+
+        while expected is None or len(output) < expected:
+            line = self.output_lines.get(timeout=self.idle_timeout)
+
+            if line is None:
+                return None
+
+            line = line.decode("utf-8")
+
+            if expected is None and line.rstrip("\r\n").strip() == self.framing:
+                break
+
+            output.append(line)
+
+        return output
+
 
 @contextmanager
 def open_xz_or_gzip_or_plain(file_path, mode='rt'):
@@ -78,6 +245,17 @@ def open_xz_or_gzip_or_plain(file_path, mode='rt'):
             f.close()
 
 
+def read_b64_lists(file_path):
+    """
+    Read a file with a b64encoded list of items (e.g. the links or images written by bitextor_warc2preprocess.py)
+    per line, and yield the list of every line
+    """
+    with open_xz_or_gzip_or_plain(file_path) as fd:
+        for line in fd:
+            items = base64.b64decode(line.strip()).decode("utf-8", errors="ignore")
+            yield items.split("\n") if items else []
+
+
 @contextmanager
 def dummy_open():
     yield None
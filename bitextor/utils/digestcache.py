@@ -0,0 +1,120 @@
+#  This file is part of Bitextor.
+#
+#  Bitextor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bitextor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Bitextor.  If not, see <https://www.gnu.org/licenses/>.
+
+# Persistent cache of the processing results of WARC records across crawls (e.g. monthly recrawls of the same
+#  sites), stored in a SQLite database. Records are identified by their WARC-Payload-Digest, their HTTP
+#  Content-Type (which is used to resolve the encoding and MIME type) and a fingerprint of the processing options,
+#  so a record whose payload has not changed is not decoded, cleaned and extracted again
+
+import json
+import zlib
+import sqlite3
+import hashlib
+
+# Increase when the stored results change, so old entries are not used
+CACHE_VERSION = 1
+
+
+def options_fingerprint(options, names):
+    """
+    Hash of the values of the options (argparse namespace) which change the processing results
+    """
+    values = {name: getattr(options, name, None) for name in names}
+    values["version"] = CACHE_VERSION
+
+    return hashlib.sha1(json.dumps(values, sort_keys=True).encode()).hexdigest()
+
+
+class DigestCache(object):
+    """
+    Results of the records (a list with a result per document of the record, as several documents might be
+    extracted from a single record) by key. The results are JSON-serializable dicts
+    """
+
+    def __init__(self, path, fingerprint, commit_interval=1000):
+        # Several processes might share the cache (e.g. one per WARC)
+        self.connection = sqlite3.connect(path, timeout=600)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB)")
+        self.fingerprint = fingerprint
+        self.commit_interval = commit_interval
+        self.uncommitted = 0
+
+        # Results of the record which is being added (see add())
+        self.current_key = None
+        self.current_index = None
+        self.current_results = []
+
+    def key(self, digest, content_type, doc_format=None):
+        """
+        Key of the results of a record, from its payload digest, its Content-Type and its broader document format
+        (which depends on the URL, see bitextor_warc2htmlwarc.document_format())
+        """
+        if not digest:
+            return None
+
+        return "\t".join((self.fingerprint, digest, content_type or "", doc_format or ""))
+
+    def get(self, key):
+        row = self.connection.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+
+        if row is None:
+            return None
+
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, key, results):
+        value = zlib.compress(json.dumps(results).encode())
+        self.connection.execute("INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)", (key, value))
+        self.uncommitted += 1
+
+        if self.uncommitted >= self.commit_interval:
+            self.commit()
+
+    def add(self, key, index, result):
+        """
+        Add a result of the record with the given input index. The results of a record are stored once all of
+        them have been added (i.e. when a result of another record is added), unless any of them is None (i.e.
+        it cannot be cached). A key of None adds nothing
+        """
+        if index != self.current_index:
+            self.finish_record()
+            self.current_key = key
+            self.current_index = index
+
+        if self.current_key is None:
+            return
+
+        if result is None:
+            self.current_key = None
+        else:
+            self.current_results.append(result)
+
+    def finish_record(self):
+        if self.current_key is not None and self.current_results:
+            self.put(self.current_key, self.current_results)
+
+        self.current_key = None
+        self.current_index = None
+        self.current_results = []
+
+    def commit(self):
+        self.connection.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.finish_record()
+        self.commit()
+        self.connection.close()
@@ -0,0 +1,203 @@
+#  This file is part of Bitextor.
+#
+#  Bitextor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bitextor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Bitextor.  If not, see <https://www.gnu.org/licenses/>.
+
+# Resolution of the charset and MIME type of the documents. The metadata provided by the HTTP headers and the
+#  beginning of the document are used first, and cchardet or libmagic are only run (on a bounded prefix of the
+#  document) when that metadata is missing or ambiguous. The source of each value is returned as well in order
+#  to be able to measure how often the fast path is taken
+
+import re
+import codecs
+
+import cchardet
+import magic
+
+# Bytes of the document where <meta charset> is looked for
+META_PREFIX_SIZE = 4096
+# Bytes (or characters) of the document provided to cchardet or libmagic
+DETECT_PREFIX_SIZE = 65536
+
+CONTENT_TYPE_CHARSET_RE = re.compile(r'charset\s*=\s*["\']?\s*([\w:.+-]+)', re.IGNORECASE)
+META_CHARSET_RE = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?\s*([\w:.+-]+)', re.IGNORECASE)
+HTML_START_RE = re.compile(r'\s*(<\?xml[^>]*>\s*)?(<!--.*?-->\s*)*(<!doctype\s+html|<html|<head|<body)', re.IGNORECASE | re.DOTALL)
+
+# IANA names (the ones cchardet uses) of the Python codecs, so the reported encoding does not depend on how it was
+#  resolved. ISO-8859-* and WINDOWS-125* are handled in encoding_name()
+ENCODING_NAMES = {
+    "utf-8": "UTF-8",
+    "utf-8-sig": "UTF-8-SIG",
+    "utf-16": "UTF-16",
+    "utf-16-le": "UTF-16LE",
+    "utf-16-be": "UTF-16BE",
+    "utf-32": "UTF-32",
+    "utf-32-le": "UTF-32LE",
+    "utf-32-be": "UTF-32BE",
+    "ascii": "ASCII",
+    "shift_jis": "SHIFT_JIS",
+    "cp932": "WINDOWS-31J",
+    "euc_jp": "EUC-JP",
+    "iso2022_jp": "ISO-2022-JP",
+    "euc_kr": "EUC-KR",
+    "cp949": "CP949",
+    "iso2022_kr": "ISO-2022-KR",
+    "gb2312": "GB2312",
+    "gbk": "GBK",
+    "gb18030": "GB18030",
+    "hz": "HZ-GB-2312",
+    "big5": "BIG5",
+    "big5hkscs": "BIG5-HKSCS",
+    "koi8-r": "KOI8-R",
+    "koi8-u": "KOI8-U",
+    "cp866": "IBM866",
+    "cp855": "IBM855",
+    "cp874": "WINDOWS-874",
+    "mac-cyrillic": "MAC-CYRILLIC",
+    "tis-620": "TIS-620",
+}
+
+# MIME types which are checked against the beginning of the document before trusting them
+HTML_MIME_TYPES = {"text/html", "application/xhtml+xml"}
+
+# Characters which UTF-8 continuation bytes (0x80-0xBF) become when UTF-8 is decoded as windows-1252 or Latin-1
+_CONTINUATION = "\u0080-\u00bf\u20ac\u201a\u0192\u201e\u2026\u2020\u2021\u02c6\u2030\u0160\u2039\u0152" \
+                "\u017d\u2018\u2019\u201c\u201d\u2022\u2013\u2014\u02dc\u2122\u0161\u203a\u0153\u017e\u0178"
+# UTF-8 sequences decoded with the wrong encoding (a lead byte followed by continuation bytes), C1 control
+#  characters and replacement characters, which are the usual signs of mojibake
+MOJIBAKE_RE = re.compile(
+    "[\u00c2-\u00df][" + _CONTINUATION + "]|[\u00e0-\u00ef][" + _CONTINUATION + "]{2}|[\u0080-\u009f\ufffd]")
+
+
+def lookup_encoding(label):
+    try:
+        name = codecs.lookup(label.decode("ascii") if isinstance(label, bytes) else label).name
+    except (LookupError, UnicodeDecodeError):
+        return None
+
+    # Browsers decode documents labelled as ASCII or Latin-1 as windows-1252
+    if name in ("ascii", "iso8859-1"):
+        name = "cp1252"
+
+    return name
+
+
+def encoding_name(name):
+    """
+    IANA name of a Python codec name (e.g. 'iso8859-2' -> 'ISO-8859-2')
+    """
+    if name in ENCODING_NAMES:
+        return ENCODING_NAMES[name]
+    if name.startswith("cp125"):
+        return "WINDOWS-" + name[2:]
+    if name.startswith("iso8859-"):
+        return "ISO-8859-" + name[8:]
+
+    return name.upper().replace("_", "-")
+
+
+def content_type_charset(content_type):
+    if not content_type:
+        return None
+
+    rx = CONTENT_TYPE_CHARSET_RE.search(content_type)
+
+    return lookup_encoding(rx.group(1)) if rx else None
+
+
+def meta_charset(data):
+    rx = META_CHARSET_RE.search(data[:META_PREFIX_SIZE])
+
+    return lookup_encoding(rx.group(1)) if rx else None
+
+
+def is_utf8(data):
+    try:
+        data.decode("utf-8")
+    except UnicodeDecodeError:
+        return False
+
+    return True
+
+
+def detect_encoding(data):
+    encoding = cchardet.detect(data[:DETECT_PREFIX_SIZE])['encoding']
+    if encoding is None:
+        encoding = "utf-8"
+    if len(data) > 0:
+        # We convert, even if the text is detected to be UTF8 so,
+        # if it is an error and conversion fails, the error is caught here
+        for enc in [encoding, 'utf-8', 'iso-8859-1', 'windows‑1252']:
+            try:
+                return enc, data.decode(enc)
+            except BaseException:
+                pass
+    return None, ''
+
+
+def resolve_encoding(data, content_type=None):
+    """
+    Decode a document. Returns a tuple with the source of the encoding ('bom', 'ascii', 'header', 'meta' or
+    'detector'), the encoding and the decoded text. If the document cannot be decoded, the encoding is None
+    """
+    if data[:3] == codecs.BOM_UTF8 and is_utf8(data):
+        return "bom", encoding_name("utf-8-sig"), data.decode("utf-8-sig")
+
+    header_encoding = content_type_charset(content_type)
+    document_encoding = meta_charset(data)
+
+    if data.isascii() and header_encoding is None and document_encoding is None:
+        return "ascii", encoding_name("ascii"), data.decode("ascii")
+
+    if header_encoding is None or document_encoding is None or header_encoding == document_encoding:
+        source = "header" if header_encoding else "meta"
+        encoding = header_encoding or document_encoding
+
+        # A UTF-8 document labelled with a different encoding would be decoded without errors, but wrongly
+        if encoding is not None and (encoding == "utf-8" or data.isascii() or not is_utf8(data)):
+            try:
+                return source, encoding_name(encoding), data.decode(encoding)
+            except UnicodeDecodeError:
+                pass
+
+    encoding, text = detect_encoding(data)
+
+    if encoding is not None:
+        # The detector (or the fallback encodings) might use a different name than the other sources
+        try:
+            encoding = encoding_name(codecs.lookup(encoding).name)
+        except LookupError:
+            encoding = encoding.upper()
+
+    return "detector", encoding, text
+
+
+def resolve_mime(text, content_type=None):
+    """
+    Get the MIME type of a decoded document. Returns a tuple with the source of the MIME type ('header' or
+    'detector') and the MIME type
+    """
+    if content_type:
+        mime = content_type.split(';')[0].strip().lower()
+
+        if mime in HTML_MIME_TYPES and HTML_START_RE.match(text[:META_PREFIX_SIZE]):
+            return "header", mime
+
+    return "detector", magic.from_buffer(text[:DETECT_PREFIX_SIZE], mime=True)
+
+
+def looks_like_mojibake(text):
+    """
+    Cheap check of whether a decoded document might contain mojibake, e.g. to decide whether to run ftfy on it
+    """
+    return MOJIBAKE_RE.search(text) is not None
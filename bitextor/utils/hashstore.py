@@ -0,0 +1,236 @@
+#  This file is part of Bitextor.
+#
+#  Bitextor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bitextor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Bitextor.  If not, see <https://www.gnu.org/licenses/>.
+
+# Compact storage for the Murmur hashes used to deduplicate documents (e.g. --input_hash and --output_hash
+#  from bitextor_warc2preprocess.py). Hashes are stored as a sorted array of unsigned integers in a .npy file,
+#  which is memory-mapped and looked up with a binary search, so they do not need to be loaded as Python objects
+
+import sys
+import logging
+import argparse
+
+import numpy as np
+
+from bitextor.utils.common import open_xz_or_gzip_or_plain
+
+
+def is_hash_store(path):
+    return path[-4:] == ".npy"
+
+
+def hash_dtype(max_value):
+    return np.uint32 if max_value <= np.iinfo(np.uint32).max else np.uint64
+
+
+def read_hashes(path):
+    """
+    Read a file of hashes (either a hash store or a text file with one hash per line) as a sorted array
+    of unique hashes
+    """
+    if is_hash_store(path):
+        return np.load(path)
+
+    hashes = []
+
+    with open_xz_or_gzip_or_plain(path) as fh:
+        for line in fh:
+            line = line.strip()
+
+            if line:
+                hashes.append(int(line))
+
+    if not hashes:
+        return np.empty(0, dtype=np.uint32)
+
+    return np.unique(np.array(hashes, dtype=hash_dtype(max(hashes))))
+
+
+def write_hashes(path, hashes):
+    hashes = np.unique(np.asarray(hashes))
+
+    if len(hashes) == 0:
+        hashes = hashes.astype(np.uint32)
+    else:
+        hashes = hashes.astype(hash_dtype(int(hashes[-1])))
+
+    if is_hash_store(path):
+        with open(path, "wb") as fh:
+            np.save(fh, hashes)
+    else:
+        with open_xz_or_gzip_or_plain(path, "wt") as fh:
+            for h in hashes:
+                fh.write(f"{h}\n")
+
+
+def merge_hashes(paths, output_path):
+    """
+    Merge several files of hashes into a single one (duplicated hashes are stored once)
+    """
+    hashes = [read_hashes(path) for path in paths]
+    dtype = np.uint64 if any(h.dtype == np.uint64 for h in hashes) else np.uint32
+    merged = np.concatenate([h.astype(dtype) for h in hashes]) if hashes else np.empty(0, dtype=dtype)
+
+    write_hashes(output_path, merged)
+
+    return len(np.unique(merged))
+
+
+class BloomFilter(object):
+    """
+    Bloom filter over integer hashes, used to avoid the binary search for most of the hashes which are not stored
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = int(-capacity * np.log(error_rate) / (np.log(2) ** 2)) + 1
+        self.probes = max(int(round(self.size / capacity * np.log(2))), 1)
+        self.bits = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+
+    def _positions(self, hashes):
+        # Double hashing: the probe i of a value is h1 + i * h2, where h1 and h2 are obtained mixing the value
+        hashes = np.atleast_1d(np.asarray(hashes, dtype=np.uint64))
+
+        with np.errstate(over="ignore"):
+            h1 = hashes * np.uint64(0x9E3779B97F4A7C15)
+            h1 ^= h1 >> np.uint64(31)
+            h2 = (hashes ^ (hashes >> np.uint64(29))) * np.uint64(0xBF58476D1CE4E5B9)
+            h2 ^= h2 >> np.uint64(32)
+            h2 |= np.uint64(1)
+            probes = np.arange(self.probes, dtype=np.uint64)
+            positions = h1[:, None] + probes[None, :] * h2[:, None]
+
+        return positions % np.uint64(self.size)
+
+    def add(self, hashes):
+        positions = self._positions(hashes).ravel()
+        np.bitwise_or.at(self.bits, positions >> np.uint64(3), (1 << (positions & np.uint64(7))).astype(np.uint8))
+
+    def __contains__(self, h):
+        positions = self._positions(h)[0]
+        return bool(np.all(self.bits[positions >> np.uint64(3)] & (1 << (positions & np.uint64(7))).astype(np.uint8)))
+
+
+class HashStore(object):
+    """
+    Read-only set of hashes backed by a sorted array (memory-mapped if it is a hash store)
+    """
+
+    def __init__(self, path=None, bloom=False, bloom_error_rate=0.01):
+        if path is None:
+            self.hashes = np.empty(0, dtype=np.uint32)
+        elif is_hash_store(path):
+            self.hashes = np.load(path, mmap_mode="r")
+        else:
+            self.hashes = read_hashes(path)
+
+        self.bloom = None
+
+        if bloom and len(self.hashes) > 0:
+            self.bloom = BloomFilter(len(self.hashes), bloom_error_rate)
+
+            # Add the hashes in chunks in order to not load the whole memory-mapped array
+            for i in range(0, len(self.hashes), 1000000):
+                self.bloom.add(self.hashes[i:i + 1000000])
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, h):
+        if len(self.hashes) == 0 or h < 0 or h > int(self.hashes[-1]):
+            return False
+        if self.bloom is not None and h not in self.bloom:
+            return False
+
+        idx = np.searchsorted(self.hashes, h)
+
+        return idx < len(self.hashes) and int(self.hashes[idx]) == h
+
+
+class SeenHashes(object):
+    """
+    Growing set of hashes. New hashes are kept in a small Python set which is periodically compacted into a sorted
+    array, so every hash takes 4 (or 8) bytes instead of a Python int in a set
+    """
+
+    def __init__(self, buffer_size=100000):
+        self.buffer_size = buffer_size
+        self.buffer = set()
+        self.hashes = np.empty(0, dtype=np.uint32)
+
+    def compact(self):
+        if not self.buffer:
+            return
+
+        new_hashes = np.fromiter(self.buffer, dtype=np.uint64, count=len(self.buffer))
+        dtype = np.uint64 if self.hashes.dtype == np.uint64 or int(new_hashes.max()) > np.iinfo(np.uint32).max \
+            else np.uint32
+        self.hashes = np.union1d(self.hashes.astype(dtype), new_hashes.astype(dtype))
+        self.buffer = set()
+
+    def add(self, h):
+        self.buffer.add(h)
+
+        if len(self.buffer) >= self.buffer_size:
+            self.compact()
+
+    def __contains__(self, h):
+        if h in self.buffer:
+            return True
+        if len(self.hashes) == 0 or h < 0 or h > int(self.hashes[-1]):
+            return False
+
+        idx = np.searchsorted(self.hashes, h)
+
+        return idx < len(self.hashes) and int(self.hashes[idx]) == h
+
+    def __len__(self):
+        return len(self.hashes) + len(self.buffer)
+
+    def load(self, hashes):
+        """
+        Add a sorted array of hashes (e.g. the result of to_array())
+        """
+        self.compact()
+
+        if len(self.hashes) == 0:
+            self.hashes = np.asarray(hashes)
+        else:
+            dtype = np.uint64 if np.uint64 in (self.hashes.dtype, hashes.dtype) else np.uint32
+            self.hashes = np.union1d(self.hashes.astype(dtype), hashes.astype(dtype))
+
+    def to_array(self):
+        self.compact()
+
+        return self.hashes
+
+
+def main():
+    oparser = argparse.ArgumentParser(
+        description="Merge files of Murmur hashes (e.g. the --output_hash files of several bitextor_warc2preprocess.py "
+                    "jobs) into a single file. Files ending with '.npy' are read and written as sorted hash stores "
+                    "which can be memory-mapped; any other file is expected to contain one hash per line")
+    oparser.add_argument('inputs', nargs='+', help="Input files of hashes")
+    oparser.add_argument('-o', '--output', required=True, help="Output file of hashes")
+    options = oparser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    total = merge_hashes(options.inputs, options.output)
+
+    logging.info("%d unique hashes written to %s", total, options.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#  This file is part of Bitextor.
+#
+#  Bitextor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bitextor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Bitextor.  If not, see <https://www.gnu.org/licenses/>.
+
+# Index of the documents by the host of their URL, for the docalign stages which only pair documents of the same
+#  host (e.g. bitextor_idx2ridx.py -l): the host of every document is extracted once, and the candidates are
+#  enumerated within the documents of each host instead of comparing the hosts of every pair
+
+import re
+
+HOST_RE = re.compile(r'(https?://)([^/]+)([^?]*)(\?.*)?')
+
+
+def get_host(url):
+    match = HOST_RE.match(url)
+
+    if match is None:
+        raise Exception(f"Could not extract the host of '{url}'")
+
+    return match.group(2)
+
+
+class HostIndex(object):
+    """
+    Document IDs of every host, in the order in which they were added, and the host of every document ID
+    """
+
+    def __init__(self):
+        self.host_docs = {}
+        self.doc_hosts = {}
+
+    @classmethod
+    def from_urls(cls, doc_urls):
+        """
+        Build the index from (document ID, URL) pairs
+        """
+        index = cls()
+
+        for doc_id, url in doc_urls:
+            index.add(doc_id, url)
+
+        return index
+
+    def add(self, doc_id, url):
+        host = get_host(url)
+
+        self.doc_hosts[doc_id] = host
+        self.host_docs.setdefault(host, []).append(doc_id)
+
+    def host(self, doc_id):
+        return self.doc_hosts[doc_id]
+
+    def docs(self, host):
+        return self.host_docs.get(host, [])
+
+    def hosts(self):
+        return self.host_docs.keys()
+
+    def __len__(self):
+        return len(self.host_docs)
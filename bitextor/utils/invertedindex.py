@@ -0,0 +1,262 @@
+#  This file is part of Bitextor.
+#
+#  Bitextor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bitextor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Bitextor.  If not, see <https://www.gnu.org/licenses/>.
+
+# Binary inverted index of the words of the tokenised documents, written by docalign/bitextor_build_idx.py and read
+#  by docalign/bitextor_idx2ridx.py. For every language, the file contains the vocabulary (the word of every integer
+#  word ID, zlib-compressed), the number of documents of every word ID and the postings: the sorted indices
+#  (starting at 1) of the documents where the word appears, delta-encoded. The numbers are stored with a variable
+#  byte encoding (7 bits per byte, the highest bit is set in every byte but the last one of a number), so most of
+#  them take a single byte. The file is memory-mapped and decoded with numpy instead of parsed, but the postings are
+#  decoded into memory: the arrays are not used in place
+#
+# Size with 2 x 80k synthetic documents: 4.7 MB, against 9.8 MB for the gzipped text index and 17 MB with uint32
+#  postings. With -m 15 (as in the pipeline), most of the index is the vocabulary, and the gain is small: 334 KB,
+#  against 343 KB for the gzipped text index and 775 KB with uint32 postings
+#
+# Layout: MAGIC, JSON header length (uint64), JSON header and the data of the languages, whose position (relative to
+#  the end of the header) is in the header
+
+import json
+import mmap
+import struct
+import zlib
+
+import numpy as np
+
+MAGIC = b"BITEXTOR-IDX\x00\x02\x00\x00"
+
+
+def is_binary_index(path):
+    try:
+        with open(path, "rb") as fh:
+            return fh.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def delta_encode(doc_ids, offsets):
+    """
+    Delta-encode the postings of every word (the first posting of a word is kept as is)
+    """
+    deltas = doc_ids.copy()
+    deltas[1:] -= doc_ids[:-1]
+
+    starts = offsets[:-1]
+    deltas[starts] = doc_ids[starts]
+
+    return deltas
+
+
+def varbyte_encode(values):
+    """
+    Encode an array of integers (< 2^35) with a variable byte encoding, and return the bytes
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+
+    for bits in range(7, 35, 7):
+        lengths += values >= (1 << bits)
+
+    starts = np.cumsum(lengths) - lengths
+    data = np.zeros(int(lengths.sum()), dtype=np.uint8)
+
+    for byte in range(int(lengths.max()) if len(values) else 0):
+        selected = lengths > byte
+        data_byte = (values[selected] >> np.uint64(7 * byte)) & np.uint64(0x7f)
+        # The highest bit marks that the number continues in the next byte
+        data_byte |= np.where(lengths[selected] > byte + 1, 0x80, 0).astype(np.uint64)
+        data[starts[selected] + byte] = data_byte
+
+    return data.tobytes()
+
+
+def varbyte_decode(data):
+    """
+    Decode the integers of an array of bytes with a variable byte encoding, and return them as an uint64 array
+    """
+    data = np.asarray(data, dtype=np.uint8)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.empty(len(ends), dtype=np.int64)
+    starts[:1] = 0
+    starts[1:] = ends[:-1] + 1
+    lengths = ends - starts + 1
+    values = np.zeros(len(ends), dtype=np.uint64)
+
+    for byte in range(int(lengths.max()) if len(ends) else 0):
+        selected = lengths > byte
+        values[selected] |= (data[starts[selected] + byte] & 0x7f).astype(np.uint64) << np.uint64(7 * byte)
+
+    return values
+
+
+class LanguageIndex(object):
+    """
+    Inverted index of the documents of a language: vocabulary (list of words, the position is the word ID),
+    offsets (uint64 array with the position of the postings of every word ID, plus the total; the number of
+    documents of every word is stored instead) and postings (delta-encoded uint32 document indices)
+    """
+
+    def __init__(self, lang, vocabulary, offsets, postings, num_docs):
+        self.lang = lang
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.postings = postings
+        self.num_docs = num_docs
+
+    @classmethod
+    def from_pairs(cls, lang, vocabulary, word_ids, doc_ids, num_docs, max_occ=-1):
+        """
+        Build the index from the (word ID, document index) pairs of the words of every document. Words which appear
+        in more than max_occ documents (if it is not -1) are discarded, as they might be stop words
+        """
+        word_ids = np.asarray(word_ids, dtype=np.uint32)
+        doc_ids = np.asarray(doc_ids, dtype=np.uint32)
+
+        order = np.lexsort((doc_ids, word_ids))
+        word_ids = word_ids[order]
+        doc_ids = doc_ids[order]
+
+        counts = np.bincount(word_ids, minlength=len(vocabulary))
+        keep = counts > 0
+        if max_occ != -1:
+            keep &= counts <= max_occ
+
+        doc_ids = doc_ids[keep[word_ids]]
+        counts = counts[keep]
+        vocabulary = [word for word, kept in zip(vocabulary, keep) if kept]
+
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.uint64)
+        np.cumsum(counts, out=offsets[1:])
+
+        return cls(lang, vocabulary, offsets, delta_encode(doc_ids, offsets), num_docs)
+
+    def __len__(self):
+        return len(self.vocabulary)
+
+    def doc_frequencies(self):
+        return np.diff(self.offsets)
+
+    def word_postings(self, word_id):
+        start, end = int(self.offsets[word_id]), int(self.offsets[word_id + 1])
+
+        return np.cumsum(self.postings[start:end], dtype=np.uint32)
+
+    def decode_postings(self):
+        """
+        Return the word ID and the document index of every posting, as arrays sorted by word ID and document index
+        """
+        counts = self.doc_frequencies().astype(np.int64)
+        word_ids = np.repeat(np.arange(len(self.vocabulary), dtype=np.uint32), counts)
+
+        if len(self.postings) == 0:
+            return word_ids, np.empty(0, dtype=np.uint32)
+
+        # Cumulative sum of the whole array, minus the cumulative sum before the first posting of each word
+        cumulative = np.cumsum(self.postings, dtype=np.uint64)
+        starts = self.offsets[:-1].astype(np.int64)
+        base = cumulative[starts] - self.postings[starts]
+        doc_ids = (cumulative - np.repeat(base, counts)).astype(np.uint32)
+
+        return word_ids, doc_ids
+
+    def items(self):
+        """
+        Iterate over the words and their list of document indices
+        """
+        word_ids, doc_ids = self.decode_postings()
+        doc_ids = doc_ids.tolist()
+        offsets = self.offsets.tolist()
+
+        for word_id, word in enumerate(self.vocabulary):
+            yield word, doc_ids[offsets[word_id]:offsets[word_id + 1]]
+
+
+def write_index(path, indices):
+    """
+    Write the LanguageIndex of every language to a binary index file
+    """
+    header = {"languages": []}
+    sections = []
+    position = 0
+
+    for index in indices:
+        section = {"lang": index.lang, "words": len(index.vocabulary), "docs": index.num_docs,
+                   "postings_count": len(index.postings)}
+
+        for name, data in (("frequencies", varbyte_encode(index.doc_frequencies())),
+                           ("postings", varbyte_encode(index.postings)),
+                           ("vocabulary", zlib.compress("\n".join(index.vocabulary).encode("utf-8")))):
+            section[name] = position
+            section[name + "_size"] = len(data)
+            sections.append(data)
+            position += len(data)
+
+        header["languages"].append(section)
+
+    header = json.dumps(header).encode("utf-8")
+
+    with open(path, "wb") as fh:
+        fh.write(MAGIC)
+        fh.write(struct.pack("<Q", len(header)))
+        fh.write(header)
+
+        for data in sections:
+            fh.write(data)
+
+
+def read_index(path):
+    """
+    Memory-map a binary index file, and return a dict with the LanguageIndex of every language
+    """
+    with open(path, "rb") as fh:
+        if fh.read(len(MAGIC)) != MAGIC:
+            raise Exception(f"'{path}' is not a binary index")
+
+        buffer = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    header_size = struct.unpack("<Q", buffer[len(MAGIC):len(MAGIC) + 8])[0]
+    header_start = len(MAGIC) + 8
+    header = json.loads(buffer[header_start:header_start + header_size].decode("utf-8"))
+    data_start = header_start + header_size
+    indices = {}
+
+    def section_data(section, name):
+        return np.frombuffer(buffer, dtype=np.uint8, count=section[name + "_size"],
+                             offset=data_start + section[name])
+
+    for section in header["languages"]:
+        vocabulary = zlib.decompress(section_data(section, "vocabulary")).decode("utf-8")
+        vocabulary = vocabulary.split("\n") if section["words"] else []
+        offsets = np.zeros(section["words"] + 1, dtype=np.uint64)
+        np.cumsum(varbyte_decode(section_data(section, "frequencies")), out=offsets[1:])
+        postings = varbyte_decode(section_data(section, "postings")).astype(np.uint32)
+
+        if len(postings) != section["postings_count"] or int(offsets[-1]) != len(postings):
+            raise Exception(f"The postings of '{section['lang']}' in '{path}' are corrupted")
+
+        indices[section["lang"]] = LanguageIndex(section["lang"], vocabulary, offsets, postings, section["docs"])
+
+    return indices
+
+
+def write_tsv(indices, fh):
+    """
+    Export the indices in the text format (lang, word and the document indices joined by ':')
+    """
+    fh.write("lang\tword\tdoc_idxs\n")
+
+    for index in indices:
+        for word, doc_ids in index.items():
+            fh.write(index.lang + "\t" + word + "\t" + ":".join(map(str, doc_ids)) + "\n")
@@ -0,0 +1,146 @@
+#  This file is part of Bitextor.
+#
+#  Bitextor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bitextor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Bitextor.  If not, see <https://www.gnu.org/licenses/>.
+
+# Near-duplicate detection of documents with 64-bit SimHash signatures computed over word shingles. Signatures
+#  are indexed by bands (LSH): if two signatures differ in at most k bits, and they are split into k + 1 bands,
+#  at least one of the bands is identical, so only the signatures which share a band have to be compared
+
+import mmh3
+import numpy as np
+
+from bitextor.utils.hashstore import read_hashes, write_hashes
+
+
+def simhash(text, shingle_size=4):
+    words = text.lower().split()
+
+    if len(words) == 0:
+        return 0
+
+    shingles = [' '.join(words[i:i + shingle_size]) for i in range(max(len(words) - shingle_size + 1, 1))]
+    hashes = np.array([mmh3.hash64(s, signed=False)[0] for s in shingles], dtype=np.uint64)
+
+    # Every bit of the signature is the majority vote of the same bit of the hashes of the shingles
+    bits = np.unpackbits(hashes.view(np.uint8)).reshape(-1, 64)
+    signature = np.packbits(bits.sum(axis=0) * 2 > len(shingles)).view(np.uint64)[0]
+
+    return int(signature)
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class SimHashIndex(object):
+    """
+    Signatures indexed by bands. New signatures are kept in small Python buckets which are periodically compacted
+    into numpy arrays: for every band, the values of the band (uint8 to uint64, depending on its width) and the
+    signatures, sorted by the value of the band. Every compacted signature takes the size of the band value plus 8
+    bytes for every band, e.g. 40 bytes with the default 4 bands of 16 bits (max_distance=3)
+    """
+
+    def __init__(self, max_distance=3, buffer_size=100000):
+        self.max_distance = max_distance
+        self.buffer_size = buffer_size
+        self.buffer_len = 0
+        self.bands = []
+
+        nbands = max_distance + 1
+        start = 0
+
+        for i in range(nbands):
+            width = 64 // nbands + (1 if i < 64 % nbands else 0)
+            mask = (1 << width) - 1
+            self.bands.append({"shift": start, "mask": mask, "buckets": {},
+                               "keys": np.empty(0, dtype=np.min_scalar_type(mask)),
+                               "signatures": np.empty(0, dtype=np.uint64)})
+            start += width
+
+    def compact(self, signatures=None):
+        """
+        Move the buffered signatures (and the provided array of signatures, if any) to the sorted arrays
+        """
+        if signatures is None:
+            signatures = np.empty(0, dtype=np.uint64)
+        if self.buffer_len:
+            buffered = [signature for bucket in self.bands[0]["buckets"].values() for signature in bucket]
+            signatures = np.concatenate((signatures, np.array(buffered, dtype=np.uint64)))
+
+        if len(signatures) == 0:
+            return
+
+        for band in self.bands:
+            keys = ((signatures >> np.uint64(band["shift"])) & np.uint64(band["mask"])).astype(band["keys"].dtype)
+            keys = np.concatenate((band["keys"], keys))
+            band_signatures = np.concatenate((band["signatures"], signatures))
+            order = np.argsort(keys, kind="stable")
+
+            band["keys"] = keys[order]
+            band["signatures"] = band_signatures[order]
+            band["buckets"] = {}
+
+        self.buffer_len = 0
+
+    def add(self, signature):
+        for band in self.bands:
+            band["buckets"].setdefault((signature >> band["shift"]) & band["mask"], []).append(signature)
+
+        self.buffer_len += 1
+
+        if self.buffer_len >= self.buffer_size:
+            self.compact()
+
+    def find_near_duplicate(self, signature):
+        """
+        Return a stored signature which is at most max_distance bits away from the provided one, or None
+        """
+        for band in self.bands:
+            key = (signature >> band["shift"]) & band["mask"]
+
+            for candidate in band["buckets"].get(key, []):
+                if hamming_distance(signature, candidate) <= self.max_distance:
+                    return candidate
+
+            # The key has to have the dtype of the array, otherwise numpy casts the whole array to search it
+            key = band["keys"].dtype.type(key)
+            start = band["keys"].searchsorted(key, side="left")
+            end = band["keys"].searchsorted(key, side="right")
+
+            for candidate in band["signatures"][start:end].tolist():
+                if hamming_distance(signature, candidate) <= self.max_distance:
+                    return candidate
+
+        return None
+
+    def __contains__(self, signature):
+        return self.find_near_duplicate(signature) is not None
+
+    def __len__(self):
+        return len(self.bands[0]["signatures"]) + self.buffer_len
+
+    def update(self, signatures):
+        self.compact(np.asarray(signatures, dtype=np.uint64))
+
+    def to_array(self):
+        self.compact()
+
+        # Every signature is stored in all the bands, so the first one contains all of them
+        return np.unique(self.bands[0]["signatures"])
+
+    def load(self, path):
+        self.update(read_hashes(path))
+
+    def save(self, path):
+        write_hashes(path, self.to_array())
@@ -0,0 +1,136 @@
+#  This file is part of Bitextor.
+#
+#  Bitextor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bitextor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Bitextor.  If not, see <https://www.gnu.org/licenses/>.
+
+# Per-stage timing, counters and drop reasons of the record processing scripts (e.g. bitextor_warc2preprocess.py),
+#  periodically dumped as JSON (--stats-json)
+
+import os
+import json
+import time
+import random
+from contextlib import contextmanager
+from collections import Counter, defaultdict
+
+
+@contextmanager
+def timed(timings, stage):
+    """
+    Add the time spent in the block to timings[stage]
+    """
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+class StageStats(object):
+    """
+    Cumulative time of a stage and a reservoir sample of its latencies, used to estimate the percentiles
+    """
+
+    def __init__(self, reservoir_size=10000, seed=1):
+        self.count = 0
+        self.total = 0.0
+        self.reservoir_size = reservoir_size
+        self.samples = []
+        self.random = random.Random(seed)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+
+        if len(self.samples) < self.reservoir_size:
+            self.samples.append(seconds)
+        else:
+            idx = self.random.randrange(self.count)
+
+            if idx < self.reservoir_size:
+                self.samples[idx] = seconds
+
+    def percentile(self, p):
+        if not self.samples:
+            return 0.0
+
+        samples = sorted(self.samples)
+
+        return samples[min(int(p / 100.0 * len(samples)), len(samples) - 1)]
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total_seconds": round(self.total, 6),
+            "p50_ms": round(self.percentile(50) * 1000.0, 3),
+            "p99_ms": round(self.percentile(99) * 1000.0, 3),
+        }
+
+
+class PipelineStats(object):
+
+    def __init__(self, path=None, flush_interval=60):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.start = time.time()
+        self.last_flush = self.start
+        self.stages = defaultdict(StageStats)
+        self.counters = Counter()
+        self.drops = Counter()
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.stages[stage].add(time.perf_counter() - start)
+
+    def add_timings(self, timings):
+        for stage, seconds in timings.items():
+            self.stages[stage].add(seconds)
+
+    def count(self, counter, n=1):
+        self.counters[counter] += n
+
+    def drop(self, reason):
+        self.drops[reason] += 1
+
+    def to_dict(self):
+        return {
+            "elapsed_seconds": round(time.time() - self.start, 3),
+            "counters": dict(self.counters),
+            "drops": dict(self.drops),
+            "stages": {stage: self.stages[stage].to_dict() for stage in sorted(self.stages)},
+        }
+
+    def flush(self):
+        self.last_flush = time.time()
+
+        if not self.path:
+            return
+
+        # Write and rename, so the file is always complete even if it is read while the process is running
+        tmp_path = f"{self.path}.tmp"
+
+        with open(tmp_path, "w") as fh:
+            json.dump(self.to_dict(), fh, indent=2, sort_keys=True)
+            fh.write("\n")
+
+        os.replace(tmp_path, self.path)
+
+    def maybe_flush(self):
+        if self.path and time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
@@ -0,0 +1,101 @@
+#  This file is part of Bitextor.
+#
+#  Bitextor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bitextor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Bitextor.  If not, see <https://www.gnu.org/licenses/>.
+
+# Triage of WARC records using only their WARC and HTTP headers, shared by bitextor_warc2htmlwarc.py and
+#  bitextor_warc2preprocess.py. Records which are discarded are never read: warcio skips their payload while
+#  looking for the next record, without keeping it in memory
+
+# URL extensions of documents which do not contain text
+SKIPPED_EXTENSIONS = frozenset({
+    ".gif", ".jpg", ".jpeg", ".png", ".css", ".js", ".mp3", ".mp4", ".ogg", ".midi", ".swf",
+})
+
+# Prefixes of the HTTP Content-Type of documents which do not contain text
+SKIPPED_MIME_PREFIXES = (
+    "image/",
+    "audio/",
+    "video/",
+    "text/x-component",
+    "text/x-js",
+    "text/javascript",
+    "application/x-javascript",
+    "text/css",
+    "application/javascript",
+    "application/x-shockwave-flash",
+    "application/octet-stream",
+    "application/x-font-ttf",
+)
+
+
+def record_url(record):
+    """
+    Target URI of a record, without the angle brackets some crawlers add, or None if it is unknown
+    """
+    url = record.rec_headers.get_header('WARC-Target-URI')
+
+    if url and url[0] == '<' and url[-1] == '>':
+        url = url[1:-1]
+    if not url or url == "unknown":
+        return None
+
+    return url.replace('\t', ' ')
+
+
+def url_extension(url):
+    dot = url.rfind('.')
+
+    # Only the last path component
+    if dot == -1 or '/' in url[dot:]:
+        return ""
+
+    return url[dot:].lower()
+
+
+def triage_record(record, max_size=0):
+    """
+    Classify a record from its headers. Returns a tuple with the reason why the record has to be skipped (which is
+    used as the drop category of the statistics), or None if it has to be processed, and its URL
+    """
+    if record.rec_type != 'response' and record.rec_type != 'resource':
+        return "record_type", None
+
+    url = record_url(record)
+    if url is None:
+        return "unknown_url", None
+
+    warc_content_type = record.rec_headers.get_header('Content-Type')
+    if warc_content_type is None:
+        return "no_content_type", url
+    if "text/dns" in warc_content_type:
+        return "dns", url
+
+    content_length = record.rec_headers.get_header('Content-Length')
+    if max_size > 0 and content_length and content_length.isdigit() and int(content_length) > max_size:
+        return "size", url
+
+    if record.http_headers is not None:
+        content_type = record.http_headers.get_header('Content-Type')
+
+        if content_type is not None and content_type.strip().lower().startswith(SKIPPED_MIME_PREFIXES):
+            return "mime", url
+
+    if url_extension(url) in SKIPPED_EXTENSIONS:
+        return "extension", url
+
+    # Ignore robots.txt when processing records
+    if url.endswith("/robots.txt"):
+        return "robots_txt", url
+
+    return None, url
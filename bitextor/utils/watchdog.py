@@ -0,0 +1,64 @@
+#  This file is part of Bitextor.
+#
+#  Bitextor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bitextor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Bitextor.  If not, see <https://www.gnu.org/licenses/>.
+
+# CPU time budget for the processing of a single record, so a pathological document (e.g. deeply nested tables or
+#  huge inline scripts) is skipped instead of blocking the whole stream. The budget is enforced with a SIGPROF
+#  timer, so it has to be used from the main thread of a process (e.g. the serial loop or a pool worker), and it
+#  only interrupts Python code: a long call to a C extension is interrupted once it returns
+
+import time
+import signal
+
+
+class RecordBudgetExceeded(BaseException):
+    # Not an Exception, so the broad 'except Exception' of the parsing code does not swallow it
+    pass
+
+
+class CPUBudget(object):
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expired = False
+        self.start = None
+        self.previous_handler = None
+
+    def handler(self, signum, frame):
+        # SIGPROF measures the CPU time of the whole process, which might have other threads, so the CPU time of
+        # the current thread is checked before giving up
+        used = time.thread_time() - self.start
+
+        if used >= self.seconds:
+            self.expired = True
+            raise RecordBudgetExceeded(f"CPU time budget of {self.seconds} seconds exceeded")
+
+        signal.setitimer(signal.ITIMER_PROF, self.seconds - used)
+
+    def __enter__(self):
+        self.expired = False
+
+        if self.seconds > 0:
+            self.start = time.thread_time()
+            self.previous_handler = signal.signal(signal.SIGPROF, self.handler)
+            signal.setitimer(signal.ITIMER_PROF, self.seconds)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.seconds > 0:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self.previous_handler)
+
+        return False
@@ -0,0 +1,160 @@
+#  This file is part of Bitextor.
+#
+#  Bitextor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bitextor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Bitextor.  If not, see <https://www.gnu.org/licenses/>.
+
+# Output writers of the preprocessing scripts. Writes are buffered and handed to a thread pool, where they are
+#  compressed (zlib and lzma release the GIL), so the compression of the output files does not block the record loop.
+#  Every file keeps a single compressor which receives the data in order, so the output is the same as writing it
+#  synchronously
+
+import os
+import gzip
+import lzma
+from collections import OrderedDict
+
+
+class BackgroundWriter(object):
+    """
+    File-like object which buffers the data written to fh and writes it from an executor. At most one write of
+    every file is in flight, so the data is written in order and the memory used by the buffers is bounded
+    """
+
+    def __init__(self, fh, executor, buffer_size=1 << 20):
+        self.fh = fh
+        self.executor = executor
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+        self.pending = None
+
+    def wait(self):
+        if self.pending is not None:
+            # Raise the errors of the write in the thread which is writing
+            self.pending.result()
+            self.pending = None
+
+    def submit(self):
+        self.wait()
+
+        if self.buffer:
+            self.pending = self.executor.submit(self.fh.write, b"".join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+
+        if self.buffered >= self.buffer_size:
+            self.submit()
+
+        return len(data)
+
+    def flush(self):
+        self.submit()
+        self.wait()
+        self.fh.flush()
+
+    def checkpoint(self):
+        self.submit()
+        self.wait()
+
+        return self.fh.checkpoint()
+
+    def close(self):
+        self.submit()
+        self.wait()
+        self.fh.close()
+
+
+class MemberWriter(object):
+    """
+    Compressed file written as a sequence of gzip members (or xz streams), which is read as a single file. A new
+    member is started after every checkpoint, so the file can be truncated at the size returned by checkpoint() and
+    opened again in append mode. The compression is given by the extension of the path unless it is provided
+    """
+
+    def __init__(self, path, mode="wb", compression=None):
+        self.compression = compression if compression is not None else path[-2:]
+        self.raw = open(path, mode)
+        self.fh = None
+
+    def open_member(self):
+        if self.compression == "gz":
+            return gzip.GzipFile(fileobj=self.raw, mode="wb")
+        elif self.compression == "xz":
+            return lzma.LZMAFile(self.raw, "wb", format=lzma.FORMAT_XZ)
+        else:
+            return self.raw
+
+    def write(self, data):
+        if self.fh is None:
+            self.fh = self.open_member()
+
+        return self.fh.write(data)
+
+    def flush(self):
+        if self.fh is not None:
+            self.fh.flush()
+        self.raw.flush()
+
+    def finish_member(self):
+        if self.fh is not None and self.fh is not self.raw:
+            self.fh.close()
+        self.fh = None
+
+    def checkpoint(self):
+        # Finish the current member, so the file is complete up to this point
+        self.finish_member()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+
+        return self.raw.tell()
+
+    def close(self):
+        if self.raw.tell() == 0:
+            # An empty member, so the file is a valid (empty) compressed file
+            self.fh = self.open_member()
+
+        self.finish_member()
+        self.raw.close()
+
+
+class HandlePool(object):
+    """
+    Least recently used pool of open files: when more than max_open files are open, the least recently used one is
+    closed, and it is opened again (with open_function, which should append) the next time it is requested
+    """
+
+    def __init__(self, open_function, max_open=64):
+        self.open_function = open_function
+        self.max_open = max_open
+        self.handles = OrderedDict()
+
+    def get(self, key):
+        if key in self.handles:
+            self.handles.move_to_end(key)
+        else:
+            if len(self.handles) >= self.max_open:
+                _, fh = self.handles.popitem(last=False)
+                fh.close()
+
+            self.handles[key] = self.open_function(key)
+
+        return self.handles[key]
+
+    def close(self):
+        while self.handles:
+            _, fh = self.handles.popitem(last=False)
+            fh.close()
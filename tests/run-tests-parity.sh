@@ -0,0 +1,201 @@
+#!/bin/bash
+
+DIR="$( cd "$(dirname "$0")" >/dev/null 2>&1 ; pwd -P )"
+source "$DIR/common.sh"
+
+exit_program()
+{
+    >&2 echo "$1 [-w workdir] [-j threads]"
+    >&2 echo ""
+    >&2 echo "Runs several tests to check that the parallel, resumed and cached modes of the Bitextor scripts"
+    >&2 echo "produce the same output as the serial mode"
+    >&2 echo ""
+    >&2 echo "OPTIONS:"
+    >&2 echo "  -w <workdir>            Working directory. By default: \$HOME"
+    >&2 echo "  -j <threads>            Workers of the parallel modes. By default: 4"
+    exit 1
+}
+
+WORK="${HOME}"
+WORK="${WORK/#\~/$HOME}" # Expand ~ to $HOME
+THREADS=4
+
+while getopts "hw:j:" i; do
+    case "$i" in
+        h) exit_program "$(basename "$0")" ; break ;;
+        w) WORK=${OPTARG};;
+        j) THREADS="${OPTARG}";;
+        *) exit_program "$(basename "$0")" ; break ;;
+    esac
+done
+shift $((OPTIND-1))
+
+BITEXTOR="${DIR}/../bitextor"
+FAILS="${WORK}/data/fails.log"
+mkdir -p "${WORK}"
+mkdir -p "${WORK}/permanent"
+mkdir -p "${WORK}/data/warc"
+mkdir -p "${WORK}/data/parity"
+mkdir -p "${WORK}/reports"
+rm -f "$FAILS"
+touch "$FAILS"
+
+# Download necessary files
+# WARCs
+download_file "${WORK}/data/warc/greenpeace.warc.gz" https://github.com/bitextor/bitextor-data/releases/download/bitextor-warc-v1.1/greenpeace.canada-small.warc.gz &
+# Dictionaries
+download_dictionary "en-fr" "${WORK}/permanent" &
+
+wait
+
+WARC="${WORK}/data/warc/greenpeace.warc.gz"
+DIC="${WORK}/permanent/en-fr.dic"
+OUT="${WORK}/data/parity"
+PREPROCESS_ARGS="--langs en,fr --near-duplicates-distance 3 --links-images"
+
+# Number of files which differ between two directories (the content is compared, so compressed files are
+#  compared after decompressing them); the files which are only in one of them also differ
+diff_dirs()
+{
+    local dir1="$1"
+    local dir2="$2"
+    local files=$( (cd "$dir1" && find . -type f; cd "$dir2" && find . -type f) | grep -v "[.]json$" | sort -u)
+    local ndiffs=0
+
+    for f in $files; do
+        if [[ "$(get_hash "${dir1}/${f}")" != "$(get_hash "${dir2}/${f}")" ]]; then
+            >&2 echo "Different file: ${f}"
+            ndiffs=$((ndiffs + 1))
+        fi
+    done
+
+    echo "$ndiffs"
+}
+
+# Compare the output of a mode with the reference, and annotate the result of the test
+annotate_comparison()
+{
+    local status="$1"
+    local reference="$2"
+    local output="$3"
+    local nolines=$(find "${reference}" -type f -exec zcat -f {} + 2> /dev/null | wc -l)
+
+    if [[ "$status" == "0" ]]; then
+        local ndiffs=$([[ -d "$reference" ]] && diff_dirs "$reference" "$output" \
+                       || ([[ "$(get_hash "$reference")" == "$(get_hash "$output")" ]] && echo 0 || echo 1))
+        local status=$([[ "$ndiffs" != "0" ]] && echo 1 || echo 0)
+        local desc="different files: ${ndiffs}"
+    else
+        local desc="the command failed"
+    fi
+
+    annotate_and_echo_info "${TEST_ID}" "${status}" "${nolines}" "${desc}"
+}
+
+rm -rf "${OUT}"/*
+
+# Preprocessing (id >= 10)
+## Serial mode (reference of the rest of the tests)
+python3 ${BITEXTOR}/bitextor_warc2preprocess.py --input "${WARC}" --output-dir "${OUT}/preprocess" ${PREPROCESS_ARGS} \
+    &> "${WORK}/reports/parity-preprocess.report"
+PREPROCESS_STATUS=$?
+
+## --workers
+TEST_ID="10"
+python3 ${BITEXTOR}/bitextor_warc2preprocess.py --input "${WARC}" --output-dir "${OUT}/${TEST_ID}" ${PREPROCESS_ARGS} \
+    --workers ${THREADS} &> "${WORK}/reports/parity-${TEST_ID}.report"
+annotate_comparison $(( $? + PREPROCESS_STATUS )) "${OUT}/preprocess" "${OUT}/${TEST_ID}"
+
+## --checkpoint: the run is killed once it has processed some records, and resumed
+TEST_ID="11"
+python3 ${BITEXTOR}/bitextor_warc2preprocess.py --input "${WARC}" --output-dir "${OUT}/${TEST_ID}" ${PREPROCESS_ARGS} \
+    --checkpoint "${OUT}/${TEST_ID}.checkpoint" --checkpoint-interval 0 &> "${WORK}/reports/parity-${TEST_ID}.report" &
+pid=$!
+while kill -0 $pid 2> /dev/null && \
+      [[ "$(grep -o '"input_record": [0-9]*' "${OUT}/${TEST_ID}.checkpoint" 2> /dev/null | grep -o "[0-9]*$")" -lt 100 ]]; do
+    sleep 0.1
+done
+kill -9 $pid 2> /dev/null
+wait $pid 2> /dev/null
+python3 ${BITEXTOR}/bitextor_warc2preprocess.py --input "${WARC}" --output-dir "${OUT}/${TEST_ID}" ${PREPROCESS_ARGS} \
+    --checkpoint "${OUT}/${TEST_ID}.checkpoint" --checkpoint-interval 0 --resume \
+    &>> "${WORK}/reports/parity-${TEST_ID}.report"
+annotate_comparison $(( $? + PREPROCESS_STATUS )) "${OUT}/preprocess" "${OUT}/${TEST_ID}"
+
+## --digest-cache: the second run gets the results from the cache
+TEST_ID="12"
+python3 ${BITEXTOR}/bitextor_warc2preprocess.py --input "${WARC}" --output-dir "${OUT}/${TEST_ID}-first" \
+    ${PREPROCESS_ARGS} --digest-cache "${OUT}/${TEST_ID}.cache" &> "${WORK}/reports/parity-${TEST_ID}.report" && \
+python3 ${BITEXTOR}/bitextor_warc2preprocess.py --input "${WARC}" --output-dir "${OUT}/${TEST_ID}" ${PREPROCESS_ARGS} \
+    --digest-cache "${OUT}/${TEST_ID}.cache" &>> "${WORK}/reports/parity-${TEST_ID}.report"
+annotate_comparison $(( $? + PREPROCESS_STATUS )) "${OUT}/preprocess" "${OUT}/${TEST_ID}"
+
+## --htmlwarc: same output as preprocessing the output of bitextor_warc2htmlwarc.py (but the original encoding)
+TEST_ID="13"
+python3 ${BITEXTOR}/bitextor_warc2htmlwarc.py -i "${WARC}" -o "${OUT}/${TEST_ID}.warc.gz" \
+    &> "${WORK}/reports/parity-${TEST_ID}.report" && \
+python3 ${BITEXTOR}/bitextor_warc2preprocess.py --input "${OUT}/${TEST_ID}.warc.gz" --output-dir "${OUT}/${TEST_ID}-reference" \
+    ${PREPROCESS_ARGS} &>> "${WORK}/reports/parity-${TEST_ID}.report" && \
+python3 ${BITEXTOR}/bitextor_warc2preprocess.py --input "${WARC}" --output-dir "${OUT}/${TEST_ID}" ${PREPROCESS_ARGS} \
+    --htmlwarc &>> "${WORK}/reports/parity-${TEST_ID}.report"
+status=$?
+rm -f "${OUT}/${TEST_ID}"/*/encoding.gz "${OUT}/${TEST_ID}-reference"/*/encoding.gz
+annotate_comparison ${status} "${OUT}/${TEST_ID}-reference" "${OUT}/${TEST_ID}"
+
+# Sentence splitting and tokenisation (id >= 20)
+## --workers
+TEST_ID="20"
+mkdir -p "${OUT}/split" "${OUT}/${TEST_ID}"
+status=${PREPROCESS_STATUS}
+for lang in en fr; do
+    python3 ${BITEXTOR}/bitextor_split.py --text "${OUT}/preprocess/${lang}/plain_text.gz" --langcode ${lang} \
+        --sentences-output "${OUT}/split/${lang}.sentences" --tokenised-output "${OUT}/split/${lang}.tokenised.gz" \
+        &>> "${WORK}/reports/parity-split.report" && \
+    python3 ${BITEXTOR}/bitextor_split.py --text "${OUT}/preprocess/${lang}/plain_text.gz" --langcode ${lang} \
+        --sentences-output "${OUT}/${TEST_ID}/${lang}.sentences" \
+        --tokenised-output "${OUT}/${TEST_ID}/${lang}.tokenised.gz" --workers ${THREADS} \
+        &>> "${WORK}/reports/parity-${TEST_ID}.report"
+    status=$(( status + $? ))
+done
+annotate_comparison ${status} "${OUT}/split" "${OUT}/${TEST_ID}"
+
+# Document alignment (id >= 30)
+BUILD_IDX_ARGS="--lang1 en --lang2 fr --text1 ${OUT}/split/en.tokenised.gz --text2 ${OUT}/split/fr.tokenised.gz -m 15"
+mkdir -p "${OUT}/idx" "${OUT}/30" "${OUT}/31"
+
+## --workers of bitextor_build_idx.py
+TEST_ID="30"
+python3 ${BITEXTOR}/docalign/bitextor_build_idx.py ${BUILD_IDX_ARGS} --tsv > "${OUT}/idx/en-fr.idx" \
+    2> "${WORK}/reports/parity-idx.report" && \
+python3 ${BITEXTOR}/docalign/bitextor_build_idx.py ${BUILD_IDX_ARGS} --tsv --workers ${THREADS} --chunk-size 10 \
+    > "${OUT}/${TEST_ID}/en-fr.idx" 2> "${WORK}/reports/parity-${TEST_ID}.report"
+annotate_comparison $? "${OUT}/idx" "${OUT}/${TEST_ID}"
+
+## Binary index: same candidates as with the text index
+TEST_ID="31"
+python3 ${BITEXTOR}/docalign/bitextor_build_idx.py ${BUILD_IDX_ARGS} --output "${OUT}/${TEST_ID}/en-fr.bin" \
+    2> "${WORK}/reports/parity-${TEST_ID}.report"
+status=$?
+for direction in "en fr" "fr en"; do
+    set -- $direction
+    python3 ${BITEXTOR}/docalign/bitextor_idx2ridx.py "${OUT}/idx/en-fr.idx" -d "${DIC}" --lang1 $1 --lang2 $2 \
+        > "${OUT}/idx/$1-$2.ridx" 2>> "${WORK}/reports/parity-${TEST_ID}.report" && \
+    python3 ${BITEXTOR}/docalign/bitextor_idx2ridx.py "${OUT}/${TEST_ID}/en-fr.bin" -d "${DIC}" --lang1 $1 --lang2 $2 \
+        > "${OUT}/${TEST_ID}/$1-$2.ridx" 2>> "${WORK}/reports/parity-${TEST_ID}.report"
+    status=$(( status + $? ))
+done
+# The index itself is only compared through the candidates
+mv "${OUT}/${TEST_ID}/en-fr.bin" "${OUT}/${TEST_ID}.bin"
+cp "${OUT}/idx/en-fr.idx" "${OUT}/${TEST_ID}/en-fr.idx"
+annotate_comparison ${status} "${OUT}/idx" "${OUT}/${TEST_ID}"
+
+# Results
+failed=$(cat "$FAILS" | wc -l)
+
+echo "-------------------------------------"
+echo "            Fails Summary            "
+echo "-------------------------------------"
+echo -e "status\ttest-id\texit code / desc."
+cat "$FAILS"
+
+exit "$failed"